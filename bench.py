@@ -0,0 +1,1051 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the referral bot hot paths.
+
+Runs against synthetic populations in a temp directory, never against the
+real users.json. Usage:
+
+    python bench.py distribute --users 1000000
+    python bench.py accrual --users 200000 --views 2000
+    python bench.py render
+    python bench.py memory --users 200000
+    python bench.py startup --users 200000
+    python bench.py burst --users 200
+    python bench.py webhook --updates 500
+    python bench.py workers --users 100000 --workers 0,1,2,4
+    python bench.py leaderboard --users 1000000
+    python bench.py query --users 200000
+    python bench.py shards --users 200000
+    python bench.py writer --users 200000
+    python bench.py throttle --users 1000000
+    python bench.py suite --sizes 10000,100000,1000000 --json results.json
+    python bench.py suite --sizes 10000 --compare results.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import signal
+import time
+import random
+import logging
+import argparse
+import asyncio
+import tempfile
+import subprocess
+import platform
+import tracemalloc
+import threading
+import statistics
+import urllib.request
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+_TMP = tempfile.mkdtemp(prefix="referral-bench-")
+# every file or directory main.py writes, whatever STORAGE_MODE the run picks
+for _name, _path in (
+    ("DATA_FILE", "users.json"),
+    ("META_FILE", "meta.json"),
+    ("LEDGER_FILE", "ledger.jsonl"),
+    ("JOURNAL_FILE", "users.journal"),
+    ("SQLITE_FILE", "users.db"),
+    ("SNAPSHOT_FILE", "users.snap"),
+    ("SHARD_DIR", "users.shards"),
+    ("DEAD_LETTER_FILE", "dead_letters.jsonl"),
+    ("BROADCAST_FILE", "broadcast.json"),
+    ("PROFILE_DIR", "profiles"),
+):
+    os.environ.setdefault(_name, os.path.join(_TMP, _path))
+os.environ.setdefault("PERSIST_FLUSH_INTERVAL", "0")
+
+import main as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+# -----------------------
+# Synthetic data
+# -----------------------
+def make_population(n: int, invest_fraction: float = 0.5, seed: int = 1,
+                    pending_fraction: float = 0.0, skew: float = 0.0):
+    """
+    n users in the shape start() creates; `invest_fraction` of them hold an
+    investment started up to 40 days ago (so some are past the lock window).
+    Most users were referred by an earlier user.
+
+    `skew` is the chance a new user joins through the referrer of a random
+    earlier user instead of a uniformly random one, which piles referrals
+    onto a few big recruiters (preferential attachment). `pending_fraction`
+    of users each have an unconfirmed membership TXID, a pending investment
+    and a pending withdrawal; paid users then carry a TXID too.
+    """
+    rnd = random.Random(seed)
+    extra = random.Random(seed + 1)  # keeps the base population identical whatever the extras
+    now = datetime.utcnow()
+    users = {}
+    ids = []
+    for i in range(n):
+        uid = str(1_000_000_000 + i)
+        investment = None
+        if rnd.random() < invest_fraction:
+            start = now - timedelta(days=rnd.uniform(0, 40))
+            investment = {
+                "amount": float(rnd.choice((50, 100, 250, 1000))) + rnd.randint(0, 99) / 100,
+                "start_date": start.isoformat(),
+                "active": True,
+                "lock_until": (start + timedelta(days=bot.INVEST_LOCK_DAYS)).isoformat(),
+                "referrer_rewarded_for_invest": True,
+            }
+        referrer = str(1_000_000_000 + rnd.randrange(i)) if i and rnd.random() < 0.8 else None
+        if referrer and skew and extra.random() < skew:
+            referrer = users[ids[extra.randrange(i)]]["referrer"] or referrer
+        ids.append(uid)
+        users[uid] = {
+            "referrer": referrer,
+            "balance": round(rnd.uniform(0, 500), 2),
+            "earned_from_referrals": 0.0,
+            "left": 0,
+            "right": 0,
+            "referrals": [],
+            "paid": rnd.random() < 0.6,
+            "txid": None,
+            "pending_investment": None,
+            "investment": investment,
+            "pending_withdraw": None,
+            "membership_referrer_rewarded": False,
+            "direct_bonus_total": 0.0,
+            "pairing_bonus_total": 0.0,
+        }
+        if referrer:
+            users[referrer]["referrals"].append(uid)
+        if pending_fraction:
+            user = users[uid]
+            submitted = (now - timedelta(hours=extra.uniform(0, 72))).isoformat()
+            if user["paid"] or extra.random() < pending_fraction:
+                user["txid"] = f"{extra.getrandbits(128):032x}"
+            if extra.random() < pending_fraction:
+                user["pending_investment"] = {"amount": float(extra.choice((50, 100, 250))),
+                                              "txid": f"{extra.getrandbits(128):032x}", "submitted_at": submitted}
+            if extra.random() < pending_fraction and user["balance"] >= 10:
+                user["pending_withdraw"] = {"wallet": "TXyz", "amount": user["balance"], "submitted_at": submitted}
+    return users
+
+
+def install_population(records):
+    """Make `records` the bot's users and rebuild every structure derived from them."""
+    bot.users = records
+    bot.invest_columns = None
+    bot.query_index.invalidate()
+    bot.txid_index.build(records)
+    bot.pending_items.build(records)
+    for board in bot.LEADERBOARDS.values():
+        board.build(records)
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - t0, result
+
+
+# -----------------------
+# Benchmarks
+# -----------------------
+def bench_distribute(args):
+    """Per-user walk vs NumPy column store; results must match exactly."""
+    if bot.np is None:
+        sys.exit("numpy is not installed")
+    population = {uid: bot.UserRecord.from_dict(u)
+                  for uid, u in make_population(args.users, invest_fraction=args.invest_fraction).items()}
+    investors = sum(1 for u in population.values() if u["investment"])
+    print(f"users={args.users} investors={investors}")
+    now = datetime.utcnow()
+
+    bot.users = {uid: bot.copy_record(u) for uid, u in population.items()}
+    t_loop, n_loop = timed(bot._distribute_per_user, now)
+    expected = {uid: u["balance"] for uid, u in bot.users.items()}
+    expected_watermarks = {uid: u["investment"].get("accrued_through")
+                           for uid, u in bot.users.items() if u["investment"]}
+
+    bot.users = {uid: bot.copy_record(u) for uid, u in population.items()}
+    bot.invest_columns = None
+    t_build, bot.invest_columns = timed(bot.InvestmentColumns.build, bot.users)
+    t_vec, n_vec = timed(bot._distribute_columnar, now)
+    actual = {uid: u["balance"] for uid, u in bot.users.items()}
+    watermarks = {uid: u["investment"].get("accrued_through") for uid, u in bot.users.items() if u["investment"]}
+
+    assert n_loop == n_vec, (n_loop, n_vec)
+    assert actual == expected, "vectorized balances differ from per-user results"
+    assert watermarks == expected_watermarks, "vectorized watermarks differ from per-user results"
+    print(f"per-user loop : {t_loop * 1000:9.1f} ms  credited={n_loop}")
+    print(f"column build  : {t_build * 1000:9.1f} ms  (once, then kept up to date)")
+    print(f"vectorized    : {t_vec * 1000:9.1f} ms  credited={n_vec}  speedup x{t_loop / t_vec:.1f}")
+
+
+def bench_accrual(args):
+    """
+    Daily profit cost: a manual /distribute touches every investor each day,
+    lazy accrual only the users who look at their balance, plus one catch-up.
+    """
+    population = make_population(args.users, invest_fraction=args.invest_fraction)
+    investors = [uid for uid, u in population.items() if u["investment"]]
+    print(f"users={args.users} investors={len(investors)} views/day={args.views} days={args.days}")
+    now = datetime.utcnow()
+    distribute = bot._distribute_columnar if bot.np is not None else bot._distribute_per_user
+
+    def credited():
+        return sum(u["balance"] - population[uid]["balance"] for uid, u in bot.users.items())
+
+    bot.users = {uid: bot.copy_record(u) for uid, u in population.items()}
+    bot.invest_columns = None
+    t_manual, dirty = 0.0, 0
+    for day in range(1, args.days + 1):
+        t, n = timed(distribute, now + timedelta(days=day))
+        t_manual += t
+        dirty += n
+    paid_manual = credited()
+
+    bot.users = {uid: bot.copy_record(u) for uid, u in population.items()}
+    for uid in investors:  # everything up to now already paid out
+        bot.users[uid]["investment"]["accrued_through"] = now.isoformat()
+    rnd = random.Random(7)
+    t_lazy, views = 0.0, 0
+    for day in range(1, args.days + 1):
+        at = now + timedelta(days=day)
+        for uid in rnd.sample(investors, min(args.views, len(investors))):
+            t, _ = timed(bot.accrue_profit, uid, bot.users[uid], at)
+            t_lazy += t
+            views += 1
+    t_catchup = 0.0
+    for uid in investors:
+        t, _ = timed(bot.accrue_profit, uid, bot.users[uid], now + timedelta(days=args.days))
+        t_catchup += t
+
+    print(f"manual distribute : {t_manual / args.days * 1000:9.2f} ms/day  {dirty / args.days:9.0f} users saved/day"
+          f"  paid={paid_manual:.2f}")
+    print(f"lazy on view      : {t_lazy / args.days * 1000:9.2f} ms/day  {views / args.days:9.0f} users saved/day")
+    print(f"lazy catch-up all : {t_catchup * 1000:9.2f} ms once              paid={credited():.2f}")
+
+
+def _legacy_main_menu():
+    """The per-call menu builder the render cache replaced."""
+    keyboard = [
+        [bot.InlineKeyboardButton("💰 Balance", callback_data="menu:balance"),
+         bot.InlineKeyboardButton("💸 Invest", callback_data="menu:invest")],
+        [bot.InlineKeyboardButton("👥 Referrals", callback_data="menu:referral"),
+         bot.InlineKeyboardButton("💎 FAQ", callback_data="menu:faq")],
+        [bot.InlineKeyboardButton("🏦 Withdraw", callback_data="menu:withdraw"),
+         bot.InlineKeyboardButton("❓ Help", callback_data="menu:help")],
+        [bot.InlineKeyboardButton("🌟 Join Premium", callback_data="join_premium")]
+    ]
+    return bot.InlineKeyboardMarkup(keyboard)
+
+
+def _legacy_start_render(username, user_id):
+    referral_link = f"https://t.me/{username}?start={user_id}"
+    benefits_text = (
+        "💼 𝙋𝙧𝙚𝙢𝙞𝙪𝙢 𝙑𝙄𝙋 𝙈𝙚𝙢𝙗𝙚𝙧𝙨𝙝𝙞𝙥\n\n"
+        "👑 *Lifetime Membership Fee:*\n"
+        "💰 𝟓𝟎𝟎 𝐔𝐒𝐃𝐓 (𝐃𝐢𝐬𝐜𝐨𝐮𝐧𝐭𝐞𝐝 𝐏𝐫𝐢𝐜𝐞) — 𝐎𝐧𝐥𝐲 𝟐 𝐒𝐥𝐨𝐭𝐬 𝐋𝐞𝐟𝐭!\n"
+        "_🪙 Original Price: 1000 USDT (Lifetime)_\n\n"
+        "_🔥 Benefits:_\n"
+        "🚀 Early access to coins before they pump\n"
+        "📊 Buy & Sell targets guidance\n"
+        "📈 2–5 Daily Signals\n"
+        "🤖 Auto Trading by Bot\n"
+        "💎 Premium Channel Only:\n"
+        "\u2003🚀 1–3 Special Signals Daily (coins that pump within 24 h)\n\n"
+        "💳 𝟏-𝐌𝐨𝐧𝐭𝐡 𝐏𝐫𝐞𝐦𝐢𝐮𝐦: 𝟓𝟎 𝐔𝐒𝐃𝐓\n\n"
+    )
+    text = (
+        f"{benefits_text}"
+        f"💰 To access, pay USDT (BEP20) to this address:\n"
+        f"`{bot.BNB_ADDRESS}`\n\n"
+        f"After payment submit TXID type: `/pay <TXID>`\n\n"
+        f"🔗 Your referral link:\n{referral_link}"
+    )
+    return text, _legacy_main_menu()
+
+
+def _cached_start_render(username, user_id):
+    return bot.START_TEXT_PREFIX + bot.referral_link(username, user_id), bot.MAIN_MENU
+
+
+def bench_render(args):
+    """/start reply rendering: per-call build vs the precompiled render cache."""
+    assert _legacy_start_render("testbot", 1)[0] == _cached_start_render("testbot", 1)[0]
+    for name, fn in (("per-call build", _legacy_start_render), ("render cache", _cached_start_render)):
+        t0 = time.perf_counter()
+        for i in range(args.iterations):
+            fn("testbot", 1_000_000_000 + i)
+        per_call = (time.perf_counter() - t0) / args.iterations
+
+        # objects each render leaves behind (what a reply keeps alive until sent)
+        keep = []
+        before = sys.getallocatedblocks()
+        for i in range(1000):
+            keep.append(fn("testbot", 1_000_000_000 + i))
+        blocks = (sys.getallocatedblocks() - before) / 1000
+        print(f"{name:15}: {per_call * 1e6:8.2f} us/update  {blocks:6.1f} allocated blocks/update")
+
+
+def bench_memory(args):
+    """Resident size of the users dict: plain dicts vs UserRecord."""
+    text = bot.json.dumps(make_population(args.users, invest_fraction=args.invest_fraction))
+
+    tracemalloc.start()
+    as_dicts = bot.json.loads(text)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del as_dicts
+
+    tracemalloc.start()
+    as_records = {uid: bot.UserRecord.from_dict(d) for uid, d in bot.json.loads(text).items()}
+    record_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert all(as_records[uid].to_dict() == d for uid, d in bot.json.loads(text).items())
+
+    print(f"users={args.users}")
+    print(f"dict records : {dict_bytes / args.users:8.0f} bytes/user")
+    print(f"UserRecord   : {record_bytes / args.users:8.0f} bytes/user  (x{dict_bytes / record_bytes:.1f} smaller)")
+
+
+_FIRST_UPDATE = """
+import sys, time, asyncio
+from types import SimpleNamespace
+t0 = float(sys.argv[1])
+import main
+
+async def noop(*args, **kwargs):
+    pass
+
+query = SimpleNamespace(from_user=SimpleNamespace(id=int(sys.argv[2])), data="menu:balance",
+                        answer=noop, edit_message_text=noop)
+asyncio.run(main.menu_handler(SimpleNamespace(callback_query=query), SimpleNamespace(bot=None)))
+print(time.time() - t0)
+"""
+
+
+def bench_startup(args):
+    """Process start to first handled update (a balance view): JSON vs binary snapshot."""
+    population = make_population(args.users, invest_fraction=args.invest_fraction)
+    data_file = os.path.join(_TMP, "startup.json")
+    bot.write_json_atomic(data_file, population)
+    records = {uid: bot.UserRecord.from_dict(u) for uid, u in population.items()}
+    del population
+    print(f"users={args.users}  json={os.path.getsize(data_file) / 1e6:.1f} MB")
+
+    runs = [("json", {"BINARY_SNAPSHOT": "0"})]
+    for compress in ("1", "0"):
+        snap = os.path.join(_TMP, f"startup-{compress}.snap")
+        bot.write_snapshot(snap, records, compress == "1")
+        name = "snapshot zlib" if compress == "1" else "snapshot mmap"
+        print(f"{name}: {os.path.getsize(snap) / 1e6:.1f} MB")
+        runs.append((name, {"SNAPSHOT_FILE": snap, "SNAPSHOT_COMPRESS": compress}))
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    first_uid = next(iter(records))
+    baseline = None
+    for name, extra in runs:
+        env = dict(os.environ, DATA_FILE=data_file, STORAGE_MODE="json", **extra)
+        times = []
+        for _ in range(args.repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", _FIRST_UPDATE, repr(time.time()), first_uid],
+                cwd=here, env=env, capture_output=True, text=True, check=True,
+            )
+            times.append(float(out.stdout.split()[-1]))
+        best = min(times)
+        baseline = baseline or best
+        print(f"{name:14}: {best:6.2f} s to first update  (x{baseline / best:.1f})")
+
+
+class FakeBot:
+    """Bot API stand-in: every call takes `latency` seconds."""
+
+    username = "benchbot"
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def call(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+
+    send_message = call
+
+
+def _update(fake, uid, text=None, data=None):
+    user = SimpleNamespace(id=uid, full_name=f"user {uid}")
+    message = SimpleNamespace(reply_text=fake.call, edit_text=fake.call, reply_markup=None)
+    query = data and SimpleNamespace(from_user=user, data=data, message=message,
+                                     answer=fake.call, edit_message_text=fake.call)
+    update = SimpleNamespace(effective_user=user, effective_chat=SimpleNamespace(id=uid),
+                             message=None if query else message, callback_query=query)
+    context = SimpleNamespace(bot=fake, args=text.split()[1:] if text else [])
+    return update, context
+
+
+def _burst_phases(fake, n):
+    """
+    /start (every other user referred by an earlier one), then /pay and a
+    balance view, then admin confirmations that credit the referrers.
+    The final state doesn't depend on the order updates finish in.
+    """
+    uids = [2_000_000_000 + i for i in range(n)]
+    starts = [(bot.start, _update(fake, uid, f"/start {uids[i // 2]}" if i % 2 else "/start"))
+              for i, uid in enumerate(uids)]
+    pays = []
+    for uid in uids:
+        pays.append((bot.pay, _update(fake, uid, f"/pay tx{uid}")))
+        pays.append((bot.menu_handler, _update(fake, uid, data="menu:balance")))
+    confirms = [(bot.callback_query_handler, _update(fake, bot.ADMIN_ID, data=f"confirm_pay:{uid}")) for uid in uids]
+    return [starts, pays, confirms]
+
+
+async def _dispatch(phase, limit):
+    """Sequential (limit 0) or concurrent handling, as python-telegram-bot does it."""
+    if not limit:
+        for handler, (update, context) in phase:
+            await handler(update, context)
+        return
+    sem = asyncio.Semaphore(limit)
+
+    async def run(handler, update, context):
+        async with sem:
+            await handler(update, context)
+
+    await asyncio.gather(*(run(h, u, c) for h, (u, c) in phase))
+
+
+def bench_burst(args):
+    """Burst of user and admin updates with a slow Bot API: sequential vs concurrent_updates."""
+    results = {}
+    # saves go through the background writer, as they do in production
+    bot.persistence = bot.PersistenceWriter(bot.storage, bot.users, 0.5, 2.0)
+    for limit in (0, args.concurrency):
+        bot.users.clear()
+        phases = _burst_phases(FakeBot(args.latency), args.users)
+        updates = sum(len(p) for p in phases)
+        t0 = time.perf_counter()
+        for phase in phases:
+            asyncio.run(_dispatch(phase, limit))
+        elapsed = time.perf_counter() - t0
+        results[limit] = {uid: u.to_dict() for uid, u in bot.users.items()}
+        name = f"concurrent {limit}" if limit else "sequential"
+        print(f"{name:14}: {elapsed:7.2f} s  {updates / elapsed:8.0f} updates/s  "
+              f"({updates} updates, {args.latency * 1000:.0f} ms per API call)")
+    bot.shutdown_persistence()
+    assert results[0] == results[args.concurrency], "concurrent run left a different state"
+    print(f"final state identical; user locks still allocated: {len(bot.user_locks)}")
+
+
+def bench_leaderboard(args):
+    """Top-10 and rank lookups: sorting all users per request vs the incremental index."""
+    population = make_population(args.users, invest_fraction=0.5)
+    rnd = random.Random(2)
+    records = {uid: bot.UserRecord.from_dict(u) for uid, u in population.items()}
+    del population
+    for user in records.values():
+        user["earned_from_referrals"] = float(rnd.randrange(0, 2000, 5))
+    uids = list(records)
+    probes = [rnd.choice(uids) for _ in range(args.queries)]
+    board = bot.Leaderboard("referrers", lambda u: u.get("earned_from_referrals", 0.0))
+
+    def sorted_view(uid):
+        ranked = sorted(((board.score(u), i) for i, u in records.items() if board.score(u) > 0), reverse=True)
+        top = ranked[:10]
+        score = board.score(records[uid])
+        return top, 1 + sum(1 for s, _ in ranked if s > score)
+
+    n = max(1, args.queries // 100)
+    t_sort, _ = timed(lambda: [sorted_view(uid) for uid in probes[:n]])
+    t_build, _ = timed(board.build, records)
+    t_index, _ = timed(lambda: [(board.top(10), board.rank(uid)) for uid in probes])
+
+    def bump():
+        for uid in probes:
+            records[uid]["earned_from_referrals"] += 5
+            board.update(uid, records[uid])
+    t_update, _ = timed(bump)
+    assert sorted_view(probes[0])[1] == board.rank(probes[0])
+    print(f"users={args.users} ranked={len(board)} sortedcontainers={bot.SortedList is not None}")
+    print(f"sort per request : {t_sort / n * 1e3:10.2f} ms/query")
+    print(f"index build      : {t_build * 1e3:10.2f} ms (once at startup)")
+    print(f"index top10+rank : {t_index / len(probes) * 1e6:10.2f} us/query")
+    print(f"index update     : {t_update / len(probes) * 1e6:10.2f} us/score change")
+
+
+QUERY_BENCH = (
+    ["pending:withdraw"],
+    ["paid=false", "has:txid"],
+    ["lock_until>=now", "lock_until<+7d"],
+    ["submitted_at>=-24h"],
+    ["balance>=490"],
+    ["paid=true", "invest_amount>=1000"],
+    ["balance<1"],
+)
+
+
+def bench_query(args):
+    """Admin /query filters: secondary indexes vs a full scan; results must match."""
+    rnd = random.Random(3)
+    now = datetime.utcnow()
+    records = {}
+    for uid, u in make_population(args.users, invest_fraction=0.5).items():
+        if rnd.random() < 0.3:
+            u["txid"] = f"0x{rnd.getrandbits(64):016x}"
+        if rnd.random() < 0.01:
+            u["pending_withdraw"] = {"wallet": "w", "amount": u["balance"],
+                                     "submitted_at": (now - timedelta(hours=rnd.uniform(0, 72))).isoformat()}
+        records[uid] = bot.UserRecord.from_dict(u)
+    bot.users = records
+    bot.query_index.invalidate()
+    t_build, _ = timed(bot.query_index.ensure)
+    print(f"users={args.users}  index build {t_build * 1000:.0f} ms (once, then kept current by save_data)")
+    for words in QUERY_BENCH:
+        terms, _ = bot.parse_query(words)
+        t_idx, (indexed, plan) = timed(bot.run_query, terms)
+        t_scan, (scanned, _) = timed(bot.run_query, terms, False)
+        assert indexed == scanned, words
+        print(f"{' '.join(words):34} {len(indexed):7} hits  indexed {t_idx * 1000:8.2f} ms  "
+              f"scan {t_scan * 1000:8.2f} ms  x{t_scan / t_idx:6.1f}  ({plan})")
+
+
+def bench_shards(args):
+    """Saving one user / everyone and loading: single users.json vs hash-sharded files."""
+    records = {uid: bot.UserRecord.from_dict(u) for uid, u in make_population(args.users).items()}
+    some = random.Random(5).sample(list(records), args.saves)
+    print(f"users={args.users}  (one-user save: best of {args.saves} different users)")
+
+    single = bot.JsonStorage(os.path.join(_TMP, "shards-single.json"))
+    t_full, _ = timed(single.save, records)
+    t_one = min(timed(single.save, records, [uid])[0] for uid in some[:3])
+    t_load, _ = timed(single.load)
+    print(f"{'single file':18} save one {t_one * 1000:9.1f} ms  save all {t_full:6.2f} s  load {t_load:6.2f} s")
+
+    for shards in (int(s) for s in args.shards.split(",")):
+        for workers in (1, args.workers):
+            directory = os.path.join(_TMP, f"shards-{shards}-{workers}")
+            store = bot.ShardedStorage(directory, shards, os.path.join(_TMP, "missing.json"), None, workers)
+            store.load()
+            t_full, _ = timed(store.save, records)
+            t_one = min(timed(store.save, records, [uid])[0] for uid in some)
+            reader = bot.ShardedStorage(directory, shards, os.path.join(_TMP, "missing.json"), None, workers)
+            t_load, loaded = timed(reader.load)
+            assert len(loaded) == len(records)
+            store.close()
+            reader.close()
+            print(f"{shards:4} shards x{workers:<2} thr save one {t_one * 1000:9.1f} ms  "
+                  f"save all {t_full:6.2f} s  load {t_load:6.2f} s")
+
+
+def bench_writer(args):
+    """Memory the background writer holds per backend, and the time to flush a burst of saves."""
+    records = {uid: bot.UserRecord.from_dict(u) for uid, u in make_population(args.users).items()}
+    some = random.Random(6).sample(list(records), args.saves)
+    print(f"users={args.users}  (flush of {args.saves} one-user saves)")
+    backends = {
+        "json": lambda d: bot.JsonStorage(os.path.join(d, "users.json")),
+        "journal": lambda d: bot.JournalStorage(os.path.join(d, "users.json"), os.path.join(d, "users.journal"),
+                                                args.users),
+        "sharded": lambda d: bot.ShardedStorage(os.path.join(d, "shards"), 64, os.path.join(d, "missing.json")),
+        "sqlite": lambda d: bot.SqliteStorage(os.path.join(d, "users.db")),
+    }
+    for name, make in backends.items():
+        directory = os.path.join(_TMP, f"writer-{name}")
+        os.makedirs(directory)
+        store = make(directory)
+        store.load()
+        store.save(records)
+        tracemalloc.start()
+        writer = bot.PersistenceWriter(store, records, 3600, 3600)
+        for uid in some:
+            writer.mark(records, [uid])
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()  # tracing would dominate the flush timing
+        t_flush, _ = timed(writer.flush)
+        writer.close()
+        store.close()
+        print(f"{name:8} writer holds {held / 2**20:8.1f} MiB ({held / args.users:6.0f} bytes/user)  "
+              f"flush {t_flush * 1000:8.1f} ms")
+
+
+def _measure(results, name, n_users, fn, calls=1, repeat=3, setup=None):
+    """Time fn() `repeat` times (setup() untimed before each) and record best/median seconds."""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t, _ = timed(fn)
+        times.append(t)
+    row = {
+        "name": name,
+        "users": n_users,
+        "calls": calls,
+        "best_s": min(times),
+        "median_s": statistics.median(times),
+        "per_call_us": min(times) / calls * 1e6,
+    }
+    results.append(row)
+    print(f"{name:28} {n_users:>9}  best {row['best_s'] * 1000:10.2f} ms  "
+          f"median {row['median_s'] * 1000:10.2f} ms  {row['per_call_us']:12.2f} us/call")
+    return row
+
+
+def _suite_size(n, args, results):
+    population = make_population(n, invest_fraction=0.3, pending_fraction=0.02, skew=0.5)
+    records = {uid: bot.UserRecord.from_dict(u) for uid, u in population.items()}
+    del population
+    install_population(records)
+    uids = list(records)
+    rnd = random.Random(4)
+    repeat = args.repeat
+
+    _measure(results, "save_data:full", n, bot.save_data, repeat=repeat)
+    one = rnd.choice(uids)
+    _measure(results, "save_data:one_user", n, lambda: bot.save_data(one), repeat=repeat)
+
+    if not os.path.exists(bot.DATA_FILE):  # sqlite/journal backends keep their own files
+        bot.write_json_atomic(bot.DATA_FILE, records)
+    _measure(results, "load_json_file", n, lambda: bot.load_json_file(bot.DATA_FILE, {}), repeat=repeat)
+
+    yesterday = (datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+    def stale_pairing():
+        for user in records.values():
+            user["pairing_day"] = yesterday
+
+    reset = bot.reset_pairing_if_needed
+    values = records.values()
+    _measure(results, "reset_pairing:rollover", n, lambda: [reset(u) for u in values],
+             calls=n, repeat=repeat, setup=stale_pairing)
+    _measure(results, "reset_pairing:same_day", n, lambda: [reset(u) for u in values], calls=n, repeat=repeat)
+
+    # the first call builds the column store; after that it is kept current
+    _measure(results, "distribute_daily_profit", n, bot.distribute_daily_profit, repeat=repeat)
+
+    k = min(n, args.bonus_calls)
+    referrers = [uid for uid in uids if records[uid]["referrals"]]
+    for kind in ("membership", "pairing"):
+        targets = [rnd.choice(referrers) for _ in range(k)]
+        _measure(results, f"add_referral_bonus:{kind}", n,
+                 lambda: [bot.add_referral_bonus(uid, kind, uid) for uid in targets], calls=k, repeat=repeat)
+    bot.ledger.write(bot.ledger.take()[0])
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_throttle(args):
+    """Per-update cost of the throttle check and the memory its LRU-bounded buckets settle at."""
+    bot.THROTTLE_BUCKETS["read"] = bot.BucketMap(bot.THROTTLE_READ_RATE, bot.THROTTLE_READ_BURST, args.max_users)
+    bot.THROTTLE_NOTICES = bot.BucketMap(1 / bot.THROTTLE_NOTICE_SECONDS, 1, args.max_users)
+
+    async def run(updates):
+        dropped = 0
+        for update in updates:
+            try:
+                await bot.throttle(update, None)
+            except bot.ApplicationHandlerStop:
+                dropped += 1
+        return dropped
+
+    def callback(uid):
+        async def answer(*a, **kw):
+            pass
+        query = SimpleNamespace(answer=answer)
+        return SimpleNamespace(effective_user=SimpleNamespace(id=uid), message=None, callback_query=query)
+
+    distinct = [callback(1_000_000_000 + i) for i in range(args.users)]
+    tracemalloc.start()
+    t, dropped = timed(asyncio.run, run(distinct))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{args.users} distinct users : {t / args.users * 1e6:6.2f} us/update  dropped={dropped}"
+          f"  buckets={len(bot.THROTTLE_BUCKETS['read'].buckets)}  {current / 2**20:.1f} MiB")
+
+    hammer = [callback(42)] * args.users
+    t, dropped = timed(asyncio.run, run(hammer))
+    print(f"one user x{args.users}  : {t / args.users * 1e6:6.2f} us/update  dropped={dropped}")
+
+
+def bench_suite(args):
+    """Hot-path microbenchmarks at several population sizes; JSON output for regression checks."""
+    results = []
+    for n in (int(x) for x in args.sizes.split(",")):
+        _suite_size(n, args, results)
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "numpy": getattr(bot.np, "__version__", None),
+        "storage": bot.STORAGE_MODE,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.json}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {(r["name"], r["users"]): r for r in json.load(f)["results"]}
+        regressions = 0
+        print(f"\nvs {args.compare} (tolerance x{args.tolerance}):")
+        for row in results:
+            old = baseline.get((row["name"], row["users"]))
+            if old is None:
+                continue
+            ratio = row["per_call_us"] / old["per_call_us"]
+            flag = "REGRESSION" if ratio > args.tolerance else ""
+            regressions += bool(flag)
+            print(f"{row['name']:28} {row['users']:>9}  x{ratio:6.2f}  {flag}")
+        if regressions:
+            sys.exit(f"{regressions} benchmark(s) slower than x{args.tolerance}")
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Local Bot API stand-in: answers getMe/setWebhook/deleteWebhook, serves
+    queued updates to long-polling getUpdates, and records when each
+    sendMessage arrives (keyed by chat id). Every request and response
+    is delayed by half of `rtt`, the round trip to the real Bot API.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rtt: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _FakeTelegramHandler)
+        self.rtt = rtt
+        self.cond = threading.Condition()
+        self.queue = []
+        self.replies = {}
+        self.webhook = None
+        self.polled = False
+        self.next_id = 1
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def make_update(self, chat_id: int, text: str = "/help"):
+        with self.cond:
+            update_id, self.next_id = self.next_id, self.next_id + 1
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user {chat_id}"}
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "from": user, "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }}
+
+    def enqueue(self, update):
+        with self.cond:
+            self.queue.append(update)
+            self.cond.notify_all()
+
+    def wait_replies(self, n: int, timeout: float):
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.replies) >= n, timeout)
+
+
+class _FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 1 << 16  # headers and body in one write (no Nagle / delayed-ACK stall)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        fake = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+        method = self.path.rsplit("/", 1)[-1]
+        time.sleep(fake.rtt / 2)  # request in flight
+        result = True
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "benchbot"}
+        elif method == "setWebhook":
+            fake.webhook = params
+        elif method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            with fake.cond:
+                fake.polled = True
+                fake.queue = [u for u in fake.queue if u["update_id"] >= offset]
+                fake.cond.wait_for(lambda: fake.queue, float(params.get("timeout") or 0))
+                result = list(fake.queue)
+        elif method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            with fake.cond:
+                fake.replies.setdefault(chat_id, time.perf_counter())
+                fake.cond.notify_all()
+            result = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                      "text": params.get("text", "")}
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        time.sleep(fake.rtt / 2)  # response in flight
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def _post_update(url, secret, update, delay=0.0):
+    time.sleep(delay)
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode(), method="POST",
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def _wait_until(predicate, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError("timed out waiting for the bot")
+        time.sleep(0.05)
+
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_webhook(args):
+    """/help update-to-reply latency against a fake Bot API: long polling vs webhook, plus a drain check."""
+    secret = "bench-secret"
+    port = _free_port()
+    webhook_url = f"http://127.0.0.1:{port}"
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+    for mode in ("polling", "webhook"):
+        fake = FakeTelegram(args.rtt)
+        env = dict(os.environ, BOT_TOKEN="123:bench", BOT_API_URL=fake.url, PERSIST_FLUSH_INTERVAL="0.5",
+                   DATA_FILE=os.path.join(_TMP, f"{mode}.json"), META_FILE=os.path.join(_TMP, f"{mode}-meta.json"))
+        if mode == "webhook":
+            env.update(WEBHOOK_URL=webhook_url, WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port),
+                       WEBHOOK_SECRET=secret)
+        proc = subprocess.Popen([sys.executable, main_py], cwd=_TMP, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if mode == "webhook":
+                _wait_until(lambda: fake.webhook is not None)
+                url = fake.webhook["url"]
+                with urllib.request.urlopen(webhook_url + "/healthz", timeout=5) as response:
+                    health = json.loads(response.read())
+                assert response.status == 200 and health["status"] == "ok", health
+                assert _post_update(url, "wrong", fake.make_update(1)) == 403
+                pool = ThreadPoolExecutor(32)
+                send = lambda u: pool.submit(_post_update, url, secret, u, args.rtt / 2)  # noqa: E731
+            else:
+                _wait_until(lambda: fake.polled)
+                send = fake.enqueue
+
+            sent = {}
+            interval = 1.0 / args.rate
+            for i in range(args.updates):
+                chat_id = 3_000_000_000 + i
+                update = fake.make_update(chat_id)
+                sent[chat_id] = time.perf_counter()
+                send(update)
+                time.sleep(interval)
+            if not fake.wait_replies(args.updates, 30):
+                raise RuntimeError(f"{mode}: only {len(fake.replies)}/{args.updates} replies")
+            latencies = sorted((fake.replies[c] - t) * 1000 for c, t in sent.items())
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"{mode:8}: median {statistics.median(latencies):6.1f} ms  p99 {p99:6.1f} ms  "
+                  f"({args.updates} updates at {args.rate:.0f}/s, {args.rtt * 1000:.0f} ms RTT)")
+
+            if mode == "webhook":
+                # graceful drain: stop mid-burst, every acknowledged update must still be answered
+                burst = [fake.make_update(4_000_000_000 + i) for i in range(args.drain_burst)]
+                futures = [send(u) for u in burst]
+                wait(futures, return_when=FIRST_COMPLETED)
+                proc.send_signal(signal.SIGTERM)
+                statuses = [f.result() for f in futures]
+                accepted = {u["message"]["chat"]["id"] for u, st in zip(burst, statuses) if st == 200}
+                code = proc.wait(30)
+                answered = {c for c in fake.replies if c >= 4_000_000_000}
+                assert accepted <= answered, f"{len(accepted - answered)} acknowledged updates were dropped"
+                print(f"drain   : SIGTERM mid-burst, {len(accepted)}/{len(burst)} acknowledged, "
+                      f"{len(answered)} answered, exit code {code}")
+                pool.shutdown()
+        finally:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+                proc.wait(30)
+            fake.shutdown()
+
+
+def bench_workers(args):
+    """
+    Update throughput with CPU-bound handlers (/start with inline shard
+    saves): one process vs WORKERS processes, against the fake Bot API.
+    """
+    shards = args.shards
+    seed_dir = os.path.join(_TMP, "workers-seed")
+    records = {uid: bot.UserRecord.from_dict(u) for uid, u in make_population(args.users).items()}
+    store = bot.ShardedStorage(seed_dir, shards, os.path.join(_TMP, "missing.json"))
+    store.load()
+    store.save(records)
+    store.close()
+    del records
+    bot.write_json_atomic(os.path.join(_TMP, "workers-meta.json"), {"downline_built": True})
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    print(f"users={args.users}  shards={shards}  updates={args.updates}  cpus={os.cpu_count()}")
+
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        run_dir = os.path.join(_TMP, f"workers-{workers}")
+        shutil.copytree(seed_dir, os.path.join(run_dir, "users.shards"))
+        shutil.copy(os.path.join(_TMP, "workers-meta.json"), os.path.join(run_dir, "meta.json"))
+        fake = FakeTelegram()
+        env = dict(os.environ, BOT_TOKEN="123:bench", BOT_API_URL=fake.url, STORAGE_MODE="sharded",
+                   SHARD_COUNT=str(shards), WORKERS=str(workers), PERSIST_FLUSH_INTERVAL="0",
+                   DATA_FILE=os.path.join(run_dir, "users.json"), META_FILE=os.path.join(run_dir, "meta.json"),
+                   SHARD_DIR=os.path.join(run_dir, "users.shards"))
+        for name in ("LEDGER_FILE", "DEAD_LETTER_FILE", "BROADCAST_FILE", "JOURNAL_FILE", "SQLITE_FILE",
+                     "SNAPSHOT_FILE", "PROFILE_DIR"):
+            env.pop(name, None)  # each run keeps its own, under run_dir
+        proc = subprocess.Popen([sys.executable, main_py], cwd=run_dir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_until(lambda: fake.polled, 120)
+            # one /help per worker, so every worker has loaded its shards before the clock starts
+            warm = {}
+            for uid in range(5_000_000_000, 5_000_100_000):
+                warm.setdefault(bot.shard_of(str(uid), shards) % max(workers, 1), uid)
+                if len(warm) == max(workers, 1):
+                    break
+            for uid in warm.values():
+                fake.enqueue(fake.make_update(uid))
+            if not fake.wait_replies(len(warm), 300):
+                raise RuntimeError(f"workers={workers}: not ready")
+            start = time.perf_counter()
+            for i in range(args.updates):
+                fake.enqueue(fake.make_update(6_000_000_000 + i, "/start"))
+            if not fake.wait_replies(len(warm) + args.updates, 600):
+                raise RuntimeError(f"workers={workers}: only {len(fake.replies) - len(warm)}/{args.updates} replies")
+            elapsed = time.perf_counter() - start
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(120)
+            fake.shutdown()
+        rate = args.updates / elapsed
+        baseline = baseline or rate
+        label = f"{workers} workers" if workers else "single process"
+        print(f"{label:15}: {rate:7.1f} updates/s  x{rate / baseline:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("distribute", help="daily profit distribution: loop vs vectorized")
+    p.add_argument("--users", type=int, default=1_000_000)
+    p.add_argument("--invest-fraction", type=float, default=1.0)
+    p.set_defaults(func=bench_distribute)
+
+    p = sub.add_parser("accrual", help="daily profit: manual distribute vs lazy accrual on balance views")
+    p.add_argument("--users", type=int, default=200_000)
+    p.add_argument("--invest-fraction", type=float, default=0.5)
+    p.add_argument("--views", type=int, default=2_000)
+    p.add_argument("--days", type=int, default=7)
+    p.set_defaults(func=bench_accrual)
+
+    p = sub.add_parser("render", help="menu/text rendering: per-call build vs render cache")
+    p.add_argument("--iterations", type=int, default=100_000)
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("memory", help="memory per user: dicts vs UserRecord")
+    p.add_argument("--users", type=int, default=200_000)
+    p.add_argument("--invest-fraction", type=float, default=0.5)
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("startup", help="time to first update: JSON vs binary snapshot")
+    p.add_argument("--users", type=int, default=200_000)
+    p.add_argument("--invest-fraction", type=float, default=0.5)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("burst", help="update throughput: sequential vs concurrent_updates")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--concurrency", type=int, default=bot.CONCURRENT_UPDATES or 64)
+    p.set_defaults(func=bench_burst)
+
+    p = sub.add_parser("webhook", help="update-to-reply latency: polling vs webhook (fake Bot API)")
+    p.add_argument("--updates", type=int, default=500)
+    p.add_argument("--rate", type=float, default=50.0)
+    p.add_argument("--rtt", type=float, default=0.1, help="simulated round trip to the Bot API, seconds")
+    p.add_argument("--drain-burst", type=int, default=100)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("workers", help="CPU-bound update throughput: one process vs WORKERS processes")
+    p.add_argument("--users", type=int, default=100_000)
+    p.add_argument("--shards", type=int, default=64)
+    p.add_argument("--updates", type=int, default=200)
+    p.add_argument("--workers", default="0,1,2,4", help="comma-separated worker counts (0 = single process)")
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("leaderboard", help="top-K / rank: sort per request vs incremental index")
+    p.add_argument("--users", type=int, default=1_000_000)
+    p.add_argument("--queries", type=int, default=10_000)
+    p.set_defaults(func=bench_leaderboard)
+
+    p = sub.add_parser("query", help="admin query: secondary indexes vs full scan")
+    p.add_argument("--users", type=int, default=200_000)
+    p.set_defaults(func=bench_query)
+
+    p = sub.add_parser("shards", help="user saves and load: single JSON file vs hash-sharded files")
+    p.add_argument("--users", type=int, default=200_000)
+    p.add_argument("--shards", default="16,64,256", help="comma-separated shard counts")
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--saves", type=int, default=20)
+    p.set_defaults(func=bench_shards)
+
+    p = sub.add_parser("writer", help="background writer: memory held per backend and flush time")
+    p.add_argument("--users", type=int, default=200_000)
+    p.add_argument("--saves", type=int, default=100)
+    p.set_defaults(func=bench_writer)
+
+    p = sub.add_parser("throttle", help="per-user throttling: check cost and bounded bucket memory")
+    p.add_argument("--users", type=int, default=1_000_000)
+    p.add_argument("--max-users", type=int, default=bot.THROTTLE_MAX_USERS)
+    p.set_defaults(func=bench_throttle)
+
+    p = sub.add_parser("suite", help="hot-path timings at several sizes, JSON output for regression checks")
+    p.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated population sizes")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--bonus-calls", type=int, default=10_000)
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--compare", help="earlier --json results; exit 1 if anything got slower than --tolerance")
+    p.add_argument("--tolerance", type=float, default=1.25)
+    p.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
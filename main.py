@@ -1,34 +1,82 @@
 #!/usr/bin/env python3
 # referral_bot_complete.py
 """
-Telegram referral + investment bot (manual /distribute; APScheduler removed).
+Telegram referral + investment bot (manual /distribute or lazy accrual; APScheduler removed).
 
 Features:
 - Persistent inline Main Menu for users (Balance / Invest / Referral / FAQ / Withdraw / Help)
 - Admin-only commands remain as slash commands (not shown to users in menus)
 - Payment, invest, withdraw flows with admin confirm/reject inline buttons
-- JSON storage: users.json, meta.json
+- JSON storage: users.json, meta.json (optional journal, SQLite or hash-sharded backends via STORAGE_MODE)
+- Optional multi-process mode (WORKERS): a front process routes updates by user ID to worker processes
+- Long polling by default, or webhook mode with a health endpoint when WEBHOOK_URL is set
+- Prometheus text metrics on a local port when METRICS_PORT is set
 - Admin ID: 8150987682 (as provided)
 - BEP20 deposit address and premium group link included
 """
 
 import os
+import sys
 import json
+import mmap
+import zlib
+import bisect
+import operator
+import re
+import marshal
+import cProfile
+import pstats
+import io
+import asyncio
+import time
+import hmac
+import atexit
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Any
+import sqlite3
+import signal
+import threading
+import functools
+import multiprocessing
+import glob
+import weakref
+from collections import Counter as Tally, OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.reduction import ForkingPickler
+from contextlib import AsyncExitStack, asynccontextmanager
+from array import array
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional: profit distribution falls back to a per-user loop
+    np = None
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:  # optional: leaderboards fall back to bisect on a plain list
+    SortedList = None
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     CallbackQueryHandler,
+    ExtBot,
+    TypeHandler,
     filters,
 )
 
@@ -43,12 +91,109 @@ logger = logging.getLogger(__name__)
 # -----------------------
 # Configuration / Constants
 # -----------------------
-DATA_FILE = "users.json"
-META_FILE = "meta.json"
+DATA_FILE = os.getenv("DATA_FILE", "users.json")
+META_FILE = os.getenv("META_FILE", "meta.json")
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "users.journal")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "users.db")
+LEDGER_FILE = os.getenv("LEDGER_FILE", "ledger.jsonl")  # append-only record of balance changes
+
+# Storage mode: "json" rewrites DATA_FILE on every save, "journal" appends
+# per-user records to JOURNAL_FILE and only rewrites DATA_FILE on compaction,
+# "sqlite" writes single rows to SQLITE_FILE, "sharded" splits users over
+# SHARD_COUNT JSON files in SHARD_DIR and rewrites only the changed ones.
+# Every mode is persistence only: all users are loaded into `users` at
+# startup and handlers work on that dict, so memory grows with user count.
+STORAGE_MODE = os.getenv("STORAGE_MODE", "json")
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "5000"))  # records between snapshots
+SHARD_DIR = os.getenv("SHARD_DIR", os.path.splitext(DATA_FILE)[0] + ".shards")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "64"))  # changing it reshards on the next start
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "8"))  # threads reading / writing shard files
+
+# Binary snapshot written next to DATA_FILE (json/journal modes) and loaded
+# instead of it when at least as new. SNAPSHOT_COMPRESS=0 stores it raw and
+# memory-maps it on load.
+BINARY_SNAPSHOT = os.getenv("BINARY_SNAPSHOT", "1") != "0"
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", os.path.splitext(DATA_FILE)[0] + ".snap")
+SNAPSHOT_COMPRESS = os.getenv("SNAPSHOT_COMPRESS", "1") != "0"
+
+# Background writer: coalesce saves for PERSIST_FLUSH_INTERVAL seconds of quiet,
+# but never hold a change longer than PERSIST_MAX_LATENCY. 0 = write inline.
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.5"))
+PERSIST_MAX_LATENCY = float(os.getenv("PERSIST_MAX_LATENCY", "2.0"))
+
+# Updates handled at once (python-telegram-bot concurrent_updates); 0 = one at a time.
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# Webhook mode (instead of polling) when WEBHOOK_URL, the public base URL, is set.
+# Telegram POSTs to WEBHOOK_URL + WEBHOOK_PATH; GET HEALTH_PATH reports status.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+HEALTH_PATH = os.getenv("HEALTH_PATH", "/healthz")
+
+# Prometheus text-format metrics served from a background thread; 0 = off.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+
+# Opt-in profiling of update dispatch; captures land in PROFILE_DIR (newest PROFILE_KEEP kept).
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))  # sampled stacks of updates slower than this; 0 = off
+PROFILE_EVERY = int(os.getenv("PROFILE_EVERY", "0"))  # cProfile one update in N; 0 = off
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # stack sampling period
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+
+# Outgoing message limits (Telegram: ~30 msg/s overall, ~1 msg/s per chat)
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25"))
+PER_CHAT_SEND_RATE = float(os.getenv("PER_CHAT_SEND_RATE", "1"))
+
+# Per-user throttling of incoming updates (tokens/second, burst); the admin is exempt.
+# Write commands (/start, /pay, /invest, /withdraw) save and may notify the admin, so
+# they get a far smaller budget than menu buttons and read-only commands.
+THROTTLE_READ_RATE = float(os.getenv("THROTTLE_READ_RATE", "1"))
+THROTTLE_READ_BURST = float(os.getenv("THROTTLE_READ_BURST", "5"))
+THROTTLE_WRITE_RATE = float(os.getenv("THROTTLE_WRITE_RATE", "0.1"))
+THROTTLE_WRITE_BURST = float(os.getenv("THROTTLE_WRITE_BURST", "3"))
+THROTTLE_NOTICE_SECONDS = float(os.getenv("THROTTLE_NOTICE_SECONDS", "10"))  # at most one "slow down" per user
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+
+# Outbound queue for admin/user notifications; undeliverable ones go to DEAD_LETTER_FILE
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "10"))
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "dead_letters.jsonl")
+
+BROADCAST_FILE = os.getenv("BROADCAST_FILE", "broadcast.json")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_ATTEMPTS = 4
+BROADCAST_SAVE_EVERY = 2.0  # seconds between progress checkpoints
+
+# Multi-process mode: WORKERS > 0 runs a front process that receives updates
+# and routes each one by user ID to one of WORKERS worker processes, each
+# owning the users of its shards (needs STORAGE_MODE=sharded). The front sets
+# WORKER_INDEX for its workers; each keeps its own ledger, dead letters,
+# broadcast state and profiles and gets an equal part of the global send rate.
+WORKERS = int(os.getenv("WORKERS", "0"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "-1"))
+SHARD_CALL_TIMEOUT = float(os.getenv("SHARD_CALL_TIMEOUT", "10"))  # seconds to wait on another worker
+IS_FRONT = WORKERS > 0 and WORKER_INDEX < 0
+if WORKER_INDEX >= 0:
+    LEDGER_FILE, DEAD_LETTER_FILE, BROADCAST_FILE = (
+        f"{base}.w{WORKER_INDEX}of{WORKERS}{ext}"
+        for base, ext in map(os.path.splitext, (LEDGER_FILE, DEAD_LETTER_FILE, BROADCAST_FILE))
+    )
+    PROFILE_DIR = os.path.join(PROFILE_DIR, f"worker{WORKER_INDEX}")
+    GLOBAL_SEND_RATE /= WORKERS
+    if METRICS_PORT:
+        METRICS_PORT += 1 + WORKER_INDEX  # the front keeps METRICS_PORT
 
 # Admin ID provided by user
 ADMIN_ID = int(os.getenv("ADMIN_ID", "8150987682"))
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # required
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")  # e.g. a local Bot API server
 BNB_ADDRESS = os.getenv(
     "BNB_ADDRESS", "0xC6219FFBA27247937A63963E4779e33F7930d497"
 )  # BEP20 wallet address
@@ -62,463 +207,3107 @@ MIN_WITHDRAW = 20
 INVEST_MIN = 50
 INVEST_LOCK_DAYS = 30
 DAILY_PROFIT_RATE = 0.01  # 1% daily
+# "manual": each admin /distribute credits one day of profit. "lazy": profit
+# accrues per whole day up to lock_until and is credited whenever the user's
+# balance is read (balance view, /stats, withdraw); /distribute catches up everyone.
+ACCRUAL_MODE = os.getenv("ACCRUAL_MODE", "manual")
 
 # -----------------------
-# Storage load (safe)
+# Metrics
 # -----------------------
-def load_json_file(path: str, default):
-    try:
-        if os.path.exists(path):
-            with open(path, "r") as f:
-                return json.load(f)
-    except Exception:
-        logger.exception("Failed to load %s - using default", path)
-    return default
+# Minimal Prometheus text-format metrics. Handlers, the persistence thread
+# and the Bot API client record into them; the scrape thread renders them,
+# hence the lock per metric. Callback-backed metrics read a live value at
+# scrape time and must only do O(1) reads (len() and attribute access).
+class Metric:
+    kind = "untyped"
 
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), fn=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.fn = fn  # () -> value, or {label values: value} for labelled metrics
+        self.values: Dict[tuple, Any] = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
 
-# initialize users and meta
-users: Dict[str, Dict[str, Any]] = load_json_file(DATA_FILE, {})
-meta: Dict[str, Any] = load_json_file(META_FILE, {"last_reset": None})
+    @staticmethod
+    def _labels(names, values, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in zip(names, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
 
-# Ensure existing users have expected fields
-for u in users.values():
-    u.setdefault("direct_bonus_total", 0.0)
-    u.setdefault("pairing_bonus_total", 0.0)
-    u.setdefault("left", 0)
-    u.setdefault("right", 0)
-    u.setdefault("earned_from_referrals", 0.0)
-    u.setdefault("balance", 0.0)
-    u.setdefault("referrals", [])
-    u.setdefault("paid", False)
+    def samples(self):
+        if self.fn is not None:
+            value = self.fn()
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        return [(self.name + self._labels(self.labels, key), value) for key, value in items]
 
-# -----------------------
-# Helper functions
-# -----------------------
-def save_data():
-    try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(users, f, indent=2, default=str)
-    except Exception:
-        logger.exception("Failed to save users data.")
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name} {value}" for name, value in self.samples()]
+        return "\n".join(lines)
 
 
-def save_meta():
-    try:
-        with open(META_FILE, "w") as f:
-            json.dump(meta, f, indent=2, default=str)
-    except Exception:
-        logger.exception("Failed to save meta data.")
+class Counter(Metric):
+    kind = "counter"
 
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
 
-def reset_pairing_if_needed():
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    if meta.get("last_reset") != today:
-        for u in users.values():
-            u["left"] = 0
-            u["right"] = 0
-        meta["last_reset"] = today
-        save_data()
-        save_meta()
-        logger.info("🌞 Daily pairing counts reset.")
 
+class Gauge(Metric):
+    kind = "gauge"
 
-def add_referral_bonus(referrer_id_str: str, bonus_type: str = "membership"):
-    """
-    Give referrer either direct or pairing bonus depending on context.
 
-    bonus_type:
-      - "membership": give direct bonus only
-      - "pairing": give pairing bonus only (respecting daily max and left/right)
-    """
-    ref = users.get(referrer_id_str)
-    if not ref:
-        return
+class Histogram(Metric):
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-    # initialize aggregator fields if missing
-    ref.setdefault("direct_bonus_total", 0.0)
-    ref.setdefault("pairing_bonus_total", 0.0)
-    ref.setdefault("earned_from_referrals", 0.0)
-    ref.setdefault("left", 0)
-    ref.setdefault("right", 0)
-    ref.setdefault("balance", 0.0)
+    def observe(self, value: float, *label_values):
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * len(self.BUCKETS), 0.0, 0]
+            i = bisect.bisect_left(self.BUCKETS, value)
+            if i < len(self.BUCKETS):
+                state[0][i] += 1
+            state[1] += value
+            state[2] += 1
 
-    if bonus_type == "membership":
-        # Direct referral bonus only
-        ref["balance"] = ref.get("balance", 0.0) + DIRECT_BONUS
-        ref["earned_from_referrals"] = ref.get("earned_from_referrals", 0.0) + DIRECT_BONUS
-        ref["direct_bonus_total"] = ref.get("direct_bonus_total", 0.0) + DIRECT_BONUS
-        logger.info("Direct bonus %s given to %s", DIRECT_BONUS, referrer_id_str)
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts), total, n) for key, (counts, total, n) in self.values.items()]
+        out = []
+        for key, counts, total, n in items:
+            cumulative = 0
+            for bound, count in zip((*self.BUCKETS, "+Inf"), (*counts, None)):
+                cumulative = n if count is None else cumulative + count
+                le = 'le="%s"' % bound
+                out.append((self.name + "_bucket" + self._labels(self.labels, key, le), cumulative))
+            out.append((self.name + "_sum" + self._labels(self.labels, key), total))
+            out.append((self.name + "_count" + self._labels(self.labels, key), n))
+        return out
 
-    elif bonus_type == "pairing":
-        # Pairing bonus only: alternate left/right to balance pairs
-        side = "left" if ref.get("left", 0) <= ref.get("right", 0) else "right"
-        if ref.get(side, 0) < MAX_PAIRS_PER_DAY:
-            ref[side] = ref.get(side, 0) + 1
-            ref["balance"] += PAIRING_BONUS
-            ref["earned_from_referrals"] = ref.get("earned_from_referrals", 0.0) + PAIRING_BONUS
-            ref["pairing_bonus_total"] = ref.get("pairing_bonus_total", 0.0) + PAIRING_BONUS
-            logger.info("Pairing bonus %s given to %s on side %s", PAIRING_BONUS, referrer_id_str, side)
-        else:
-            logger.info("Pairing bonus skipped for %s: daily limit reached")
 
+METRICS: List[Metric] = []
+HANDLER_SECONDS = Histogram("referral_bot_handler_seconds", "Handler latency.", ("handler",))
+HANDLER_UPDATES = Counter("referral_bot_handler_updates_total", "Updates handled.", ("handler",))
+HANDLER_ERRORS = Counter("referral_bot_handler_errors_total", "Handlers that raised.", ("handler",))
+BOT_API_SECONDS = Histogram("referral_bot_api_seconds", "Bot API request latency.", ("method",))
+BOT_API_ERRORS = Counter("referral_bot_api_errors_total", "Bot API requests that failed.", ("method",))
+SAVE_SECONDS = Histogram("referral_bot_save_data_seconds", "Time save_data() takes in the caller.")
+STORAGE_WRITE_SECONDS = Histogram("referral_bot_storage_write_seconds", "Time the storage backend takes to write.")
+Counter("referral_bot_storage_bytes_written_total", "Bytes the storage backend wrote.",
+        fn=lambda: storage.bytes_written)
+THROTTLED = Counter("referral_bot_throttled_total", "Updates dropped by per-user throttling.", ("budget",))
+OUTBOX_DEAD_LETTERS = Counter("referral_bot_outbox_dead_letters_total", "Messages given up on.")
+Gauge("referral_bot_outbox_queued", "Messages waiting in the outbound queue.", fn=lambda: outbox.queue.qsize())
+Gauge("referral_bot_users", "Registered users.", fn=lambda: len(users))
+Gauge("referral_bot_active_investors", "Users with an active investment.",
+      fn=lambda: len(LEADERBOARDS["investors"]))
+Gauge("referral_bot_pending_items", "Requests awaiting the admin.", ("kind",),
+      fn=lambda: {(kind,): len(ids) for kind, ids in pending_items.ids.items()})
 
-def distribute_daily_profit():
-    """
-    Add DAILY_PROFIT_RATE * invested_amount to each qualifying investor's balance.
-    Returns number of investors credited.
-    """
-    now = datetime.utcnow()
-    distributed_count = 0
-    for uid, user in users.items():
-        invest = user.get("investment")
-        if invest and invest.get("active") and invest.get("start_date"):
-            try:
-                start = datetime.fromisoformat(invest["start_date"])
-            except Exception:
-                # legacy or invalid format — skip
-                logger.warning("Invalid start_date for user %s", uid)
-                continue
-            locked_until = start + timedelta(days=INVEST_LOCK_DAYS)
-            if now <= locked_until:
-                profit = invest["amount"] * DAILY_PROFIT_RATE
-                user["balance"] = user.get("balance", 0.0) + profit
-                distributed_count += 1
-    save_data()
-    logger.info("💹 Distributed daily profit to %d investors.", distributed_count)
-    return distributed_count
 
+class PendingItems:
+    """IDs of users with a request awaiting the admin, per kind; refreshed by save_data()."""
 
-# -----------------------
-# Menu utilities (NO admin buttons)
-# -----------------------
-def build_main_menu():
-    """
-    Returns InlineKeyboardMarkup for the main menu. No admin buttons included.
-    """
-    keyboard = [
-        [InlineKeyboardButton("💰 Balance", callback_data="menu:balance"),
-         InlineKeyboardButton("💸 Invest", callback_data="menu:invest")],
-        [InlineKeyboardButton("👥 Referrals", callback_data="menu:referral"),
-         InlineKeyboardButton("💎 FAQ", callback_data="menu:faq")],
-        [InlineKeyboardButton("🏦 Withdraw", callback_data="menu:withdraw"),
-         InlineKeyboardButton("❓ Help", callback_data="menu:help")],
-        [InlineKeyboardButton("🌟 Join Premium", callback_data="join_premium")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    KINDS = {
+        "pay": lambda u: bool(u.get("txid")) and not u.get("paid"),
+        "invest": lambda u: bool(u.get("pending_investment")),
+        "withdraw": lambda u: bool(u.get("pending_withdraw")),
+    }
 
+    def __init__(self):
+        self.ids: Dict[str, set] = {kind: set() for kind in self.KINDS}
 
-# -----------------------
-# Command Handlers
-# -----------------------
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    reset_pairing_if_needed()
-    user = update.effective_user
-    user_id = str(user.id)
-    # Register user if not exists
-    if user_id not in users:
-        users[user_id] = {
-            "referrer": None,
-            "balance": 0.0,
-            "earned_from_referrals": 0.0,
-            "left": 0,
-            "right": 0,
-            "referrals": [],
-            "paid": False,
-            "txid": None,
-            "pending_investment": None,
-            "investment": None,
-            "pending_withdraw": None,
-            "membership_referrer_rewarded": False,
-            "direct_bonus_total": 0.0,
-            "pairing_bonus_total": 0.0,
-        }
-        # If start param is given (referral), set if valid
-        if context.args:
-            ref = context.args[0]
-            if ref in users and ref != user_id:
-                users[user_id]["referrer"] = ref
-                users[ref].setdefault("referrals", []).append(user_id)
-        save_data()
-
-    referral_link = f"https://t.me/{context.bot.username}?start={user_id}"
-    benefits_text = (
-        "💼 𝙋𝙧𝙚𝙢𝙞𝙪𝙢 𝙑𝙄𝙋 𝙈𝙚𝙢𝙗𝙚𝙧𝙨𝙝𝙞𝙥\n\n"
-        "👑 *Lifetime Membership Fee:*\n"
-        "💰 𝟓𝟎𝟎 𝐔𝐒𝐃𝐓 (𝐃𝐢𝐬𝐜𝐨𝐮𝐧𝐭𝐞𝐝 𝐏𝐫𝐢𝐜𝐞) — 𝐎𝐧𝐥𝐲 𝟐 𝐒𝐥𝐨𝐭𝐬 𝐋𝐞𝐟𝐭!\n"
-        "_🪙 Original Price: 1000 USDT (Lifetime)_\n\n"
-        "_🔥 Benefits:_\n"
-        "🚀 Early access to coins before they pump\n"
-        "📊 Buy & Sell targets guidance\n"
-        "📈 2–5 Daily Signals\n"
-        "🤖 Auto Trading by Bot\n"
-        "💎 Premium Channel Only:\n"
-        " 🚀 1–3 Special Signals Daily (coins that pump within 24 h)\n\n"
-        "💳 𝟏-𝐌𝐨𝐧𝐭𝐡 𝐏𝐫𝐞𝐦𝐢𝐮𝐦: 𝟓𝟎 𝐔𝐒𝐃𝐓\n\n"
-    )
-    # BNB address shown in monospace
-    menu = build_main_menu()
-    await update.message.reply_text(
-        f"{benefits_text}"
-        f"💰 To access, pay USDT (BEP20) to this address:\n"
-        f"`{BNB_ADDRESS}`\n\n"
-        f"After payment submit TXID type: `/pay <TXID>`\n\n"
-        f"🔗 Your referral link:\n{referral_link}",
-        parse_mode="Markdown",
-        reply_markup=menu,
-    )
+    def build(self, data):
+        for kind, pending in self.KINDS.items():
+            self.ids[kind] = {uid for uid, u in data.items() if pending(u)}
 
+    def refresh(self, user_ids):
+        for uid in user_ids:
+            user = users.get(uid)
+            for kind, pending in self.KINDS.items():
+                if user is not None and pending(user):
+                    self.ids[kind].add(uid)
+                else:
+                    self.ids[kind].discard(uid)
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        "🤖 *Available Commands*\n\n"
-        "💬 General:\n"
-        "• /start - Register & get your referral link\n"
-        "• /faq - Learn how investing & referrals work\n"
-        "• /help - Show this menu\n"
-        "• /referral - Show your referral link\n\n"
-        "💰 Account & Earnings:\n"
-        "• /pay <TXID> - Submit membership payment\n"
-        "• /invest <amount> <TXID> - Submit investment (min 50 USDT)\n"
-        "• /balance - View your current balance & investment info\n"
-        "• /stats - View referrals, earnings, and status\n"
-        "• /withdraw <wallet> - Request withdrawal (min 20 USDT)\n\n"
-        "💸 Referral Bonuses:\n"
-        f"• Direct Bonus: {DIRECT_BONUS} USDT\n"
-        f"• Pairing Bonus: {PAIRING_BONUS} USDT (per pair, max {MAX_PAIRS_PER_DAY}/day)\n"
-    )
-    if update.message:
-        await update.message.reply_text(text, parse_mode="Markdown", reply_markup=build_main_menu())
-    else:
-        await context.bot.send_message(chat_id=update.effective_user.id, text=text, parse_mode="Markdown")
 
+pending_items = PendingItems()
 
-async def faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        "💡 *FAQ - Auto-Trading & Investments*\n\n"
-        f"• Minimum investment: *{INVEST_MIN} USDT*\n"
-        f"• Deposit to BEP20 address: `{BNB_ADDRESS}`\n"
-        f"• Direct bonus: *{DIRECT_BONUS} USDT*\n"
-        f"• Pairing bonus: *{PAIRING_BONUS} USDT*\n"
-        f"• Investment lock: *{INVEST_LOCK_DAYS} days*\n"
-        "• Daily profit: *1%* added to balance\n"
-        f"• Minimum withdraw: *{MIN_WITHDRAW} USDT*\n"
-    )
-    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=build_main_menu())
 
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    referral_link = f"https://t.me/{context.bot.username}?start={user_id}"
-
-    premium_text = (
-        "💼 𝙋𝙧𝙚𝙢𝙞𝙪𝙢 𝙑𝙄𝙋 𝙈𝙚𝙢𝙗𝙚𝙧𝙨𝙝𝙞𝙥\n\n"
-        "👑 Lifetime Membership Fee:\n"
-        "💰 𝟓𝟎𝟎 𝐔𝐒𝐃𝐓 (𝐃𝐢𝐬𝐜𝐨𝐮𝐧𝐭𝐞𝐝 𝐏𝐫𝐢𝐜𝐞) — 𝐎𝐧𝐥𝐲 𝟐 𝐒𝐥𝐨𝐭𝐬 𝐋𝐞𝐟𝐭!\n"
-        "🪙 Original Price: 1000 USDT (Lifetime)\n\n"
-        "🔥 Benefits:\n"
-        "🚀 Early access to coins before they pump\n"
-        "📊 Buy & Sell targets guidance\n"
-        "📈 2–5 Daily Signals\n"
-        "🤖 Auto Trading by Bot\n"
-        "💎 Premium Channel Only:\n"
-        " 🚀 1–3 Special Signals Daily (coins that pump within 24 h)\n\n"
-        "💳 𝟏-𝐌𝐨𝐧𝐭𝐡 𝐏𝐫𝐞𝐦𝐢𝐮𝐦: 𝟓𝟎 𝐔𝐒𝐃𝐓\n\n"
-        "💰 To access, pay USDT (BEP20) to this address:\n"
-        "`0xC6219FFBA27247937A63963E4779e33F7930d497`\n\n"
-        "After payment submit TXID type: `/pay <TXID>`\n\n"
-        f"🔗 Your referral link:\n{referral_link}"
-    )
 
-    # Use the same inline keyboard layout already shown in the menu
-    await query.message.edit_text(
-        text=premium_text,
-        parse_mode="Markdown",
-        reply_markup=query.message.reply_markup  # reuse same buttons layout
-    )
-    
-    
-async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    link = f"https://t.me/{context.bot.username}?start={user_id}"
-    await update.message.reply_text(f"🔗 Your referral link:\n{link}", reply_markup=build_main_menu())
+def timed_handler(callback):
+    """Wrap a handler callback to record its latency, update count and errors under its name."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, name)
+            HANDLER_UPDATES.inc(name)
+
+    return wrapper
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and failures per Bot API method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            BOT_API_ERRORS.inc(api_method)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - t0, api_method)
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method)
+        return code, payload
 
 
 # -----------------------
-# Payment flow (user submits)
+# User records
 # -----------------------
-async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    if not context.args:
-        await update.message.reply_text(
-            "Usage: /pay <TXID>\n\n"
-            f"Send *{MEMBERSHIP_FEE} USDT* (BEP20) to:\n`{BNB_ADDRESS}`\nThen submit: `/pay <TXID>`",
-            parse_mode="Markdown",
-            reply_markup=build_main_menu(),
-        )
-        return
-    txid = context.args[0]
-    users.setdefault(user_id, {})
-    users[user_id]["txid"] = txid
-    save_data()
+_UNSET = object()
 
-    keyboard = InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton(
-                    "✅ Confirm Payment", callback_data=f"confirm_pay:{user_id}"
-                ),
-                InlineKeyboardButton(
-                    "❌ Reject Payment", callback_data=f"reject_pay:{user_id}"
-                ),
-            ]
-        ]
-    )
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_DAY = timedelta(days=1)
+_DAY_US = 86_400_000_000
 
-    try:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=(
-                f"💳 *New Membership Payment Submitted*\n\n"
-                f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
-                f"🔗 TXID: `{txid}`\n"
-            ),
-            parse_mode="Markdown",
-            reply_markup=keyboard,
-        )
-    except Exception:
-        logger.exception("Failed to notify admin about membership payment.")
 
-    await update.message.reply_text(
-        "✅ TXID submitted. Admin will verify your payment soon.", parse_mode="Markdown", reply_markup=build_main_menu()
-    )
+def _epoch_us(dt: datetime) -> int:
+    """Naive-UTC datetime -> integer microseconds since the epoch (exact)."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - _EPOCH) // _MICROSECOND
 
 
-async def confirm_payment_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Admin-only command: /confirm <user_id>
-    """
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("❌ You are not authorized to use this command.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /confirm <user_id>")
-        return
-    target = context.args[0]
-    u = users.get(target)
-    if not u:
-        await update.message.reply_text("❌ User not found.")
-        return
-    if u.get("paid"):
-        await update.message.reply_text("✅ User already confirmed.")
-        return
-    # confirm
-    u["paid"] = True
-    # mark membership_referrer_rewarded to avoid double-crediting via callback later
-    if not u.get("membership_referrer_rewarded"):
-        ref = u.get("referrer")
-        if ref:
-            add_referral_bonus(ref, "membership")
-            u["membership_referrer_rewarded"] = True
-    save_data()
-    # send premium join button to user
+def _int_id(value):
+    """Telegram IDs are stored as ints; anything else is kept as given."""
     try:
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("💎 Join Premium Group", url=PREMIUM_GROUP)]]
-        )
-        await context.bot.send_message(
-            chat_id=int(target),
-            text="✅ Your membership payment has been confirmed! Welcome to premium.",
-            reply_markup=keyboard,
-        )
-    except Exception:
-        logger.exception("Failed to notify user after membership confirm.")
-    await update.message.reply_text(f"✅ User {target} marked as paid and referral bonuses processed.")
+        return int(value)
+    except (TypeError, ValueError):
+        return value
 
 
-# -----------------------
-# Investment submission (user)
-# -----------------------
-async def invest(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    if len(context.args) < 2:
-        await update.message.reply_text(
-            f"💹 Usage: /invest <amount> <TXID>\nMinimum: {INVEST_MIN} USDT\nDeposit to: `{BNB_ADDRESS}`",
-            parse_mode="Markdown",
-            reply_markup=build_main_menu(),
-        )
-        return
+def _pack_ids(ids):
     try:
-        amount = float(context.args[0])
-    except ValueError:
-        await update.message.reply_text("❌ Invalid amount.")
-        return
-    if amount < INVEST_MIN:
-        await update.message.reply_text(f"❌ Minimum investment is {INVEST_MIN} USDT.")
-        return
-    txid = context.args[1]
+        return array("q", map(int, ids))
+    except (TypeError, ValueError, OverflowError):
+        return list(ids)
 
-    users.setdefault(user_id, {})
-    users[user_id]["pending_investment"] = {
-        "amount": amount,
-        "txid": txid,
-        "submitted_at": datetime.utcnow().isoformat(),
-    }
-    save_data()
 
-    keyboard = InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton(
-                    "✅ Confirm Investment", callback_data=f"confirm_invest:{user_id}"
-                ),
-                InlineKeyboardButton(
-                    "❌ Reject Investment", callback_data=f"reject_invest:{user_id}"
-                ),
-            ]
-        ]
-    )
-    try:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=(
-                f"📥 *New Investment Request*\n\n"
-                f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
-                f"💵 Amount: {amount} USDT\n"
-                f"🔗 TXID: `{txid}`\n"
-            ),
-            parse_mode="Markdown",
-            reply_markup=keyboard,
-        )
-    except Exception:
-        logger.exception("Failed to notify admin of investment.")
+def _pack_iso(value):
+    """ISO timestamp -> int microseconds, if it converts back to the same text."""
+    if isinstance(value, str):
+        try:
+            us = _epoch_us(datetime.fromisoformat(value))
+        except ValueError:
+            return value
+        if _unpack_iso(us) == value:
+            return us
+    return value
 
-    await update.message.reply_text(
-        "✅ Investment submitted and is pending admin verification. You will be notified when confirmed.",
-        parse_mode="Markdown",
-        reply_markup=build_main_menu(),
-    )
 
+def _unpack_iso(us: int) -> str:
+    return (_EPOCH + us * _MICROSECOND).isoformat()
 
-# -----------------------
-# CallbackQuery handler (admin confirms/rejects for payments and investments)
-# -----------------------
-async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
 
-    # Only admin allowed to press these inline action buttons
-    if query.from_user.id != ADMIN_ID:
-        await query.edit_message_text("❌ You are not authorized to perform this action.")
-        return
+class ReferralIds:
+    """List-like view of a user's referral IDs, stored as an int64 array."""
 
-    data = query.data  # e.g., "confirm_invest:12345" or "reject_pay:12345"
-    if not data or ":" not in data:
+    __slots__ = ("ids",)
+
+    def __init__(self, ids: array):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return map(str, self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [str(i) for i in self.ids[index]]
+        return str(self.ids[index])
+
+    def __contains__(self, user_id):
+        return _int_id(user_id) in self.ids
+
+    def append(self, user_id):
+        self.ids.append(int(user_id))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class SlotRecord:
+    """
+    Dict-compatible record with one slot per known field; unknown keys go
+    to a small overflow dict. Subclasses list FIELDS (their __slots__) and
+    DEFAULTS, and may convert values on the way in/out (_pack/_unpack).
+
+    Unset DEFAULTS fields read as their default and count as present, so
+    loaded records need no backfill pass and default values cost nothing.
+    OMIT_DEFAULTS fields are left out of to_dict() (and so out of the
+    files) while they hold their default.
+    """
+
+    __slots__ = ("_extra",)
+    FIELDS: tuple = ()
+    DEFAULTS: Dict[str, Any] = {}
+    OMIT_DEFAULTS: frozenset = frozenset()
+    NESTED: Dict[str, type] = {}  # fields holding a SlotRecord of the given type
+
+    def __init__(self):
+        self._extra = None
+
+    def _stored(self):
+        """(name, value) for the slots actually set, values as stored."""
+        for name in self.FIELDS:
+            try:
+                yield name, object.__getattribute__(self, name)  # skips the __getattr__ defaults
+            except AttributeError:
+                pass
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Name-keyed stored values; nested records become their own state dicts."""
+        state = {
+            name: value.__getstate__() if isinstance(value, SlotRecord) else value
+            for name, value in self._stored()
+        }
+        if self._extra:
+            state.update(self._extra)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        """
+        Restore __getstate__ output, which may come from an older field
+        list: fields added since then read their defaults lazily, fields
+        no longer known are kept in the overflow dict.
+        """
+        self._extra = None
+        fields, nested = self.FIELDS, self.NESTED
+        for name, value in state.items():
+            if name in fields:
+                if name in nested and isinstance(value, dict):
+                    value = nested[name].restore(value)
+                setattr(self, name, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[name] = value
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any]):
+        record = cls.__new__(cls)
+        record.__setstate__(state)
+        return record
+
+    def copy(self):
+        """Detached copy; nested records, arrays and dicts are copied too."""
+        record = type(self)()
+        for name, value in self._stored():
+            if isinstance(value, SlotRecord):
+                value = value.copy()
+            elif isinstance(value, (dict, list, array)):
+                value = value.copy() if isinstance(value, dict) else value[:]
+            setattr(record, name, value)
+        if self._extra:
+            record._extra = {k: (v.copy() if isinstance(v, (dict, list)) else v) for k, v in self._extra.items()}
+        return record
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]):
+        record = cls()
+        defaults = cls.DEFAULTS
+        for key, value in data.items():
+            default = defaults.get(key, _UNSET)
+            if type(value) is type(default) and value == default:
+                continue
+            record[key] = value
+        return record
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Detached plain-dict copy (JSON-ready)."""
+        out = {}
+        omit = self.OMIT_DEFAULTS
+        for key in self.keys():
+            value = self[key]
+            if key in omit and value == self.DEFAULTS[key]:
+                continue
+            if isinstance(value, SlotRecord):
+                value = value.to_dict()
+            elif isinstance(value, ReferralIds):
+                value = list(value)
+            elif isinstance(value, (dict, list)):
+                value = value.copy()
+            out[key] = value
+        return out
+
+    def __getattr__(self, name):
+        # only reached for unset slots
+        default = self.DEFAULTS.get(name, _UNSET)
+        if default is _UNSET:
+            raise AttributeError(name)
+        if isinstance(default, list):
+            default = array("q")
+            setattr(self, name, default)
+        return default
+
+    def _pack(self, key, value):
+        return value
+
+    def _unpack(self, key, value):
+        return value
+
+    # --- dict API ---
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key, _UNSET)
+            if value is _UNSET:
+                raise KeyError(key)
+            return self._unpack(key, value)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, self._pack(key, value))
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            if getattr(self, key, _UNSET) is _UNSET:
+                raise KeyError(key)
+            delattr(self, key)
+        elif self._extra and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return key in self.DEFAULTS or getattr(self, key, _UNSET) is not _UNSET
+        return bool(self._extra) and key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        try:
+            del self[key]
+        except KeyError:
+            pass  # unset default field: nothing stored
+        return value
+
+    def keys(self):
+        keys = [k for k in self.FIELDS if k in self]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class InvestmentRecord(SlotRecord):
+    """A user's confirmed investment; timestamps held as int microseconds."""
+
+    FIELDS = ("amount", "start_date", "active", "lock_until", "referrer_rewarded_for_invest", "txid",
+              "accrued_through")
+    __slots__ = FIELDS
+    TIMESTAMPS = ("start_date", "lock_until", "accrued_through")
+
+    def _pack(self, key, value):
+        if key in self.TIMESTAMPS:
+            return _pack_iso(value)
+        return value
+
+    def _unpack(self, key, value):
+        if key in self.TIMESTAMPS and isinstance(value, int):
+            return _unpack_iso(value)
+        return value
+
+
+class UserRecord(SlotRecord):
+    """
+    Compact user record: the referrer as an int, referrals as an
+    array('q') of ints and the investment as an InvestmentRecord. IDs come
+    back out as strings, so handlers keep using it like the old dict.
+    """
+
+    FIELDS = (
+        "referrer", "balance", "earned_from_referrals", "left", "right", "referrals", "paid", "txid",
+        "pending_investment", "investment", "pending_withdraw", "membership_referrer_rewarded",
+        "direct_bonus_total", "pairing_bonus_total", "pairing_day", "profit_total", "withdrawn_total",
+        "team_size", "team_paid", "team_volume", "team_depth", "ledger_seq",
+    )
+    __slots__ = FIELDS
+    DEFAULTS = {
+        "direct_bonus_total": 0.0,
+        "pairing_bonus_total": 0.0,
+        "profit_total": 0.0,
+        "withdrawn_total": 0.0,
+        "team_size": 0,
+        "team_paid": 0,
+        "team_volume": 0.0,
+        "team_depth": 0,
+        "ledger_seq": 0,
+        "left": 0,
+        "right": 0,
+        "earned_from_referrals": 0.0,
+        "balance": 0.0,
+        "referrals": [],
+        "paid": False,
+    }
+    # ledger rollups and downline aggregates: zero is all a record without them means,
+    # so users.json keeps the shape it had before they existed
+    OMIT_DEFAULTS = frozenset(("profit_total", "withdrawn_total", "team_size", "team_paid", "team_volume",
+                               "team_depth", "ledger_seq"))
+    NESTED = {"investment": InvestmentRecord}
+
+    def _pack(self, key, value):
+        if key == "referrer" and value is not None:
+            return _int_id(value)
+        if key == "referrals":
+            return value.ids if isinstance(value, ReferralIds) else _pack_ids(value)
+        if key == "investment" and isinstance(value, dict):
+            return InvestmentRecord.from_dict(value)
+        if key == "pairing_day" and value is not None:
+            return sys.intern(value)  # the same few dates across all users
+        return value
+
+    def _unpack(self, key, value):
+        if key == "referrer" and value is not None:
+            return str(value)
+        if key == "referrals" and isinstance(value, array):
+            return ReferralIds(value)
+        return value
+
+
+def json_default(obj):
+    """json.dump fallback: records serialize as their dict form."""
+    if isinstance(obj, SlotRecord):
+        return obj.to_dict()
+    if isinstance(obj, ReferralIds):
+        return list(obj)
+    return str(obj)
+
+
+# -----------------------
+# Storage load (safe)
+# -----------------------
+def load_json_file(path: str, default):
+    try:
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return json.load(f)
+    except Exception:
+        logger.exception("Failed to load %s - using default", path)
+    return default
+
+
+def write_json_atomic(path: str, data):
+    """
+    Write JSON to a temp file, fsync it and rename it over `path`, so a
+    crash leaves either the old or the new file, never a truncated one.
+    """
+    # json.dumps, not json.dump: only the one-shot path uses the C encoder
+    write_text_atomic(path, json.dumps(data, separators=(",", ":"), default=json_default))
+
+
+def write_text_atomic(path: str, text: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+SNAPSHOT_MAGIC = b"RBSNAP2"  # RBSNAP1 files were pickles: they fail the magic check and the JSON is loaded
+SNAPSHOT_SCHEMA = 2
+# record fields held as array('q'); marshal has no array type, so they are stored as bytes
+_ARRAY_FIELDS = tuple(name for name, default in UserRecord.DEFAULTS.items() if isinstance(default, list))
+
+
+def write_snapshot(path: str, data: Dict[str, UserRecord], compress: bool = True):
+    """
+    Binary snapshot: magic, a flag byte ("z" zlib / "r" raw), then a marshal
+    of each record's name-keyed state. marshal only builds plain values
+    (never calls into code the way unpickling can), so a tampered snapshot
+    cannot run anything on load. Written atomically like the JSON.
+    """
+    users_state = {}
+    for uid, u in data.items():
+        state = u.__getstate__()
+        for name in _ARRAY_FIELDS:
+            if isinstance(state.get(name), array):
+                state[name] = state[name].tobytes()
+        users_state[uid] = state
+    payload = marshal.dumps({"schema": SNAPSHOT_SCHEMA, "users": users_state})
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + (b"z" if compress else b"r"))
+        f.write(zlib.compress(payload, 1) if compress else payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_snapshot(path: str) -> Dict[str, UserRecord]:
+    """Read a write_snapshot() file; raw snapshots are unmarshalled straight from an mmap."""
+    header = len(SNAPSHOT_MAGIC) + 1
+    with open(path, "rb") as f:
+        head = f.read(header)
+        if head[:-1] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+        if head[-1:] == b"z":
+            snap = marshal.loads(zlib.decompress(f.read()))
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view, view[header:] as body:
+                    snap = marshal.loads(body)
+    if snap.get("schema") != SNAPSHOT_SCHEMA:
+        raise ValueError(f"{path} has unsupported schema {snap.get('schema')}")
+    restore = UserRecord.restore
+    users_state = snap["users"]
+    for state in users_state.values():
+        for name in _ARRAY_FIELDS:
+            raw = state.get(name)
+            if isinstance(raw, bytes):
+                state[name] = ids = array("q")
+                ids.frombytes(raw)
+    return {uid: restore(state) for uid, state in users_state.items()}
+
+
+class JsonStorage:
+    """
+    Whole-file JSON storage: every save rewrites DATA_FILE.
+
+    save(data, user_ids) reads the records to write from `data`, which is
+    either the live users dict (synchronous saves) or the background
+    writer's pending copies. `full_rewrite` backends need every record on
+    each save; the others only need the changed ones. A backend that sets
+    `compact_due` asks save_data() for one full save with every record.
+
+    Backends keep a reference to the dict returned by load() so the admin
+    lookups below can be answered from it; SqliteStorage overrides them
+    with indexed queries.
+
+    With a `snapshot_path` every rewrite also leaves a binary snapshot
+    next to the JSON, and load() prefers it whenever it is at least as new.
+
+    `bytes_written` counts what each save put on disk (for the metrics).
+    """
+
+    full_rewrite = True
+    compact_due = False
+
+    def __init__(self, path: str, snapshot_path: Optional[str] = None):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.data: Dict[str, UserRecord] = {}
+        self.bytes_written = 0
+
+    def load(self) -> Dict[str, UserRecord]:
+        self.data = self.load_snapshot()
+        if self.data is None:
+            self.data = {uid: UserRecord.from_dict(d) for uid, d in load_json_file(self.path, {}).items()}
+        return self.data
+
+    def load_snapshot(self) -> Optional[Dict[str, UserRecord]]:
+        """The snapshot's records, or None if it is missing, older than the JSON or unreadable."""
+        snap = self.snapshot_path
+        if not snap or not os.path.exists(snap):
+            return None
+        if os.path.exists(self.path) and os.stat(snap).st_mtime_ns < os.stat(self.path).st_mtime_ns:
+            logger.info("Snapshot %s is older than %s - loading the JSON", snap, self.path)
+            return None
+        try:
+            data = load_snapshot(snap)
+        except Exception:
+            logger.exception("Failed to load snapshot %s - loading the JSON", snap)
+            return None
+        logger.info("Loaded %d users from snapshot %s", len(data), snap)
+        return data
+
+    def save(self, data, user_ids=()):
+        self.write_files(data)
+
+    def write_files(self, data):
+        # JSON first: a crash in between leaves the snapshot older, so it is skipped
+        write_json_atomic(self.path, data)
+        self.bytes_written += os.path.getsize(self.path)
+        if self.snapshot_path:
+            write_snapshot(self.snapshot_path, data, SNAPSHOT_COMPRESS)
+            self.bytes_written += os.path.getsize(self.snapshot_path)
+
+    def close(self):
+        pass
+
+    # --- admin / referral lookups ---
+    def referral_ids(self, user_id: str):
+        return [uid for uid, u in self.data.items() if u.get("referrer") == user_id]
+
+    def paid_count(self) -> int:
+        return sum(1 for u in self.data.values() if u.get("paid"))
+
+    def pending_ids(self, kind: str):
+        """kind: "investment" or "withdraw"."""
+        key = "pending_" + kind
+        return [uid for uid, u in self.data.items() if u.get(key)]
+
+
+class JournalStorage(JsonStorage):
+    """
+    Snapshot + append-only journal.
+
+    Saving with user IDs appends one compact {"u": <user_id>, "d": <record>}
+    line per changed user instead of re-serializing everything; saving with
+    no IDs (bulk changes) folds the journal into an atomic snapshot.
+
+    An ID save only sees the changed records, so after `compact_every`
+    records it sets `compact_due` and the next save_data() is a full one.
+    """
+
+    full_rewrite = False
+
+    def __init__(self, path: str, journal_path: str, compact_every: int, snapshot_path: Optional[str] = None):
+        super().__init__(path, snapshot_path)
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self.records = 0
+
+    def load(self) -> Dict[str, UserRecord]:
+        super().load()
+        self.records = self.replay()
+        logger.info("Replayed %d journal records from %s", self.records, self.journal_path)
+        return self.data
+
+    def replay(self) -> int:
+        """
+        Apply journal records on top of the loaded snapshot.
+
+        A torn last line (crash mid-append) is dropped and the file truncated
+        to the last complete record so new appends stay readable. A last
+        line without its newline counts as torn even if it parses: save()
+        writes the newline before fsyncing, so that record was never
+        acknowledged, and appending after it would merge two records.
+        Returns number of records applied.
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+        applied = 0
+        good_offset = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("no newline")
+                    rec = json.loads(line)
+                    uid = rec["u"]
+                except Exception:
+                    logger.warning("Dropping torn journal tail at offset %d", good_offset)
+                    break
+                if rec.get("d") is None:
+                    self.data.pop(uid, None)
+                else:
+                    self.data[uid] = UserRecord.from_dict(rec["d"])
+                applied += 1
+                good_offset += len(line)
+        if good_offset != os.path.getsize(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(good_offset)
+        return applied
+
+    def save(self, data, user_ids=()):
+        if not user_ids:
+            self.compact(data)
+            return
+        with open(self.journal_path, "a") as f:
+            for uid in user_ids:
+                line = json.dumps({"u": uid, "d": data.get(uid)}, separators=(",", ":"), default=json_default)
+                f.write(line)
+                f.write("\n")
+                self.bytes_written += len(line) + 1  # ensure_ascii: one byte per char
+            f.flush()
+            os.fsync(f.fileno())
+        self.records += len(user_ids)
+        if self.records >= self.compact_every:
+            self.compact_due = True
+
+    def compact(self, data):
+        """
+        Fold the journal into a fresh snapshot and start an empty journal.
+        Replaying records over a newer snapshot is harmless (records are full
+        per-user states), so a crash between the two steps loses nothing.
+        """
+        self.write_files(data)
+        with open(self.journal_path, "w"):
+            pass
+        self.records = 0
+        self.compact_due = False
+        logger.info("Journal compacted into %s", self.path)
+
+
+class SqliteStorage(JsonStorage):
+    """
+    SQLite persistence (WAL mode): one row per user plus child tables for
+    the investment, pending requests and referral edges. Saves touch only
+    the rows of the users that changed. `referrer`, `paid` and
+    pending-request `status` are indexed so the lookups below don't scan.
+
+    It does not replace the in-memory `users` dict: load() still reads every
+    user into RAM and handlers never read rows through it, so it bounds
+    write cost, not resident memory.
+
+    Resolved pending requests are kept with status "closed" rather than
+    deleted. `bytes_written` counts the row payloads handed to SQLite,
+    not its page writes.
+    """
+
+    full_rewrite = False
+
+    USER_COLUMNS = (
+        "referrer", "paid", "balance", "earned_from_referrals", "direct_bonus_total",
+        "pairing_bonus_total", "left", "right", "txid", "membership_referrer_rewarded",
+    )
+    INVEST_COLUMNS = ("amount", "start_date", "active", "lock_until", "referrer_rewarded_for_invest")
+    PENDING_COLUMNS = ("amount", "txid", "wallet", "submitted_at")
+    BOOL_COLUMNS = {"paid", "membership_referrer_rewarded", "active", "referrer_rewarded_for_invest"}
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            referrer TEXT,
+            paid INTEGER NOT NULL DEFAULT 0,
+            balance REAL NOT NULL DEFAULT 0,
+            earned_from_referrals REAL NOT NULL DEFAULT 0,
+            direct_bonus_total REAL NOT NULL DEFAULT 0,
+            pairing_bonus_total REAL NOT NULL DEFAULT 0,
+            "left" INTEGER NOT NULL DEFAULT 0,
+            "right" INTEGER NOT NULL DEFAULT 0,
+            txid TEXT,
+            membership_referrer_rewarded INTEGER NOT NULL DEFAULT 0,
+            extra TEXT
+        );
+        CREATE TABLE IF NOT EXISTS investments (
+            user_id TEXT PRIMARY KEY REFERENCES users(id),
+            amount REAL,
+            start_date TEXT,
+            active INTEGER,
+            lock_until TEXT,
+            referrer_rewarded_for_invest INTEGER,
+            extra TEXT
+        );
+        CREATE TABLE IF NOT EXISTS pending_requests (
+            user_id TEXT NOT NULL REFERENCES users(id),
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            amount REAL,
+            txid TEXT,
+            wallet TEXT,
+            submitted_at TEXT,
+            extra TEXT,
+            PRIMARY KEY (user_id, kind)
+        );
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (referrer_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer);
+        CREATE INDEX IF NOT EXISTS idx_users_paid ON users(paid);
+        CREATE INDEX IF NOT EXISTS idx_pending_status ON pending_requests(status, kind);
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # the writer connection may be driven from the persistence thread;
+        # lookups use their own connection (WAL lets readers run alongside)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.reader = sqlite3.connect(path)
+
+    @classmethod
+    def _split(cls, record: Dict[str, Any], columns):
+        """Split a dict into column values (in `columns` order) and leftover JSON."""
+        values = []
+        for col in columns:
+            v = record.get(col)
+            values.append(int(bool(v)) if col in cls.BOOL_COLUMNS and v is not None else v)
+        extra = {k: v for k, v in record.items() if k not in columns}
+        return values, (json.dumps(extra, default=str) if extra else None)
+
+    @classmethod
+    def _join(cls, row, columns, extra: str) -> Dict[str, Any]:
+        record = json.loads(extra) if extra else {}
+        for col, v in zip(columns, row):
+            record[col] = bool(v) if col in cls.BOOL_COLUMNS and v is not None else v
+        return record
+
+    def load(self) -> Dict[str, UserRecord]:
+        cols = ", ".join(f'"{c}"' for c in self.USER_COLUMNS)
+        data: Dict[str, Dict[str, Any]] = {}
+        for row in self.conn.execute(f"SELECT id, {cols}, extra FROM users"):
+            user = self._join(row[1:-1], self.USER_COLUMNS, row[-1])
+            user["referrals"] = []
+            data[row[0]] = user
+        for row in self.conn.execute(
+            "SELECT user_id, amount, start_date, active, lock_until, referrer_rewarded_for_invest, extra "
+            "FROM investments"
+        ):
+            if row[0] in data:
+                data[row[0]]["investment"] = self._join(row[1:-1], self.INVEST_COLUMNS, row[-1])
+        for row in self.conn.execute(
+            "SELECT user_id, kind, amount, txid, wallet, submitted_at, extra "
+            "FROM pending_requests WHERE status = 'pending'"
+        ):
+            if row[0] in data:
+                pending = self._join(row[2:-1], self.PENDING_COLUMNS, row[-1])
+                data[row[0]]["pending_" + row[1]] = {k: v for k, v in pending.items() if v is not None}
+        for referrer_id, user_id in self.conn.execute(
+            "SELECT referrer_id, user_id FROM referrals ORDER BY referrer_id, position"
+        ):
+            if referrer_id in data:
+                data[referrer_id]["referrals"].append(user_id)
+        self.data = {uid: UserRecord.from_dict(d) for uid, d in data.items()}
+        return self.data
+
+    def save(self, data, user_ids=()):
+        ids = user_ids or list(data)
+        with self.conn:
+            for uid in ids:
+                user = data.get(uid)
+                if user is None:
+                    self._delete_user(uid)
+                else:
+                    self._write_user(uid, user)
+
+    def _write_user(self, uid: str, user: Dict[str, Any]):
+        nested = {"investment", "pending_investment", "pending_withdraw", "referrals"}
+        values, extra = self._split({k: v for k, v in user.items() if k not in nested}, self.USER_COLUMNS)
+        self.bytes_written += sum(len(str(v)) for v in values if v is not None) + len(extra or "")
+        cols = ", ".join(f'"{c}"' for c in self.USER_COLUMNS)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO users (id, {cols}, extra) VALUES (?, {', '.join('?' * len(values))}, ?)",
+            [uid, *values, extra],
+        )
+
+        inv = user.get("investment")
+        if inv:
+            values, extra = self._split(inv, self.INVEST_COLUMNS)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO investments (user_id, amount, start_date, active, lock_until, "
+                "referrer_rewarded_for_invest, extra) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [uid, *values, extra],
+            )
+        else:
+            self.conn.execute("DELETE FROM investments WHERE user_id = ?", (uid,))
+
+        for kind in ("investment", "withdraw"):
+            pending = user.get("pending_" + kind)
+            if pending:
+                values, extra = self._split(pending, self.PENDING_COLUMNS)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO pending_requests (user_id, kind, status, amount, txid, wallet, "
+                    "submitted_at, extra) VALUES (?, ?, 'pending', ?, ?, ?, ?, ?)",
+                    [uid, kind, *values, extra],
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE pending_requests SET status = 'closed' "
+                    "WHERE user_id = ? AND kind = ? AND status = 'pending'",
+                    (uid, kind),
+                )
+
+        # referrals only ever grow: insert just the tail we haven't stored yet
+        refs = user.get("referrals") or []
+        (stored,) = self.conn.execute(
+            "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (uid,)
+        ).fetchone()
+        if len(refs) > stored:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO referrals (referrer_id, user_id, position) VALUES (?, ?, ?)",
+                [(uid, child, pos) for pos, child in enumerate(refs[stored:], start=stored)],
+            )
+
+    def _delete_user(self, uid: str):
+        for table, col in (("users", "id"), ("investments", "user_id"),
+                           ("pending_requests", "user_id"), ("referrals", "referrer_id")):
+            self.conn.execute(f"DELETE FROM {table} WHERE {col} = ?", (uid,))
+
+    def close(self):
+        self.conn.close()
+        self.reader.close()
+
+    # --- admin / referral lookups (indexed) ---
+    def referral_ids(self, user_id: str):
+        return [r[0] for r in self.reader.execute("SELECT id FROM users WHERE referrer = ?", (user_id,))]
+
+    def paid_count(self) -> int:
+        return self.reader.execute("SELECT COUNT(*) FROM users WHERE paid = 1").fetchone()[0]
+
+    def pending_ids(self, kind: str):
+        return [
+            r[0] for r in self.reader.execute(
+                "SELECT user_id FROM pending_requests WHERE status = 'pending' AND kind = ?", (kind,)
+            )
+        ]
+
+
+def read_bytes(path: str) -> bytes:
+    """File contents, or b"" if it doesn't exist."""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return b""
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    """Stable shard number for a user ID (str hash() is salted per process)."""
+    return zlib.crc32(user_id.encode()) % shards
+
+
+def worker_of(user_id: str) -> int:
+    """The worker process owning a user in multi-process mode."""
+    return shard_of(user_id, SHARD_COUNT) % WORKERS
+
+
+def owns(user_id: str) -> bool:
+    """Whether this process holds the user's record (always, outside multi-process mode)."""
+    return WORKER_INDEX < 0 or worker_of(user_id) == WORKER_INDEX
+
+
+def txid_worker(key: str) -> int:
+    """The worker indexing the holders of a (normalized) TXID in multi-process mode."""
+    return zlib.crc32(key.encode()) % WORKERS
+
+
+def owns_txid(key: str) -> bool:
+    return WORKER_INDEX < 0 or txid_worker(key) == WORKER_INDEX
+
+
+class ShardedStorage(JsonStorage):
+    """
+    Users split over `shards` JSON files by a hash of the user ID, so a save
+    rewrites only the shards holding the changed users (each atomically).
+    Saving with no IDs rewrites every shard.
+
+    The backend remembers which IDs live in which shard. A dirty shard is
+    rebuilt from `data` when that holds all of its users (the live dict);
+    the background writer hands over only the changed records, so then the
+    shard's file is read back and patched with them. Shard files carry the shard count in their name and
+    the manifest is written last: a crash while migrating from the single
+    DATA_FILE or resharding leaves the previous layout in use.
+
+    Parsing and encoding hold the GIL, so only the file reads, writes and
+    fsyncs go to the thread pool, overlapping with the JSON work.
+
+    With `owned` (multi-process mode) the backend loads and writes only
+    those shards and ignores other users; the front process prepares the
+    layout with a full instance before any worker opens its part.
+
+    Migration replays `journal_path` over the single file first, so moving
+    from STORAGE_MODE=journal keeps changes made since the last compaction.
+    """
+
+    MANIFEST = "manifest.json"
+    full_rewrite = False
+
+    def __init__(self, directory: str, shards: int, path: str, snapshot_path: Optional[str] = None,
+                 workers: int = 8, owned: Optional[List[int]] = None, journal_path: Optional[str] = None):
+        super().__init__(path, snapshot_path)  # the single-file layout, read once to migrate
+        self.journal_path = journal_path
+        self.directory = directory
+        self.shards = shards
+        self.owned = set(range(shards) if owned is None else owned)
+        self.members: List[set] = [set() for _ in range(shards)]
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="shard")
+
+    def shard_path(self, index: int, shards: int = None) -> str:
+        shards = shards or self.shards
+        return os.path.join(self.directory, f"users-{index:04d}-of-{shards:04d}.json")
+
+    def load(self) -> Dict[str, UserRecord]:
+        if not self.owned:
+            return self.data
+        partial = len(self.owned) < self.shards
+        manifest = load_json_file(os.path.join(self.directory, self.MANIFEST), None)
+        if manifest is None and not partial:
+            self.data = self.migrate()
+            return self.data
+        found = int(manifest["shards"]) if manifest else 0
+        if partial and found != self.shards:
+            raise RuntimeError(f"{self.directory} holds {found} shards, expected {self.shards}")
+        self.data = {}
+        from_dict = UserRecord.from_dict
+        paths = [self.shard_path(i, found) for i in range(found) if not partial or i in self.owned]
+        for raw in self.pool.map(read_bytes, paths):
+            if raw:
+                self.data.update((uid, from_dict(d)) for uid, d in json.loads(raw).items())
+        logger.info("Loaded %d users from %d shards in %s", len(self.data), len(paths), self.directory)
+        for uid in self.data:
+            self.members[shard_of(uid, self.shards)].add(uid)
+        if found != self.shards:
+            logger.info("Resharding %s from %d to %d shards", self.directory, found, self.shards)
+            self.write_layout(self.data)
+            self.remove_shards(found)
+        return self.data
+
+    def migrate(self) -> Dict[str, UserRecord]:
+        """First start in sharded mode: split the single-file users (and journal) into shards."""
+        if self.journal_path and os.path.exists(self.journal_path):
+            journal = JournalStorage(self.path, self.journal_path, 0, self.snapshot_path)
+            data = self.data = journal.load()
+        else:
+            data = super().load()
+        for uid in data:
+            self.members[shard_of(uid, self.shards)].add(uid)
+        self.write_layout(data)
+        for legacy in (self.path, self.snapshot_path, self.journal_path):
+            if legacy and os.path.exists(legacy):
+                os.replace(legacy, legacy + ".migrated")
+        if data:
+            logger.info("Migrated %d users from %s into %d shards in %s",
+                        len(data), self.path, self.shards, self.directory)
+        return data
+
+    def write_layout(self, data):
+        """Write every shard, then the manifest that makes them the live layout."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.write_shards(data, range(self.shards))
+        write_json_atomic(os.path.join(self.directory, self.MANIFEST), {"shards": self.shards})
+
+    def remove_shards(self, shards: int):
+        for path in glob.glob(os.path.join(self.directory, f"users-*-of-{shards:04d}.json")):
+            os.remove(path)
+
+    def save(self, data, user_ids=()):
+        if not user_ids:
+            self.members = [set() for _ in range(self.shards)]
+            for uid in data:
+                self.members[shard_of(uid, self.shards)].add(uid)
+            self.write_shards(data, sorted(self.owned))
+            return
+        dirty: Dict[int, List[str]] = {}
+        for uid in user_ids:
+            index = shard_of(uid, self.shards)
+            if index not in self.owned:
+                continue  # another worker's user, e.g. a referrer credited over the pipe
+            if data.get(uid) is not None:
+                self.members[index].add(uid)
+            else:
+                self.members[index].discard(uid)
+            dirty.setdefault(index, []).append(uid)
+        self.write_shards(data, sorted(dirty), dirty)
+
+    def write_shards(self, data, indexes, changed: Optional[Dict[int, List[str]]] = None):
+        """
+        Rewrite the given shards. With `changed` (shard -> changed IDs), a
+        shard whose other users are missing from `data` is read back from
+        its file and patched with the changed records.
+        """
+        partial = [i for i in indexes if changed and not all(uid in data for uid in self.members[i])]
+        files = dict(zip(partial, self.pool.map(read_bytes, [self.shard_path(i) for i in partial])))
+        # Encoding needs the GIL, so it stays on this thread; the pool writes
+        # and fsyncs each shard while the next one is being encoded.
+        writes = []
+        for index in indexes:
+            if index in files:
+                records = json.loads(files[index]) if files[index] else {}
+                for uid in changed[index]:
+                    if data.get(uid) is None:
+                        records.pop(uid, None)
+                    else:
+                        records[uid] = data[uid]
+            else:
+                records = {uid: data[uid] for uid in self.members[index]}
+            text = json.dumps(records, separators=(",", ":"), default=json_default)
+            writes.append(self.pool.submit(write_text_atomic, self.shard_path(index), text))
+            self.bytes_written += len(text)  # ensure_ascii: one byte per char
+        for write in writes:
+            write.result()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def open_storage(mode: str):
+    snapshot = SNAPSHOT_FILE if BINARY_SNAPSHOT else None
+    if mode == "journal":
+        return JournalStorage(DATA_FILE, JOURNAL_FILE, JOURNAL_COMPACT_EVERY, snapshot)
+    if mode == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    if mode == "sharded":
+        owned = None
+        if WORKERS:  # the front holds no users; a worker only its own shards
+            owned = [] if IS_FRONT else [i for i in range(SHARD_COUNT) if i % WORKERS == WORKER_INDEX]
+        return ShardedStorage(SHARD_DIR, SHARD_COUNT, DATA_FILE, snapshot, SHARD_WORKERS, owned, JOURNAL_FILE)
+    return JsonStorage(DATA_FILE, snapshot)
+
+
+def copy_record(record):
+    """
+    Detached copy of a user record. Records are at most two levels deep
+    (investment / pending dicts and the referrals), so this is much
+    cheaper than copy.deepcopy.
+    """
+    if isinstance(record, SlotRecord):
+        return record.copy()
+    return {k: (v.copy() if isinstance(v, (dict, list)) else v) for k, v in record.items()}
+
+
+def store_users(storage, data, user_ids):
+    """storage.save() timed into STORAGE_WRITE_SECONDS."""
+    t0 = time.perf_counter()
+    try:
+        storage.save(data, user_ids)
+    finally:
+        STORAGE_WRITE_SECONDS.observe(time.perf_counter() - t0)
+
+
+class PersistenceWriter:
+    """
+    Background group-commit writer.
+
+    save_data() hands over copies of the changed records and returns at
+    once; a daemon thread coalesces bursts and writes them in one storage
+    call once the burst has been quiet for `interval` seconds, and never
+    later than `max_latency` seconds after the first unsaved change.
+    Handler latency therefore no longer depends on the size of the data.
+
+    For full_rewrite backends (JSON) the thread keeps its own copy of every
+    record so it never reads the live users dict: that roughly doubles the
+    memory held for users (`bench.py writer` measures it). Other backends
+    only ever see the pending copies; a full save hands over every record
+    once and they are dropped after the write.
+
+    Ledger lines handed over with the records are written (and fsynced)
+    to `ledger` first and committed after the records are saved.
+    """
+
+    def __init__(self, storage, data: Dict[str, Dict[str, Any]], interval: float, max_latency: float,
+                 ledger: Optional["Ledger"] = None):
+        self.storage = storage
+        self.ledger = ledger
+        self.interval = interval
+        self.max_latency = max_latency
+        self.image = {uid: copy_record(u) for uid, u in data.items()} if storage.full_rewrite else None
+        self._cond = threading.Condition()
+        self._pending: Dict[str, Any] = {}
+        self._lines: List[str] = []
+        self._seq = 0
+        self._full = False
+        self._first = self._last = 0.0
+        self._marked = self._written = 0
+        self._force = self._closing = False
+        self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self._thread.start()
+
+    def mark(self, data: Dict[str, Dict[str, Any]], user_ids, ledger_lines=(), ledger_seq: int = 0):
+        """
+        Queue the given users (all users when `user_ids` is empty) and the
+        ledger lines posted for them for the next flush. Must be called
+        from the thread that owns `data`.
+        """
+        copies = {uid: copy_record(data[uid]) if uid in data else None for uid in (user_ids or data)}
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending and not self._full:
+                self._first = now
+            self._last = now
+            self._pending.update(copies)
+            self._lines.extend(ledger_lines)
+            self._seq = max(self._seq, ledger_seq)
+            self._full = self._full or not user_ids
+            self._marked += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout: float = None):
+        """Write everything marked so far and wait until it is on disk."""
+        with self._cond:
+            target = self._marked
+            self._force = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._written >= target or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        """Flush outstanding changes and stop the thread."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._full or self._force or self._closing)
+                while (self._pending or self._full) and not (self._force or self._closing):
+                    due = min(self._last + self.interval, self._first + self.max_latency)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                pending, full, generation = self._pending, self._full, self._marked
+                lines, seq = self._lines, self._seq
+                self._pending, self._full, self._force, self._lines = {}, False, False, []
+                closing = self._closing
+            if pending or full or lines:
+                self._write(pending, full, lines, seq)
+            with self._cond:
+                self._written = generation
+                self._cond.notify_all()
+                if closing and not self._pending and not self._full:
+                    return
+
+    def _write(self, pending: Dict[str, Any], full: bool, lines: List[str], seq: int):
+        try:
+            if self.ledger is not None:
+                self.ledger.write(lines)
+            data = pending
+            if self.image is not None:
+                for uid, record in pending.items():
+                    if record is None:
+                        self.image.pop(uid, None)
+                    else:
+                        self.image[uid] = record
+                data = self.image
+            elif full:
+                data = {uid: record for uid, record in pending.items() if record is not None}
+            store_users(self.storage, data, () if full else list(pending))
+            if self.ledger is not None:
+                self.ledger.commit(seq)
+        except Exception:
+            logger.exception("Failed to save users data.")
+
+
+# -----------------------
+# Ledger
+# -----------------------
+# ledger kind -> (per-user rollup field, sign); withdrawals are debits rolled up as a positive total
+LEDGER_ROLLUPS = {
+    "direct": ("direct_bonus_total", 1),
+    "pairing": ("pairing_bonus_total", 1),
+    "profit": ("profit_total", 1),
+    "withdraw": ("withdrawn_total", -1),
+}
+_LEDGER_COMMIT = b'{"k":"commit","n":'
+
+
+class Ledger:
+    """
+    Append-only JSON-lines ledger: one {"n", "ts", "u", "k", "a"[, "src"]}
+    line per balance change, `a` signed, `n` a sequence number. post()
+    applies the change to the user's balance and rollup fields, stamps the
+    user's `ledger_seq` and buffers the line, so the rollups are always
+    current and /stats never reads history.
+
+    The buffered lines are written with the user records, in the same
+    save_data() group commit: ledger lines first (fsynced), then the
+    records, then a {"k": "commit"} mark. On open, an entry after the last
+    mark whose user was saved without it (its `ledger_seq` is older) is
+    cancelled by a {"k": "void"} line, so the ledger always matches the
+    saved balances.
+
+    A new ledger opens with "opening" entries (no `n`) for the existing
+    rollup totals and the rest of each balance, so summing a user's
+    entries gives their balance.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.seq = 0
+        self.lines: List[str] = []
+        self.unsaved: set = set()  # users with buffered lines
+        self.committed = -1  # open() always leaves a mark, so the next start scans little
+
+    def open(self, data: Dict[str, UserRecord]):
+        if not os.path.exists(self.path):
+            ts = datetime.utcnow().isoformat()
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                for uid, user in data.items():
+                    entries = [(kind, sign * user[field]) for kind, (field, sign) in LEDGER_ROLLUPS.items()]
+                    entries.insert(0, ("opening", user["balance"] - sum(a for _, a in entries)))
+                    for kind, amount in entries:
+                        if amount:
+                            f.write(self._line(None, ts, uid, kind, amount, "opening"))
+                    self.seq = max(self.seq, user["ledger_seq"])  # a previous ledger's numbers
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.file = open(self.path, "a")
+        else:
+            self.file = open(self.path, "a")
+            self.recover(data)
+        self.commit(self.seq)
+
+    def recover(self, data: Dict[str, UserRecord]):
+        """Void the entries after the last commit mark that their user record doesn't include."""
+        with open(self.path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            start, chunk = size, 1 << 16
+            while True:
+                start = max(0, start - chunk)
+                f.seek(start)
+                tail = f.read(size - start)
+                at = tail.rfind(b"\n" + _LEDGER_COMMIT) + 1
+                if at or start == 0:
+                    break
+                chunk *= 2
+        if at or tail.startswith(_LEDGER_COMMIT):
+            mark, _, tail = tail[at:].partition(b"\n")
+            self.seq = json.loads(mark)["n"]
+        if tail and not tail.endswith(b"\n"):
+            # torn by a crash mid-write; its user can't have been saved after it
+            torn = len(tail) - tail.rfind(b"\n") - 1
+            self.file.truncate(size - torn)
+            tail = tail[:-torn]
+        void = []
+        for line in tail.splitlines():
+            entry = json.loads(line)
+            n = entry.get("n")
+            if n is None or entry["k"] in ("commit", "void"):
+                continue
+            self.seq = max(self.seq, n)
+            user = data.get(entry["u"])
+            if user is None or n > user["ledger_seq"]:
+                void.append(n)
+        if void:
+            logger.warning("Voiding %d ledger entries whose user records were not saved", len(void))
+            self.file.write(json.dumps({"k": "void", "v": void}, separators=(",", ":")) + "\n")
+
+    @staticmethod
+    def _line(n: Optional[int], ts: str, uid: str, kind: str, amount: float, source: Optional[str] = None) -> str:
+        u = f'"{uid}"' if uid.isdigit() else json.dumps(uid)
+        src = f',"src":{json.dumps(source)}' if source is not None else ""
+        seq = f'"n":{n},' if n is not None else ""
+        return f'{{{seq}"ts":"{ts}","u":{u},"k":"{kind}","a":{float(amount)!r}{src}}}\n'
+
+    def post(self, user_id: str, user: UserRecord, kind: str, amount: float,
+             source: Optional[str] = None, ts: Optional[str] = None):
+        """Apply `amount` (negative = debit) to the user's balance and rollup and record it."""
+        user["balance"] = user.get("balance", 0.0) + amount
+        rollup = LEDGER_ROLLUPS.get(kind)
+        if rollup:
+            field, sign = rollup
+            user[field] = user.get(field, 0.0) + sign * amount
+        self.seq += 1
+        user["ledger_seq"] = self.seq
+        self.lines.append(self._line(self.seq, ts or datetime.utcnow().isoformat(), user_id, kind, amount, source))
+        self.unsaved.add(user_id)
+
+    def post_many(self, kind: str, entries, ts: Optional[str] = None):
+        """post() for many (user_id, user, amount) entries."""
+        ts = ts or datetime.utcnow().isoformat()
+        field, sign = LEDGER_ROLLUPS.get(kind, (None, 0))
+        line, lines, unsaved = self._line, self.lines, self.unsaved
+        seq = self.seq
+        for user_id, user, amount in entries:
+            user["balance"] = user.get("balance", 0.0) + amount
+            if field:
+                user[field] = user.get(field, 0.0) + sign * amount
+            seq += 1
+            user["ledger_seq"] = seq
+            lines.append(line(seq, ts, user_id, kind, amount))
+            unsaved.add(user_id)
+        self.seq = seq
+
+    def take(self) -> Tuple[List[str], int]:
+        """Hand the buffered lines (and the sequence number they reach) to a save."""
+        lines, self.lines = self.lines, []
+        self.unsaved = set()
+        return lines, self.seq
+
+    def write(self, lines: List[str]):
+        """Append lines and fsync them, before the records that include them are saved."""
+        if lines and self.file:
+            self.file.write("".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def commit(self, seq: int):
+        """Mark every entry up to `seq` as saved with its user."""
+        if seq > self.committed and self.file:
+            self.file.write(f'{_LEDGER_COMMIT.decode()}{seq}}}\n')
+            self.file.flush()
+            self.committed = seq
+
+    def close(self):
+        if self.file:
+            self.write(self.take()[0])
+            self.file.close()
+            self.file = None
+
+    def totals(self, seq: int) -> Dict[str, Dict[str, float]]:
+        """Sum the ledger's entries up to `seq` per user and kind ("*" = all kinds)."""
+        sums: Dict[str, Dict[str, float]] = {}
+        with open(self.path, "rb") as f:
+            lines = f.read().splitlines()
+        void = set()
+        for line in lines:
+            if b'"k":"void"' in line:
+                void.update(json.loads(line)["v"])
+        for line in lines:
+            entry = json.loads(line)
+            kind = entry["k"]
+            n = entry.get("n")
+            if kind in ("commit", "void") or n is not None and (n > seq or n in void):
+                continue
+            per_user = sums.setdefault(entry["u"], {})
+            per_user[kind] = per_user.get(kind, 0.0) + entry["a"]
+            per_user["*"] = per_user.get("*", 0.0) + entry["a"]
+        return sums
+
+
+# initialize users and meta
+storage = open_storage(STORAGE_MODE)
+users: Dict[str, UserRecord] = storage.load()  # lookups read these live records
+meta: Dict[str, Any] = load_json_file(META_FILE, {"last_reset": None})
+pending_items.build(users)
+
+ledger = Ledger(LEDGER_FILE)
+if not IS_FRONT:  # the front process holds no users and posts nothing
+    ledger.open(users)
+atexit.register(ledger.close)
+
+persistence = (
+    PersistenceWriter(storage, users, PERSIST_FLUSH_INTERVAL, PERSIST_MAX_LATENCY, ledger)
+    if PERSIST_FLUSH_INTERVAL > 0
+    else None
+)
+
+
+def flush_persistence():
+    """Stop the background writer after it has written everything queued (idempotent)."""
+    global persistence
+    if persistence is not None:
+        persistence.close()
+        persistence = None
+
+
+def shutdown_persistence():
+    """Flush pending saves and release the storage backend (idempotent)."""
+    flush_persistence()
+    storage.close()
+
+
+atexit.register(shutdown_persistence)
+
+
+# -----------------------
+# Helper functions
+# -----------------------
+def save_data(*user_ids: str):
+    """
+    Persist users through the configured storage backend.
+
+    Pass the IDs of the users that changed so journal/sqlite backends write
+    only those records; no IDs means a bulk change (full snapshot). With the
+    background writer enabled this only queues the change.
+    """
+    t0 = time.perf_counter()
+    ids = [uid for uid in dict.fromkeys(user_ids) if uid]
+    lines, seq = ledger.take()
+    query_index.refresh(ids)
+    txid_index.refresh(ids)
+    pending_items.refresh(ids)
+    if storage.compact_due:
+        storage.compact_due = False
+        ids = []
+    try:
+        if persistence is not None:
+            persistence.mark(users, ids, lines, seq)
+        else:
+            ledger.write(lines)
+            store_users(storage, users, ids)
+            ledger.commit(seq)
+    except Exception:
+        logger.exception("Failed to save users data.")
+    finally:
+        SAVE_SECONDS.observe(time.perf_counter() - t0)
+
+
+def save_meta():
+    try:
+        with open(META_FILE, "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+    except Exception:
+        logger.exception("Failed to save meta data.")
+
+
+def reset_pairing_if_needed(user: Dict[str, Any]) -> bool:
+    """
+    Zero one user's daily left/right pair counters if they were last touched
+    on an earlier UTC day. Called lazily whenever the counters are read or
+    updated, so the daily rollover is O(1) instead of a sweep over all users.
+
+    Records written before per-user stamps existed fall back to the old global
+    meta["last_reset"] day. Returns True if the counters were reset.
+    """
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    if user.get("pairing_day", meta.get("last_reset")) != today:
+        user["left"] = 0
+        user["right"] = 0
+        user["pairing_day"] = today
+        return True
+    return False
+
+
+def add_referral_bonus(referrer_id_str: str, bonus_type: str = "membership", source: Optional[str] = None):
+    """
+    Give referrer either direct or pairing bonus depending on context.
+    `source` is the referred user, recorded in the ledger entry.
+
+    bonus_type:
+      - "membership": give direct bonus only
+      - "pairing": give pairing bonus only (respecting daily max and left/right)
+    """
+    if not owns(referrer_id_str):
+        shard_link.cast("bonus", referrer_id_str, bonus_type, source)
+        return
+    ref = users.get(referrer_id_str)
+    if not ref:
+        return
+
+    # initialize aggregator fields if missing
+    ref.setdefault("direct_bonus_total", 0.0)
+    ref.setdefault("pairing_bonus_total", 0.0)
+    ref.setdefault("earned_from_referrals", 0.0)
+    ref.setdefault("left", 0)
+    ref.setdefault("right", 0)
+    ref.setdefault("balance", 0.0)
+
+    if bonus_type == "membership":
+        # Direct referral bonus only
+        ledger.post(referrer_id_str, ref, "direct", DIRECT_BONUS, source)
+        ref["earned_from_referrals"] = ref.get("earned_from_referrals", 0.0) + DIRECT_BONUS
+        logger.info("Direct bonus %s given to %s", DIRECT_BONUS, referrer_id_str)
+
+    elif bonus_type == "pairing":
+        reset_pairing_if_needed(ref)
+        # Pairing bonus only: alternate left/right to balance pairs
+        side = "left" if ref.get("left", 0) <= ref.get("right", 0) else "right"
+        if ref.get(side, 0) < MAX_PAIRS_PER_DAY:
+            ref[side] = ref.get(side, 0) + 1
+            ledger.post(referrer_id_str, ref, "pairing", PAIRING_BONUS, source)
+            ref["earned_from_referrals"] = ref.get("earned_from_referrals", 0.0) + PAIRING_BONUS
+            logger.info("Pairing bonus %s given to %s on side %s", PAIRING_BONUS, referrer_id_str, side)
+        else:
+            logger.info("Pairing bonus skipped for %s: daily limit reached", referrer_id_str)
+    update_rankings(referrer_id_str)
+
+
+# -----------------------
+# Admin query engine
+# -----------------------
+class _BisectList(list):
+    """Stand-in for sortedcontainers.SortedList: same calls, O(n) inserts."""
+
+    def add(self, value):
+        bisect.insort(self, value)
+
+    def remove(self, value):
+        del self[bisect.bisect_left(self, value)]
+
+    def bisect_left(self, value):
+        return bisect.bisect_left(self, value)
+
+    def bisect_right(self, value):
+        return bisect.bisect_right(self, value)
+
+
+def _sorted_list(items=()):
+    return SortedList(items) if SortedList is not None else _BisectList(items)
+
+
+QUERY_PAGE_SIZE = 20
+_MAX_KEY = "\U0010ffff"  # sorts after every user ID
+
+
+def _q_bool(text: str) -> bool:
+    if text.lower() in ("true", "yes", "1"):
+        return True
+    if text.lower() in ("false", "no", "0"):
+        return False
+    raise ValueError(f"expected true/false, got {text!r}")
+
+
+def _q_date(text: str) -> str:
+    """ISO date/datetime, "now", or relative to now: +7d, -24h, +30m."""
+    now = datetime.utcnow()
+    if text == "now":
+        return now.isoformat()
+    if text[:1] in "+-" and text[-1:] in ("d", "h", "m"):
+        unit = {"d": "days", "h": "hours", "m": "minutes"}[text[-1]]
+        try:
+            return (now + timedelta(**{unit: float(text[:-1])})).isoformat()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(text).isoformat()
+    except ValueError:
+        raise ValueError(f"expected a date like 2024-05-01, now or +7d, got {text!r}") from None
+
+
+def _pending_submitted(u) -> Optional[str]:
+    dates = [p["submitted_at"] for p in (u.get("pending_withdraw"), u.get("pending_investment"))
+             if p and p.get("submitted_at")]
+    return min(dates) if dates else None
+
+
+# field -> (getter, value parser); a getter returns None when the field doesn't apply
+QUERY_FIELDS = {
+    "paid": (lambda u: bool(u.get("paid")), _q_bool),
+    "balance": (lambda u: u.get("balance", 0.0), float),
+    "earned": (lambda u: u.get("earned_from_referrals", 0.0), float),
+    "referrals": (lambda u: len(u["referrals"]), int),
+    "team_size": (lambda u: u["team_size"], int),
+    "txid": (lambda u: u.get("txid"), str),
+    "referrer": (lambda u: u.get("referrer"), str),
+    "invest_amount": (lambda u: (u.get("investment") or {}).get("amount"), float),
+    "invest_active": (lambda u: bool((u.get("investment") or {}).get("active")), _q_bool),
+    "start_date": (lambda u: (u.get("investment") or {}).get("start_date"), _q_date),
+    "lock_until": (lambda u: (u.get("investment") or {}).get("lock_until"), _q_date),
+    "withdraw_amount": (lambda u: (u.get("pending_withdraw") or {}).get("amount"), float),
+    "pending_invest_amount": (lambda u: (u.get("pending_investment") or {}).get("amount"), float),
+    "submitted_at": (_pending_submitted, _q_date),
+    "has:txid": (lambda u: bool(u.get("txid")), _q_bool),
+    "has:referrer": (lambda u: bool(u.get("referrer")), _q_bool),
+    "has:investment": (lambda u: bool(u.get("investment")), _q_bool),
+    "has:pending_withdraw": (lambda u: bool(u.get("pending_withdraw")), _q_bool),
+    "has:pending_investment": (lambda u: bool(u.get("pending_investment")), _q_bool),
+    "has:pending": (lambda u: bool(u.get("pending_withdraw") or u.get("pending_investment")), _q_bool),
+}
+INDEXED_FIELDS = (
+    "paid", "balance", "invest_amount", "invest_active", "lock_until", "submitted_at",
+    "has:txid", "has:pending_withdraw", "has:pending_investment", "has:pending",
+)
+_QUERY_OPS = {"=": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le,
+              ">": operator.gt, ">=": operator.ge}
+_QUERY_TERM = re.compile(r"^([a-z_:]+?)(<=|>=|!=|=|<|>)(.+)$")
+
+QUERY_USAGE_TEXT = (
+    "Usage: /query <term> [<term> ...] [page:N]\n"
+    "Terms are ANDed:\n"
+    "• field<op>value, op one of = != < <= > >=\n"
+    "• has:<txid|referrer|investment|pending_withdraw|pending_investment>\n"
+    "• pending:<withdraw|investment|any>\n"
+    "Dates take 2024-05-01, now, +7d, -24h.\n"
+    f"Fields: {', '.join(f for f in QUERY_FIELDS if ':' not in f)}\n"
+    "Examples:\n"
+    "/query pending:withdraw\n"
+    "/query paid=false has:txid\n"
+    "/query lock_until>=now lock_until<+7d"
+)
+
+
+def _matches(actual, op: str, value) -> bool:
+    """None means "doesn't apply": it only compares with = / != (incl. none); mismatched types never match."""
+    if actual is None or value is None:
+        if op == "=":
+            return actual is value
+        return op == "!=" and actual is not value
+    try:
+        return _QUERY_OPS[op](actual, value)
+    except TypeError:
+        return False
+
+
+def parse_query(args: List[str]):
+    """Query words -> ([(field, op, value), ...], page). Raises ValueError on bad input."""
+    terms, page = [], 1
+    for word in args:
+        if word.startswith("page:"):
+            page = int(word[5:]) if word[5:].isdigit() else 0
+            if page < 1:
+                raise ValueError(f"bad page {word!r}")
+            continue
+        if word.startswith("pending:"):
+            kind = word[8:]
+            if kind not in ("withdraw", "investment", "any"):
+                raise ValueError(f"unknown pending kind {kind!r}")
+            terms.append(("has:pending" if kind == "any" else "has:pending_" + kind, "=", True))
+            continue
+        if word.startswith("has:") and _QUERY_TERM.match(word) is None:
+            if word not in QUERY_FIELDS:
+                raise ValueError(f"unknown field {word!r}")
+            terms.append((word, "=", True))
+            continue
+        m = _QUERY_TERM.match(word)
+        if not m or m.group(1) not in QUERY_FIELDS:
+            raise ValueError(f"can't parse {word!r}")
+        field, op, raw = m.groups()
+        value = None if raw == "none" else QUERY_FIELDS[field][1](raw)
+        if value is None and op not in ("=", "!="):
+            raise ValueError(f"{word!r}: none only works with = and !=")
+        terms.append((field, op, value))
+    if not terms:
+        raise ValueError("no filter terms")
+    return terms, page
+
+
+class FieldIndex:
+    """
+    Sorted (value, uid) pairs for one query field, so =, <, <=, >, >= are
+    a bisect plus a slice. None / zero / False values are not stored;
+    terms that would match them are filtered by scan instead.
+    """
+
+    def __init__(self, getter):
+        self.getter = getter
+        self.entries = _sorted_list()
+        self.values: Dict[str, Any] = {}
+
+    def build(self, data: Dict[str, UserRecord]):
+        self.values = {uid: v for uid, v in ((uid, self.getter(u)) for uid, u in data.items())
+                       if v is not None and v != 0}
+        self.entries = _sorted_list(sorted((v, uid) for uid, v in self.values.items()))
+
+    def update(self, user_id: str, user):
+        new = self.getter(user) if user is not None else None
+        if new is not None and new == 0:
+            new = None
+        old = self.values.get(user_id)
+        if old == new and type(old) is type(new):
+            return
+        if old is not None:
+            self.entries.remove((old, user_id))
+            del self.values[user_id]
+        if new is not None:
+            self.entries.add((new, user_id))
+            self.values[user_id] = new
+
+    @staticmethod
+    def usable(op: str, value) -> bool:
+        """True if no skipped value (None, 0/False) can satisfy the term."""
+        return value is not None and not _matches(None, op, value) and not _matches(0, op, value)
+
+    def select(self, op: str, value) -> List[str]:
+        e = self.entries
+        lo, hi = 0, len(e)
+        if op in ("=", ">="):
+            lo = e.bisect_left((value,))
+        elif op == ">":
+            lo = e.bisect_right((value, _MAX_KEY))
+        if op in ("=", "<="):
+            hi = e.bisect_right((value, _MAX_KEY))
+        elif op == "<":
+            hi = e.bisect_left((value,))
+        return [uid for _, uid in e[lo:hi]]
+
+
+class UserQueryIndex:
+    """
+    Secondary indexes over INDEXED_FIELDS, built on first use.
+    save_data(*ids) refreshes the changed users on every mutation. Bulk
+    changes (save_data() with no IDs) can't say what changed, so callers
+    name the affected fields with invalidate(fields) and the next query
+    rebuilds just those indexes.
+    """
+
+    def __init__(self, fields):
+        self.indexes = {f: FieldIndex(QUERY_FIELDS[f][0]) for f in fields}
+        self.stale = set(self.indexes)
+
+    def invalidate(self, fields=None):
+        self.stale.update(self.indexes if fields is None else set(fields) & self.indexes.keys())
+
+    def refresh(self, user_ids):
+        live = [index for f, index in self.indexes.items() if f not in self.stale]
+        for uid in user_ids:
+            user = users.get(uid)
+            for index in live:
+                index.update(uid, user)
+
+    def ensure(self):
+        for field in list(self.stale):
+            self.indexes[field].build(users)
+            self.stale.discard(field)
+
+
+query_index = UserQueryIndex(INDEXED_FIELDS)
+
+
+def run_query(terms, use_indexes: bool = True):
+    """
+    Matching user IDs (numeric order) and a short plan description. Terms
+    an index can answer are intersected smallest first; the rest filter
+    that candidate set, or every user if no term was indexable.
+    """
+    selected, residual = [], []
+    if use_indexes:
+        query_index.ensure()
+    for field, op, value in terms:
+        index = query_index.indexes.get(field) if use_indexes else None
+        if index is not None and FieldIndex.usable(op, value):
+            selected.append((index.select(op, value), f"{field}{op}{value}"))
+        else:
+            residual.append((QUERY_FIELDS[field][0], op, value, f"{field}{op}{value}"))
+    candidates = None
+    for ids, _ in sorted(selected, key=lambda s: len(s[0])):
+        candidates = set(ids) if candidates is None else candidates.intersection(ids)
+    pool = users.keys() if candidates is None else candidates
+    result = [
+        uid for uid in pool
+        if all(_matches(getter(users[uid]), op, value) for getter, op, value, _ in residual)
+    ]
+    result.sort(key=lambda uid: (len(uid), uid))
+    plan = []
+    if selected:
+        plan.append("index " + ", ".join(name for _, name in selected))
+    if residual:
+        plan.append(("filter " if selected else "scan ") + ", ".join(name for *_, name in residual))
+    return result, "; ".join(plan)
+
+
+def _query_row(uid: str, u) -> str:
+    parts = [uid, "paid" if u.get("paid") else "unpaid", f"bal {u.get('balance', 0.0):.2f}"]
+    inv = u.get("investment")
+    if inv:
+        parts.append(f"inv {inv.get('amount', 0.0):.2f} until {str(inv.get('lock_until'))[:10]}")
+    for kind in ("withdraw", "investment"):
+        pending = u.get("pending_" + kind)
+        if pending:
+            parts.append(f"⏳ {kind} {pending.get('amount', 0.0):.2f} since {str(pending.get('submitted_at'))[:10]}")
+    return " · ".join(parts)
+
+
+# -----------------------
+# TXID index
+# -----------------------
+TXID_SLOTS = {"txid": "membership", "pending_investment": "pending investment", "investment": "investment"}
+
+
+def normalize_txid(txid: str) -> str:
+    """Hashes are hex on the chains we take USDT on; ignore case and a 0x prefix."""
+    txid = txid.strip().lower()
+    return txid[2:] if txid.startswith("0x") else txid
+
+
+def _user_txids(user):
+    for slot in TXID_SLOTS:
+        value = user.get(slot)
+        if slot != "txid":
+            value = value.get("txid") if value else None
+        if value:
+            yield slot, normalize_txid(str(value))
+
+
+def retire_txid(user, slot: str):
+    """
+    Move the confirmed TXID in `slot` to the user's spent_txids before the
+    slot is overwritten, so it stays unusable after the record forgets it.
+    """
+    value = user.get(slot)
+    txid = value.get("txid") if slot != "txid" and value else value
+    if txid:
+        user["spent_txids"] = [*(user.get("spent_txids") or ()), [slot, normalize_txid(str(txid))]]
+
+
+def _confirmed(slot: str, user) -> bool:
+    return slot == "investment" or (slot == "txid" and bool(user.get("paid")))
+
+
+def _txid_entries(user) -> frozenset:
+    """(slot, txid, state) per TXID on the record: state True confirmed, False pending, None retired."""
+    entries = {(slot, txid, _confirmed(slot, user)) for slot, txid in _user_txids(user)}
+    entries.update((slot, txid, None) for slot, txid in user.get("spent_txids") or ())
+    return frozenset(entries)
+
+
+class TxidIndex:
+    """
+    Every TXID on record (membership, pending and confirmed investment) ->
+    the (user_id, slot) pairs holding it, so duplicate checks are a dict
+    lookup. Built at load and refreshed by save_data() for changed users.
+
+    Confirmed TXIDs, including retired ones from spent_txids, also go to
+    `spent`, which refreshes only ever add to: a TXID stays taken after the
+    slot that held it is overwritten.
+
+    In multi-process mode a worker indexes only the TXIDs it owns (see
+    txid_worker), for every user: the front seeds them at startup and
+    workers send their users' changes to the owner (the "txid" op).
+    """
+
+    def __init__(self):
+        self.owners: Dict[str, set] = {}
+        self.by_user: Dict[str, frozenset] = {}
+        self.spent: Dict[str, tuple] = {}  # txid -> first (user_id, slot) it was confirmed in
+        self.outgoing: Dict[int, list] = {}  # worker -> changes to TXIDs it owns, not sent yet
+
+    def build(self, data):
+        self.owners.clear()
+        self.by_user.clear()
+        self.spent.clear()
+        for uid, user in data.items():
+            self.update(uid, user, send=False)
+        dupes = sum(1 for holders in self.owners.values() if len({uid for uid, _ in holders}) > 1)
+        if dupes:
+            logger.warning("⚠️ %d TXIDs are shared by more than one user.", dupes)
+
+    def seed(self, owners: Dict[str, set], spent: Dict[str, tuple]):
+        """Merge in the front's startup index of the TXIDs this worker owns."""
+        for txid, holders in owners.items():
+            self.owners.setdefault(txid, set()).update(holders)
+        for txid, holder in spent.items():
+            self.spent.setdefault(txid, holder)
+
+    def update(self, uid: str, user, send: bool = True):
+        old = self.by_user.pop(uid, frozenset())
+        new = _txid_entries(user) if user is not None else frozenset()
+        if new:
+            self.by_user[uid] = new
+        if old == new:
+            return
+        changes: Dict[str, tuple] = {}
+        for entry in old - new:
+            changes.setdefault(entry[1], ([], []))[0].append(entry)
+        for entry in new - old:
+            changes.setdefault(entry[1], ([], []))[1].append(entry)
+        for txid, (removed, added) in changes.items():
+            if owns_txid(txid):
+                self.apply(txid, uid, removed, added)
+            elif send:
+                self.outgoing.setdefault(txid_worker(txid), []).append((txid, uid, removed, added))
+
+    def apply(self, txid: str, uid: str, removed, added):
+        holders = self.owners.setdefault(txid, set())
+        for slot, _, state in removed:
+            if state is not None:
+                holders.discard((uid, slot))
+        for slot, _, state in added:
+            if state is not None:
+                holders.add((uid, slot))
+            if state is not False:
+                self.spent.setdefault(txid, (uid, slot))
+        if not holders:
+            del self.owners[txid]
+
+    def refresh(self, user_ids):
+        for uid in user_ids:
+            self.update(uid, users.get(uid))
+        if self.outgoing and shard_link.conn is not None:
+            for batch in self.outgoing.values():  # one message per owning worker
+                shard_link.cast("txid", batch[0][0], batch)
+            self.outgoing.clear()
+
+    def conflicts(self, txid: str, user_id: str, slot: str) -> List[tuple]:
+        """
+        Holders of `txid` other than `user_id`'s own `slot`, i.e. anything
+        that makes a new submission a duplicate. Resubmitting the same TXID
+        into the same slot (after a rejection, say) is allowed.
+        """
+        txid = normalize_txid(txid)
+        holders = set(self.owners.get(txid, ()))
+        if txid in self.spent:
+            holders.add(self.spent[txid])
+        return sorted(h for h in holders if h != (user_id, slot))
+
+    def claim(self, txid: str, user_id: str, slot: str) -> List[tuple]:
+        """conflicts(), and if there are none, hold the TXID for `user_id`'s `slot` until their save lands."""
+        holders = self.conflicts(txid, user_id, slot)
+        if not holders:
+            self.owners.setdefault(normalize_txid(txid), set()).add((user_id, slot))
+        return holders
+
+
+txid_index = TxidIndex()
+txid_index.build(users)
+
+
+def duplicate_txid_text(holders) -> str:
+    return ", ".join(f"user {uid} ({TXID_SLOTS[slot]})" for uid, slot in holders)
+
+
+def shared_txid_note(txid: Optional[str], user_id: str, slot: str) -> str:
+    """Warning line for admin messages when a TXID recorded before the index existed is shared."""
+    holders = txid_index.conflicts(txid, user_id, slot) if txid else []
+    return f"\n⚠️ TXID also used by {duplicate_txid_text(holders)}" if holders else ""
+
+
+# -----------------------
+# Referral downline
+# -----------------------
+# Every user carries aggregates over their whole downline (everyone below
+# them in the referral tree): team_size, team_paid, team_volume (confirmed
+# investment amounts) and team_depth (levels below them). Events update
+# the ancestor chain, so reading them is O(1).
+def update_downline(user_id: str, members: int = 0, paid: int = 0, volume: float = 0.0) -> List[str]:
+    """
+    Add a new member / a newly paid member / confirmed investment volume
+    of `user_id` to every ancestor's aggregates. Returns the ancestor IDs
+    (to save).
+    """
+    user = users.get(user_id)
+    return climb_downline(user.get("referrer") if user else None, 1, members, paid, volume, {user_id})
+
+
+def climb_downline(uid: Optional[str], distance: int, members: int, paid: int, volume: float,
+                   seen: Optional[set] = None) -> List[str]:
+    """
+    Apply an update_downline() change to `uid`, `distance` levels above the
+    member, and on up its referrer chain. In multi-process mode the rest of
+    the climb is handed to the owning worker once the chain leaves this one.
+    """
+    seen = seen or set()
+    touched = []
+    while uid and uid not in seen:
+        if not owns(uid):
+            shard_link.cast("downline", uid, distance, members, paid, volume)
+            break
+        ancestor = users.get(uid)
+        if ancestor is None:
+            break
+        seen.add(uid)
+        if members:
+            ancestor["team_size"] += members
+            if distance > ancestor["team_depth"]:
+                ancestor["team_depth"] = distance
+        if paid:
+            ancestor["team_paid"] += paid
+        if volume:
+            ancestor["team_volume"] += volume
+        touched.append(uid)
+        uid = ancestor.get("referrer")
+        distance += 1
+    return touched
+
+
+def build_downline(data: Dict[str, UserRecord]):
+    """
+    Compute every user's downline aggregates from scratch in O(n): users
+    are visited deepest first and each one's totals are folded into its
+    referrer's.
+    """
+    depth: Dict[str, int] = {}
+    for uid in data:
+        chain = []
+        while uid in data and uid not in depth and uid not in chain:
+            chain.append(uid)
+            uid = data[uid].get("referrer")
+        d = depth.get(uid, -1)
+        for node in reversed(chain):
+            d += 1
+            depth[node] = d
+    for user in data.values():
+        user["team_size"] = user["team_paid"] = user["team_depth"] = 0
+        user["team_volume"] = 0.0
+    for uid in sorted(data, key=depth.__getitem__, reverse=True):
+        user = data[uid]
+        parent = data.get(user.get("referrer"))
+        if parent is None or parent is user:
+            continue
+        inv = user.get("investment")
+        parent["team_size"] += 1 + user["team_size"]
+        parent["team_paid"] += int(bool(user.get("paid"))) + user["team_paid"]
+        parent["team_volume"] += (inv.get("amount", 0.0) if inv else 0.0) + user["team_volume"]
+        parent["team_depth"] = max(parent["team_depth"], 1 + user["team_depth"])
+
+
+if not WORKERS and not meta.get("downline_built"):  # workers: prepare_shards() builds them
+    build_downline(users)
+    save_data()
+    meta["downline_built"] = True
+    save_meta()
+    logger.info("Built referral downline aggregates for %d users", len(users))
+
+
+# -----------------------
+# Leaderboards
+# -----------------------
+class Leaderboard:
+    """
+    Users ranked by one score, kept as (-score, uid) in a sorted list so
+    top(k) and rank(uid) are O(k + log n) / O(log n). Only positive scores
+    are ranked. update() must be called whenever a user's score may have
+    changed.
+    """
+
+    def __init__(self, title: str, score):
+        self.title = title
+        self.score = score
+        self.entries = _sorted_list()
+        self.scores: Dict[str, float] = {}
+
+    def build(self, data: Dict[str, UserRecord]):
+        self.scores = {uid: s for uid, s in ((uid, self.score(u)) for uid, u in data.items()) if s > 0}
+        self.entries = _sorted_list(sorted((-s, uid) for uid, s in self.scores.items()))
+
+    def update(self, user_id: str, user):
+        new = self.score(user) if user is not None else 0.0
+        old = self.scores.get(user_id)
+        if new == old or (old is None and new <= 0):
+            return
+        if old is not None:
+            self.entries.remove((-old, user_id))
+            del self.scores[user_id]
+        if new > 0:
+            self.entries.add((-new, user_id))
+            self.scores[user_id] = new
+
+    def top(self, k: int = 10):
+        return [(uid, -neg) for neg, uid in islice(self.entries, k)]
+
+    def rank(self, user_id: str) -> Optional[int]:
+        """1-based rank (ties share a rank), or None if unranked."""
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return self.entries.bisect_left((-score, "")) + 1
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _active_investment(user) -> float:
+    inv = user.get("investment")
+    return inv.get("amount", 0.0) if inv and inv.get("active") else 0.0
+
+
+LEADERBOARDS = {
+    "referrers": Leaderboard("💸 Top Referrers (earned)", lambda u: u.get("earned_from_referrals", 0.0)),
+    "direct": Leaderboard("🤝 Top Direct Bonuses", lambda u: u.get("direct_bonus_total", 0.0)),
+    "investors": Leaderboard("💹 Top Investors (active)", _active_investment),
+}
+for _board in LEADERBOARDS.values():
+    _board.build(users)
+
+
+def update_rankings(user_id: str):
+    """Re-rank a user whose bonuses or investment changed."""
+    user = users.get(user_id)
+    for board in LEADERBOARDS.values():
+        board.update(user_id, user)
+
+
+def leaderboard_text(board: Leaderboard, k: int = 10, user_id: Optional[str] = None, mask: bool = True) -> str:
+    """Top-k lines plus the user's own rank; public views show only the last 4 digits of IDs."""
+    lines = [f"*{board.title}*"]
+    for i, (uid, score) in enumerate(board.top(k), start=1):
+        lines.append(f"{i}. {'…' + uid[-4:] if mask else uid} — {score:.2f} USDT")
+    if len(lines) == 1:
+        lines.append("No entries yet.")
+    if user_id is not None:
+        rank = board.rank(user_id)
+        lines.append(f"Your rank: #{rank} of {len(board)}" if rank else "Your rank: not ranked yet")
+    return "\n".join(lines)
+
+
+class MergedBoard:
+    """
+    A leaderboard put together from every worker's part in multi-process
+    mode: each sends its top k, its size and how many of its users score
+    above `user_id`. Reads like a Leaderboard for leaderboard_text().
+    """
+
+    def __init__(self, board: Leaderboard, k: int, user_id: Optional[str], parts):
+        self.title = board.title
+        self.entries = sorted((e for top, _, _ in parts for e in top), key=lambda e: (-e[1], e[0]))[:k]
+        self.total = sum(size for _, size, _ in parts)
+        self.above = sum(above for _, _, above in parts)
+        self.ranked = user_id in board.scores
+
+    def top(self, k: int = 10):
+        return self.entries[:k]
+
+    def rank(self, user_id: str) -> Optional[int]:
+        return self.above + 1 if self.ranked else None
+
+    def __len__(self):
+        return self.total
+
+
+async def leaderboard_view(name: str, k: int = 10, user_id: Optional[str] = None):
+    """LEADERBOARDS[name], or in multi-process mode its merge over every worker."""
+    board = LEADERBOARDS[name]
+    if not WORKERS:
+        return board
+    parts = await shard_link.call_all("board", name, k, board.scores.get(user_id))
+    return MergedBoard(board, k, user_id, [part for part in parts if part])  # None: that worker failed
+
+
+class InvestmentColumns:
+    """
+    Columnar copy of every user's investment, kept in NumPy arrays so
+    distribute_daily_profit() is one masked vector operation instead of a
+    walk over all user dicts.
+
+    Row i describes users[uids[i]]: amount, start time and accrued_through
+    watermark (epoch microseconds, parsed once when the row is written) and
+    an active flag. Rows are updated through upsert() whenever an
+    investment is (re)confirmed.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.uids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.amount = np.zeros(capacity, dtype=np.float64)
+        self.start_us = np.zeros(capacity, dtype=np.int64)
+        self.through_us = np.zeros(capacity, dtype=np.int64)
+        self.active = np.zeros(capacity, dtype=bool)
+
+    @classmethod
+    def build(cls, data: Dict[str, Dict[str, Any]]) -> "InvestmentColumns":
+        cols = cls(max(1024, len(data)))
+        for uid, user in data.items():
+            if user.get("investment"):
+                cols.upsert(uid, user["investment"])
+        return cols
+
+    def upsert(self, uid: str, invest: Optional[Dict[str, Any]]):
+        row = self.rows.get(uid)
+        if row is None:
+            row = len(self.uids)
+            if row == len(self.amount):
+                self._grow()
+            self.uids.append(uid)
+            self.rows[uid] = row
+        active = bool(invest and invest.get("active") and invest.get("start_date"))
+        start_us = through_us = 0
+        if active:
+            try:
+                start_us = _epoch_us(datetime.fromisoformat(invest["start_date"]))
+                through = invest.get("accrued_through")
+                through_us = _epoch_us(datetime.fromisoformat(through)) if through else start_us
+            except Exception:
+                # legacy or invalid format — never credited
+                logger.warning("Invalid start_date for user %s", uid)
+                active = False
+        self.amount[row] = invest["amount"] if active else 0.0
+        self.start_us[row] = start_us
+        self.through_us[row] = through_us
+        self.active[row] = active
+
+    def _grow(self):
+        size = len(self.amount) * 2
+        self.amount = np.resize(self.amount, size)
+        self.start_us = np.resize(self.start_us, size)
+        self.through_us = np.resize(self.through_us, size)
+        self.active = np.resize(self.active, size)
+
+    def due(self, now: datetime):
+        """
+        Rows whose investment day containing `now` is inside the lock window
+        and not paid yet, their profit, and the watermark paying that day
+        moves them to (the end of the day).
+        """
+        n = len(self.uids)
+        start_us = self.start_us[:n]
+        day = (_epoch_us(now) - start_us) // _DAY_US
+        mask = self.active[:n] & (day < INVEST_LOCK_DAYS) & (self.through_us[:n] <= start_us + day * _DAY_US)
+        rows = np.flatnonzero(mask)
+        return rows, self.amount[rows] * DAILY_PROFIT_RATE, start_us[rows] + (day[rows] + 1) * _DAY_US
+
+
+invest_columns: Optional[InvestmentColumns] = None
+
+
+def track_investment(user_id: str):
+    """Refresh the columnar row for a user whose investment changed."""
+    if invest_columns is not None:
+        invest_columns.upsert(user_id, users.get(user_id, {}).get("investment"))
+
+
+def _distribute_columnar(now: datetime) -> int:
+    global invest_columns
+    if invest_columns is None:
+        invest_columns = InvestmentColumns.build(users)
+    rows, profit, through = invest_columns.due(now)
+    uids = invest_columns.uids
+    paid = [(uid, users[uid]) for uid in map(uids.__getitem__, rows.tolist())]
+    ledger.post_many("profit", ((uid, user, amount) for (uid, user), amount in zip(paid, profit.tolist())),
+                     ts=now.isoformat())
+    for (_, user), through_us in zip(paid, through.tolist()):
+        user["investment"]["accrued_through"] = through_us  # InvestmentRecord keeps epoch microseconds as-is
+    invest_columns.through_us[rows] = through
+    return len(rows)
+
+
+def _distribute_per_user(now: datetime) -> int:
+    distributed_count = 0
+    ts = now.isoformat()
+    for uid, user in users.items():
+        invest = user.get("investment")
+        if invest and invest.get("active") and invest.get("start_date"):
+            try:
+                start = datetime.fromisoformat(invest["start_date"])
+                through = datetime.fromisoformat(invest["accrued_through"]) if invest.get("accrued_through") else start
+            except Exception:
+                # legacy or invalid format — skip
+                logger.warning("Invalid start_date for user %s", uid)
+                continue
+            day = (now - start) // _DAY
+            if day < INVEST_LOCK_DAYS and through <= start + day * _DAY:
+                profit = invest["amount"] * DAILY_PROFIT_RATE
+                ledger.post(uid, user, "profit", profit, ts=ts)
+                invest["accrued_through"] = (start + (day + 1) * _DAY).isoformat()
+                distributed_count += 1
+    return distributed_count
+
+
+def accrue_profit(user_id: str, user, now: Optional[datetime] = None) -> float:
+    """
+    Credit the whole days of profit an active investment has earned since
+    its accrued_through watermark (start_date if unset), counting days up
+    to lock_until, and move the watermark. Returns the amount credited;
+    the caller saves.
+    """
+    inv = user.get("investment") if user else None
+    if not inv or not inv.get("active") or not inv.get("start_date"):
+        return 0.0
+    try:
+        start = datetime.fromisoformat(inv["start_date"])
+        end = datetime.fromisoformat(inv["lock_until"]) if inv.get("lock_until") else start + INVEST_LOCK_DAYS * _DAY
+        through = datetime.fromisoformat(inv["accrued_through"]) if inv.get("accrued_through") else start
+    except Exception:
+        logger.warning("Invalid investment dates for user %s", user_id)
+        return 0.0
+    now = now or datetime.utcnow()
+    earned = (min(now, end) - start) // _DAY
+    days = earned - (through - start) // _DAY
+    if days <= 0:
+        return 0.0
+    amount = inv["amount"] * DAILY_PROFIT_RATE * days
+    ledger.post(user_id, user, "profit", amount, ts=now.isoformat())
+    inv["accrued_through"] = (start + earned * _DAY).isoformat()
+    return amount
+
+
+def realize_profit(user_id: str, user) -> bool:
+    """
+    In lazy accrual mode, credit what the user's investment has earned so
+    far before their balance is shown or withdrawn. Call under the user's
+    lock; saves if anything was credited.
+    """
+    if ACCRUAL_MODE != "lazy" or not accrue_profit(user_id, user):
+        return False
+    save_data(user_id)
+    return True
+
+
+def distribute_daily_profit():
+    """
+    Add DAILY_PROFIT_RATE * invested_amount to each qualifying investor's balance.
+    Uses the NumPy column store when available, else walks every user.
+    In lazy accrual mode it instead credits every investor's accrued profit.
+    Returns number of investors credited.
+    """
+    now = datetime.utcnow()
+    if ACCRUAL_MODE == "lazy":
+        distributed_count = sum(1 for uid, user in users.items() if accrue_profit(uid, user, now))
+    elif np is not None:
+        distributed_count = _distribute_columnar(now)
+    else:
+        distributed_count = _distribute_per_user(now)
+    query_index.invalidate(("balance",))
+    save_data()
+    logger.info("💹 Distributed daily profit to %d investors.", distributed_count)
+    return distributed_count
+
+
+# -----------------------
+# Per-user locks
+# -----------------------
+class UserLocks:
+    """
+    One asyncio.Lock per user ID, created on first use. Locks are held in
+    a WeakValueDictionary, so a lock lives only while some update holds or
+    waits for it and memory stays bounded by the updates in flight, not by
+    the number of users.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def get(self, user_id) -> asyncio.Lock:
+        key = str(user_id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, *user_ids):
+        """
+        Lock every given user (None is ignored) for the duration of the
+        block. Locks are taken in sorted order, so updates touching the
+        same users (a user and their referrer) cannot deadlock.
+        """
+        locks = [self.get(uid) for uid in sorted({str(uid) for uid in user_ids if uid is not None})]
+        async with AsyncExitStack() as stack:
+            for lock in locks:
+                await stack.enter_async_context(lock)
+            yield
+
+    def __len__(self):
+        return len(self._locks)
+
+
+user_locks = UserLocks()
+
+
+# -----------------------
+# Menu utilities (NO admin buttons)
+# -----------------------
+def build_main_menu():
+    """
+    Returns InlineKeyboardMarkup for the main menu. No admin buttons included.
+    Markups are immutable, so the result is built once (MAIN_MENU) and shared.
+    """
+    keyboard = [
+        [InlineKeyboardButton("💰 Balance", callback_data="menu:balance"),
+         InlineKeyboardButton("💸 Invest", callback_data="menu:invest")],
+        [InlineKeyboardButton("👥 Referrals", callback_data="menu:referral"),
+         InlineKeyboardButton("💎 FAQ", callback_data="menu:faq")],
+        [InlineKeyboardButton("🏦 Withdraw", callback_data="menu:withdraw"),
+         InlineKeyboardButton("❓ Help", callback_data="menu:help")],
+        [InlineKeyboardButton("🏆 Top 10", callback_data="menu:top")],
+        [InlineKeyboardButton("🌟 Join Premium", callback_data="join_premium")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+MAIN_MENU = build_main_menu()
+JOIN_PREMIUM_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("💎 Join Premium Group", url=PREMIUM_GROUP)]]
+)
+
+
+# -----------------------
+# Static texts (rendered once at import; handlers only fill per-user slots)
+# -----------------------
+_BENEFITS_LINES = (
+    "🚀 Early access to coins before they pump\n"
+    "📊 Buy & Sell targets guidance\n"
+    "📈 2–5 Daily Signals\n"
+    "🤖 Auto Trading by Bot\n"
+    "💎 Premium Channel Only:\n"
+    " 🚀 1–3 Special Signals Daily (coins that pump within 24 h)\n\n"
+    "💳 𝟏-𝐌𝐨𝐧𝐭𝐡 𝐏𝐫𝐞𝐦𝐢𝐮𝐦: 𝟓𝟎 𝐔𝐒𝐃𝐓\n\n"
+)
+_PAY_INSTRUCTIONS = (
+    "💰 To access, pay USDT (BEP20) to this address:\n"
+    f"`{BNB_ADDRESS}`\n\n"
+    "After payment submit TXID type: `/pay <TXID>`\n\n"
+    "🔗 Your referral link:\n"
+)
+# + referral link
+START_TEXT_PREFIX = (
+    "💼 𝙋𝙧𝙚𝙢𝙞𝙪𝙢 𝙑𝙄𝙋 𝙈𝙚𝙢𝙗𝙚𝙧𝙨𝙝𝙞𝙥\n\n"
+    "👑 *Lifetime Membership Fee:*\n"
+    "💰 𝟓𝟎𝟎 𝐔𝐒𝐃𝐓 (𝐃𝐢𝐬𝐜𝐨𝐮𝐧𝐭𝐞𝐝 𝐏𝐫𝐢𝐜𝐞) — 𝐎𝐧𝐥𝐲 𝟐 𝐒𝐥𝐨𝐭𝐬 𝐋𝐞𝐟𝐭!\n"
+    "_🪙 Original Price: 1000 USDT (Lifetime)_\n\n"
+    "_🔥 Benefits:_\n"
+    + _BENEFITS_LINES
+    + _PAY_INSTRUCTIONS
+)
+# + referral link
+PREMIUM_TEXT_PREFIX = (
+    "💼 𝙋𝙧𝙚𝙢𝙞𝙪𝙢 𝙑𝙄𝙋 𝙈𝙚𝙢𝙗𝙚𝙧𝙨𝙝𝙞𝙥\n\n"
+    "👑 Lifetime Membership Fee:\n"
+    "💰 𝟓𝟎𝟎 𝐔𝐒𝐃𝐓 (𝐃𝐢𝐬𝐜𝐨𝐮𝐧𝐭𝐞𝐝 𝐏𝐫𝐢𝐜𝐞) — 𝐎𝐧𝐥𝐲 𝟐 𝐒𝐥𝐨𝐭𝐬 𝐋𝐞𝐟𝐭!\n"
+    "🪙 Original Price: 1000 USDT (Lifetime)\n\n"
+    "🔥 Benefits:\n"
+    + _BENEFITS_LINES
+    + _PAY_INSTRUCTIONS
+)
+HELP_TEXT = (
+    "🤖 *Available Commands*\n\n"
+    "💬 General:\n"
+    "• /start - Register & get your referral link\n"
+    "• /faq - Learn how investing & referrals work\n"
+    "• /help - Show this menu\n"
+    "• /referral - Show your referral link\n\n"
+    "💰 Account & Earnings:\n"
+    "• /pay <TXID> - Submit membership payment\n"
+    "• /invest <amount> <TXID> - Submit investment (min 50 USDT)\n"
+    "• /balance - View your current balance & investment info\n"
+    "• /stats - View referrals, earnings, and status\n"
+    "• /withdraw <wallet> - Request withdrawal (min 20 USDT)\n\n"
+    "💸 Referral Bonuses:\n"
+    f"• Direct Bonus: {DIRECT_BONUS} USDT\n"
+    f"• Pairing Bonus: {PAIRING_BONUS} USDT (per pair, max {MAX_PAIRS_PER_DAY}/day)\n"
+)
+FAQ_TEXT = (
+    "💡 *FAQ - Auto-Trading & Investments*\n\n"
+    f"• Minimum investment: *{INVEST_MIN} USDT*\n"
+    f"• Deposit to BEP20 address: `{BNB_ADDRESS}`\n"
+    f"• Direct bonus: *{DIRECT_BONUS} USDT*\n"
+    f"• Pairing bonus: *{PAIRING_BONUS} USDT*\n"
+    f"• Investment lock: *{INVEST_LOCK_DAYS} days*\n"
+    "• Daily profit: *1%* added to balance\n"
+    f"• Minimum withdraw: *{MIN_WITHDRAW} USDT*\n"
+)
+INVEST_TEXT = (
+    "💼 *Investment Instructions*\n\n"
+    "💰 *Minimum Investment:* 50 USDT (BEP20)\n"
+    "📈 Earn daily returns and referral rewards.\n\n"
+    "💳 *Payment Address (BEP20):*\n"
+    f"`{BNB_ADDRESS}`\n\n"
+    "📤 *How to Invest:*\n"
+    "1️⃣ Send your USDT to the address above.\n"
+    "2️⃣ Submit your TXID using:\n"
+    "`/invest <amount> <TXID>`\n"
+    "3️⃣ Your *initial investment* will be *locked for 30 days*.\n"
+    " 💹 It will generate *1% daily profit*, which will be added automatically to your balance.\n\n"
+    "⏱️ Once confirmed, your balance updates automatically."
+)
+WITHDRAW_TEXT = (
+    f"🏦 To request withdrawal, type:\n`/withdraw <your_wallet_address>`\n\n"
+    f"💵 Minimum withdrawal: *{MIN_WITHDRAW} USDT*"
+)
+MENU_HELP_TEXT = (
+    "❓ *Help Menu*\n\n"
+    "Use the buttons to navigate:\n"
+    "💰 Balance — View your balance & investment\n"
+    "💸 Invest — Submit new investment\n"
+    "👥 Referral — Your referral link\n"
+    "💎 FAQ — Info about bonuses and rules\n"
+    "🏦 Withdraw — How to withdraw funds"
+)
+PAY_USAGE_TEXT = (
+    "Usage: /pay <TXID>\n\n"
+    f"Send *{MEMBERSHIP_FEE} USDT* (BEP20) to:\n`{BNB_ADDRESS}`\nThen submit: `/pay <TXID>`"
+)
+INVEST_USAGE_TEXT = f"💹 Usage: /invest <amount> <TXID>\nMinimum: {INVEST_MIN} USDT\nDeposit to: `{BNB_ADDRESS}`"
+WITHDRAW_USAGE_TEXT = f"Usage: /withdraw <wallet_address>\nMinimum: {MIN_WITHDRAW} USDT"
+
+
+def referral_link(bot_username: str, user_id) -> str:
+    return f"https://t.me/{bot_username}?start={user_id}"
+
+
+# -----------------------
+# Command Handlers
+# -----------------------
+def link_referrer(user_id: str, ref: Optional[str], found: bool, adopted: List[str]):
+    """Finish registering a new user once their referrer has (or hasn't) adopted them."""
+    if found:
+        users[user_id]["referrer"] = ref
+    save_data(user_id, *adopted, *update_downline(user_id, members=1))
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    user_id = str(user.id)
+    # If start param is given (referral), set if valid
+    ref = context.args[0] if context.args and context.args[0] != user_id else None
+    remote = ref is not None and not owns(ref)
+    # Register user if not exists
+    async with user_locks.hold(user_id, None if remote else ref):
+        created = user_id not in users
+        if created:
+            users[user_id] = UserRecord.from_dict({
+                "referrer": None,
+                "balance": 0.0,
+                "earned_from_referrals": 0.0,
+                "left": 0,
+                "right": 0,
+                "referrals": [],
+                "paid": False,
+                "txid": None,
+                "pending_investment": None,
+                "investment": None,
+                "pending_withdraw": None,
+                "membership_referrer_rewarded": False,
+                "direct_bonus_total": 0.0,
+                "pairing_bonus_total": 0.0,
+            })
+            if not remote:
+                found, adopted = await on_owner("adopt", ref, user_id) if ref else (False, [])
+                link_referrer(user_id, ref, found, adopted)
+            else:
+                joining.add(user_id)
+    if created and remote:
+        # the referrer's worker is asked without holding our lock: two new users
+        # naming each other on different workers would otherwise wait on each other
+        try:
+            found, adopted = await on_owner("adopt", ref, user_id)
+        except asyncio.TimeoutError:
+            logger.error("Worker %d didn't answer - %s joins without referrer %s", worker_of(ref), user_id, ref)
+            found, adopted = False, []
+        async with user_locks.hold(user_id):
+            link_referrer(user_id, ref, found, adopted)
+            joining.discard(user_id)
+
+    # BNB address shown in monospace
+    await update.message.reply_text(
+        START_TEXT_PREFIX + referral_link(context.bot.username, user_id),
+        parse_mode="Markdown",
+        reply_markup=MAIN_MENU,
+    )
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message:
+        await update.message.reply_text(HELP_TEXT, parse_mode="Markdown", reply_markup=MAIN_MENU)
+    else:
+        await context.bot.send_message(chat_id=update.effective_user.id, text=HELP_TEXT, parse_mode="Markdown")
+
+
+async def faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(FAQ_TEXT, parse_mode="Markdown", reply_markup=MAIN_MENU)
+
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    premium_text = PREMIUM_TEXT_PREFIX + referral_link(context.bot.username, query.from_user.id)
+
+    # Use the same inline keyboard layout already shown in the menu
+    await query.message.edit_text(
+        text=premium_text,
+        parse_mode="Markdown",
+        reply_markup=query.message.reply_markup  # reuse same buttons layout
+    )
+    
+    
+async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    link = referral_link(context.bot.username, update.effective_user.id)
+    await update.message.reply_text(f"🔗 Your referral link:\n{link}", reply_markup=MAIN_MENU)
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats: read straight from the user's ledger rollups."""
+    user_id = str(update.effective_user.id)
+    user = users.get(user_id)
+    if not user:
+        await update.message.reply_text("❌ You are not registered yet. Use /start first.")
+        return
+    async with user_locks.hold(user_id):
+        realize_profit(user_id, user)
+    inv = user.get("investment")
+    inv_text = f"{inv['amount']:.2f} USDT (active)" if inv and inv.get("active") else "None"
+    await update.message.reply_text(
+        f"📊 *Your Stats*\n\n"
+        f"👥 Referrals: {len(user['referrals'])}\n"
+        f"✅ Membership: {'Paid' if user.get('paid') else 'Not paid'}\n"
+        f"💹 Investment: {inv_text}\n\n"
+        f"💸 *Earnings*\n"
+        f"• Direct bonuses: {user['direct_bonus_total']:.2f} USDT\n"
+        f"• Pairing bonuses: {user['pairing_bonus_total']:.2f} USDT\n"
+        f"• Investment profit: {user['profit_total']:.2f} USDT\n"
+        f"• Withdrawn: {user['withdrawn_total']:.2f} USDT\n\n"
+        f"💰 Balance: {user['balance']:.2f} USDT",
+        parse_mode="Markdown",
+        reply_markup=MAIN_MENU,
+    )
+
+
+# -----------------------
+# Payment flow (user submits)
+# -----------------------
+async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        await update.message.reply_text(
+            PAY_USAGE_TEXT,
+            parse_mode="Markdown",
+            reply_markup=MAIN_MENU,
+        )
+        return
+    txid = context.args[0]
+    async with user_locks.hold(user_id):
+        # the TXID's worker takes no user locks, so waiting on it here can't deadlock
+        duplicates = await claim_txid(txid, user_id, "txid")
+        if duplicates == []:
+            user = users.setdefault(user_id, UserRecord())
+            if user.get("paid") and user.get("txid") and normalize_txid(user["txid"]) != normalize_txid(txid):
+                retire_txid(user, "txid")
+            user["txid"] = txid
+            save_data(user_id)
+    if duplicates is None:
+        return await update.message.reply_text(TXID_CHECK_FAILED_TEXT)
+    if duplicates:
+        await reject_duplicate_txid(update, context, txid, duplicates, "membership payment")
+        return
+
+    keyboard = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "✅ Confirm Payment", callback_data=f"confirm_pay:{user_id}"
+                ),
+                InlineKeyboardButton(
+                    "❌ Reject Payment", callback_data=f"reject_pay:{user_id}"
+                ),
+            ]
+        ]
+    )
+
+    outbox.send(
+        chat_id=ADMIN_ID,
+        text=(
+            f"💳 *New Membership Payment Submitted*\n\n"
+            f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
+            f"🔗 TXID: `{txid}`\n"
+        ),
+        parse_mode="Markdown",
+        reply_markup=keyboard,
+    )
+
+    await update.message.reply_text(
+        "✅ TXID submitted. Admin will verify your payment soon.", parse_mode="Markdown", reply_markup=MAIN_MENU
+    )
+
+
+TXID_CHECK_FAILED_TEXT = "⚠️ Couldn't check this TXID right now. Please send it again in a minute."
+
+
+async def reject_duplicate_txid(update: Update, context: ContextTypes.DEFAULT_TYPE, txid: str, holders, what: str):
+    """Turn away a submission whose TXID is already on record, and flag it to the admin."""
+    user_id = update.effective_user.id
+    logger.warning("Duplicate TXID %s from user %s (already held by %s)", txid, user_id, holders)
+    outbox.send(
+        chat_id=ADMIN_ID,
+        text=(
+            f"⚠️ *Duplicate TXID rejected*\n\n"
+            f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
+            f"📝 Tried: {what}\n"
+            f"🔗 TXID: `{txid}`\n"
+            f"📌 Already used by: {duplicate_txid_text(holders)}"
+        ),
+        parse_mode="Markdown",
+    )
+    await update.message.reply_text(
+        "❌ This TXID has already been submitted. Each payment can only be used once.\n"
+        "If you believe this is an error, please contact the admin.",
+        reply_markup=MAIN_MENU,
+    )
+
+
+async def confirm_payment_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Admin-only command: /confirm <user_id>
+    """
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if not context.args:
+        await update.message.reply_text("Usage: /confirm <user_id>")
+        return
+    target = context.args[0]
+    async with user_locks.hold(target, users.get(target, {}).get("referrer")):
+        u = users.get(target)
+        if not u:
+            await update.message.reply_text("❌ User not found.")
+            return
+        if u.get("paid"):
+            await update.message.reply_text("✅ User already confirmed.")
+            return
+        # confirm
+        u["paid"] = True
+        team = update_downline(target, paid=1)
+        # mark membership_referrer_rewarded to avoid double-crediting via callback later
+        if not u.get("membership_referrer_rewarded"):
+            ref = u.get("referrer")
+            if ref:
+                add_referral_bonus(ref, "membership", target)
+                u["membership_referrer_rewarded"] = True
+        save_data(target, u.get("referrer"), *team)
+    # send premium join button to user
+    outbox.send(
+        chat_id=int(target),
+        text="✅ Your membership payment has been confirmed! Welcome to premium.",
+        reply_markup=JOIN_PREMIUM_KEYBOARD,
+    )
+    await update.message.reply_text(f"✅ User {target} marked as paid and referral bonuses processed.")
+
+
+# -----------------------
+# Investment submission (user)
+# -----------------------
+async def invest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if len(context.args) < 2:
+        await update.message.reply_text(
+            INVEST_USAGE_TEXT,
+            parse_mode="Markdown",
+            reply_markup=MAIN_MENU,
+        )
+        return
+    try:
+        amount = float(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Invalid amount.")
+        return
+    if amount < INVEST_MIN:
+        await update.message.reply_text(f"❌ Minimum investment is {INVEST_MIN} USDT.")
+        return
+    txid = context.args[1]
+
+    async with user_locks.hold(user_id):
+        duplicates = await claim_txid(txid, user_id, "pending_investment")
+        if duplicates == []:
+            users.setdefault(user_id, UserRecord())
+            users[user_id]["pending_investment"] = {
+                "amount": amount,
+                "txid": txid,
+                "submitted_at": datetime.utcnow().isoformat(),
+            }
+            save_data(user_id)
+    if duplicates is None:
+        return await update.message.reply_text(TXID_CHECK_FAILED_TEXT)
+    if duplicates:
+        await reject_duplicate_txid(update, context, txid, duplicates, f"investment of {amount} USDT")
+        return
+
+    keyboard = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "✅ Confirm Investment", callback_data=f"confirm_invest:{user_id}"
+                ),
+                InlineKeyboardButton(
+                    "❌ Reject Investment", callback_data=f"reject_invest:{user_id}"
+                ),
+            ]
+        ]
+    )
+    outbox.send(
+        chat_id=ADMIN_ID,
+        text=(
+            f"📥 *New Investment Request*\n\n"
+            f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
+            f"💵 Amount: {amount} USDT\n"
+            f"🔗 TXID: `{txid}`\n"
+        ),
+        parse_mode="Markdown",
+        reply_markup=keyboard,
+    )
+
+    await update.message.reply_text(
+        "✅ Investment submitted and is pending admin verification. You will be notified when confirmed.",
+        parse_mode="Markdown",
+        reply_markup=MAIN_MENU,
+    )
+
+
+# -----------------------
+# Approvals (shared by the inline buttons and /approve)
+# -----------------------
+# Each approve_* applies one confirmation to the in-memory state and
+# returns (IDs to save, summary for the admin, send_message kwargs for the
+# user). They neither save nor send, so /approve can run a whole batch
+# under one save_data() call. A ValueError means nothing was changed.
+def approve_pay(user_id: str, user) -> Tuple[List[str], str, Dict[str, Any]]:
+    txid = user.get("txid")
+    # mark paid
+    team = [] if user.get("paid") else update_downline(user_id, paid=1)
+    user["paid"] = True
+    # reward referrer for membership if not yet rewarded
+    if not user.get("membership_referrer_rewarded"):
+        ref = user.get("referrer")
+        if ref:
+            add_referral_bonus(ref, "membership", user_id)
+            user["membership_referrer_rewarded"] = True
+    summary = f"Payment for user {user_id} confirmed (TXID: {txid})." + shared_txid_note(txid, user_id, "txid")
+    notice = {
+        "text": (
+            "✅ *Your membership payment has been confirmed!*\n\n"
+            "🎉 Welcome to the Premium Members Signals group 💎\n"
+            "Tap the button below to join."
+        ),
+        "parse_mode": "Markdown",
+        "reply_markup": JOIN_PREMIUM_KEYBOARD,
+    }
+    return [user_id, user.get("referrer"), *team], summary, notice
+
+
+def approve_invest(user_id: str, user) -> Tuple[List[str], str, Dict[str, Any]]:
+    if not user.get("pending_investment"):
+        raise ValueError("No pending investment for this user.")
+    # the index still files the TXID under the pending slot until the save
+    note = shared_txid_note(user["pending_investment"].get("txid"), user_id, "pending_investment")
+    pending = user.pop("pending_investment")
+    amount = pending["amount"]
+    replaced = (user.get("investment") or {}).get("amount", 0.0)
+    if replaced:
+        if ACCRUAL_MODE == "lazy":
+            accrue_profit(user_id, user)  # credit the old investment before it is overwritten
+        retire_txid(user, "investment")
+    now = datetime.utcnow()
+    lock_until = now + timedelta(days=INVEST_LOCK_DAYS)
+    user["investment"] = {
+        "amount": amount,
+        "start_date": now.isoformat(),
+        "active": True,
+        "lock_until": lock_until.isoformat(),
+        "referrer_rewarded_for_invest": False,
+        "txid": pending.get("txid"),
+    }
+    track_investment(user_id)
+    update_rankings(user_id)
+    # team_volume counts current investments (as build_downline does), so a reinvestment adds the difference
+    ids = [user_id, *update_downline(user_id, volume=amount - replaced)]
+
+    # credit referrer for investment (pairing only)
+    ref = user.get("referrer")
+    if ref:
+        add_referral_bonus(ref, "pairing", user_id)
+        user["investment"]["referrer_rewarded_for_invest"] = True
+        ids.append(ref)
+
+    # notify user with premium group link and lock-end date
+    notice = {
+        "text": (
+            f"🎉 *Your investment is confirmed!*\n\n"
+            f"💹 Amount: {amount:.2f} USDT\n"
+            f"🔒 Locked until: {lock_until.strftime('%Y-%m-%d %H:%M UTC')}\n"
+            f"📈 You will earn *1% daily* added to your balance during the lock period.\n\n"
+            f"💎 Tap below to join the Premium Members Signals group:"
+        ),
+        "parse_mode": "Markdown",
+        "reply_markup": JOIN_PREMIUM_KEYBOARD,
+    }
+    return ids, f"Investment for user {user_id} confirmed (Amount: {amount} USDT)." + note, notice
+
+
+def approve_withdraw(user_id: str, user) -> Tuple[List[str], str, Dict[str, Any]]:
+    if not user.get("pending_withdraw"):
+        raise ValueError("No pending withdraw for this user.")
+    pending = user.pop("pending_withdraw")
+    amount = pending.get("amount", user.get("balance", 0.0))
+    # subtract from balance safely (never below zero)
+    balance = user.get("balance", 0.0)
+    ledger.post(user_id, user, "withdraw", max(balance - amount, 0.0) - balance)
+    notice = {"text": f"✅ Your withdrawal of {amount:.2f} USDT has been processed successfully!"}
+    return [user_id], f"Withdrawal of {amount:.2f} USDT for user {user_id} marked as completed.", notice
+
+
+# kind -> (approve function, query words selecting what is pending)
+APPROVALS = {
+    "pay": (approve_pay, ["paid=false", "has:txid"]),
+    "invest": (approve_invest, ["pending:investment"]),
+    "withdraw": (approve_withdraw, ["pending:withdraw"]),
+}
+
+
+async def approve_batch(kind: str, user_ids: List[str], terms):
+    """
+    Approve `user_ids` in one pass: every confirmation is applied under the
+    users' locks (rechecking `terms`, since the list was read unlocked),
+    then saved with a single save_data() call, and the user notifications
+    are queued on the outbox, which sends them concurrently.
+
+    Returns ([(uid, summary)], [(uid, reason)], [uids not notified]).
+    """
+    approve, _ = APPROVALS[kind]
+    refs = [users[uid].get("referrer") for uid in user_ids if uid in users]
+    done, failed, changed = [], [], []
+    async with user_locks.hold(*user_ids, *refs):
+        for uid in user_ids:
+            user = users.get(uid)
+            if user is None:
+                failed.append((uid, "user not found"))
+                continue
+            if not all(_matches(QUERY_FIELDS[f][0](user), op, v) for f, op, v in terms):
+                failed.append((uid, "no longer pending"))
+                continue
+            try:
+                ids, summary, notice = approve(uid, user)
+            except ValueError as e:
+                failed.append((uid, str(e)))
+                continue
+            except Exception:
+                logger.exception("Bulk %s approval failed for user %s", kind, uid)
+                failed.append((uid, "internal error"))
+                continue
+            changed.extend(ids)
+            done.append((uid, summary, notice))
+        save_data(*changed)
+    sent = await asyncio.gather(*(outbox.send(int(uid), **notice) for uid, _, notice in done))
+    unnotified = [uid for (uid, _, _), ok in zip(done, sent) if not ok]
+    return [(uid, summary) for uid, summary, _ in done], failed, unnotified
+
+
+# -----------------------
+# CallbackQuery handler (admin confirms/rejects for payments and investments)
+# -----------------------
+async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    # Only admin allowed to press these inline action buttons
+    if query.from_user.id != ADMIN_ID:
+        await query.edit_message_text("❌ You are not authorized to perform this action.")
+        return
+
+    data = query.data  # e.g., "confirm_invest:12345" or "reject_pay:12345"
+    if not data or ":" not in data:
         await query.edit_message_text("❌ Invalid action.")
         return
 
     action, user_id = data.split(":", 1)
+    # the user and the referrer their confirmation may credit
+    async with user_locks.hold(user_id, users.get(user_id, {}).get("referrer")):
+        await _admin_action(query, context, action, user_id)
+
+
+async def _admin_action(query, context: ContextTypes.DEFAULT_TYPE, action: str, user_id: str):
     user = users.get(user_id)
     if not user:
         await query.edit_message_text("❌ User not found in DB.")
@@ -526,100 +3315,35 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
 
     # --- Payment confirm/reject ---
     if action == "confirm_pay":
-        txid = user.get("txid")
-        # mark paid
-        user["paid"] = True
-        # reward referrer for membership if not yet rewarded
-        if not user.get("membership_referrer_rewarded"):
-            ref = user.get("referrer")
-            if ref:
-                add_referral_bonus(ref, "membership")
-                user["membership_referrer_rewarded"] = True
-        save_data()
-        await query.edit_message_text(f"✅ Payment for user {user_id} confirmed (TXID: {txid}).")
-
-        # send user premium join inline button & message
-        try:
-            keyboard = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("💎 Join Premium Group", url=PREMIUM_GROUP)]]
-            )
-            await context.bot.send_message(
-                chat_id=int(user_id),
-                text=(
-                    "✅ *Your membership payment has been confirmed!*\n\n"
-                    "🎉 Welcome to the Premium Members Signals group 💎\n"
-                    "Tap the button below to join."
-                ),
-                parse_mode="Markdown",
-                reply_markup=keyboard,
-            )
-        except Exception:
-            logger.exception("Failed to notify user after payment confirm.")
+        ids, summary, notice = approve_pay(user_id, user)
+        save_data(*ids)
+        await query.edit_message_text(f"✅ {summary}")
+        outbox.send(int(user_id), **notice)
         return
 
     if action == "reject_pay":
         txid = user.get("txid")
         # optionally keep txid, but notify user
         await query.edit_message_text(f"❌ Payment for user {user_id} rejected (TXID: {txid}).")
-        try:
-            await context.bot.send_message(
-                chat_id=int(user_id),
-                text=(
-                    f"❌ Your membership payment (TXID: {txid}) was rejected by admin.\n"
-                    "If you paid, please contact the admin with proof."
-                ),
-            )
-        except Exception:
-            logger.exception("Failed to notify user after payment rejection.")
+        outbox.send(
+            chat_id=int(user_id),
+            text=(
+                f"❌ Your membership payment (TXID: {txid}) was rejected by admin.\n"
+                "If you paid, please contact the admin with proof."
+            ),
+        )
         return
 
     # --- Investment confirm/reject ---
     if action == "confirm_invest":
-        if "pending_investment" not in user or not user.get("pending_investment"):
-            await query.edit_message_text("❌ No pending investment for this user.")
-            return
-        pending = user.pop("pending_investment")
-        amount = pending["amount"]
-        now_iso = datetime.utcnow().isoformat()
-        lock_until_iso = (datetime.utcnow() + timedelta(days=INVEST_LOCK_DAYS)).isoformat()
-        user["investment"] = {
-            "amount": amount,
-            "start_date": now_iso,
-            "active": True,
-            "lock_until": lock_until_iso,
-            "referrer_rewarded_for_invest": False,
-        }
-        save_data()
-        await query.edit_message_text(f"✅ Investment for user {user_id} confirmed (Amount: {amount} USDT).")
-
-        # credit referrer for investment (pairing only)
-        ref = user.get("referrer")
-        if ref and not user["investment"].get("referrer_rewarded_for_invest"):
-            add_referral_bonus(ref, "pairing")
-            user["investment"]["referrer_rewarded_for_invest"] = True
-            save_data()
-
-        # notify user with premium group link and lock-end date
         try:
-            lock_until_dt = datetime.fromisoformat(lock_until_iso)
-            lock_until_str = lock_until_dt.strftime("%Y-%m-%d %H:%M UTC")
-            keyboard = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("💎 Join Premium Group", url=PREMIUM_GROUP)]]
-            )
-            await context.bot.send_message(
-                chat_id=int(user_id),
-                text=(
-                    f"🎉 *Your investment is confirmed!*\n\n"
-                    f"💹 Amount: {amount:.2f} USDT\n"
-                    f"🔒 Locked until: {lock_until_str}\n"
-                    f"📈 You will earn *1% daily* added to your balance during the lock period.\n\n"
-                    f"💎 Tap below to join the Premium Members Signals group:"
-                ),
-                parse_mode="Markdown",
-                reply_markup=keyboard,
-            )
-        except Exception:
-            logger.exception("Failed to notify user after confirming investment.")
+            ids, summary, notice = approve_invest(user_id, user)
+        except ValueError as e:
+            await query.edit_message_text(f"❌ {e}")
+            return
+        save_data(*ids)
+        await query.edit_message_text(f"✅ {summary}")
+        outbox.send(int(user_id), **notice)
         return
 
     if action == "reject_invest":
@@ -627,41 +3351,27 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             await query.edit_message_text("❌ No pending investment for this user.")
             return
         pending = user.pop("pending_investment")
-        save_data()
+        save_data(user_id)
         await query.edit_message_text(f"❌ Investment for user {user_id} has been rejected.")
-        try:
-            await context.bot.send_message(
-                chat_id=int(user_id),
-                text=(
-                    f"❌ Your investment request of {pending['amount']:.2f} USDT was rejected by admin.\n"
-                    "If you paid and believe this is an error, please contact the admin."
-                ),
-            )
-        except Exception:
-            logger.exception("Failed to notify user after rejecting investment.")
+        outbox.send(
+            chat_id=int(user_id),
+            text=(
+                f"❌ Your investment request of {pending['amount']:.2f} USDT was rejected by admin.\n"
+                "If you paid and believe this is an error, please contact the admin."
+            ),
+        )
         return
 
     # --- Withdraw confirm/reject via inline buttons ---
     if action == "confirm_withdraw":
-        if not user.get("pending_withdraw"):
-            await query.edit_message_text("❌ No pending withdraw for this user.")
-            return
-        pending = user.pop("pending_withdraw")
-        amount = pending.get("amount", user.get("balance", 0.0))
-        # subtract from balance safely
-        user["balance"] = max(user.get("balance", 0.0) - amount,
-                0.0)
-        save_data()
-        await query.edit_message_text(
-            f"✅ Withdrawal of {amount:.2f} USDT for user {user_id} marked as completed."
-        )
         try:
-            await context.bot.send_message(
-                chat_id=int(user_id),
-                text=f"✅ Your withdrawal of {amount:.2f} USDT has been processed successfully!",
-            )
-        except Exception:
-            logger.exception("Failed to notify user after confirming withdrawal.")
+            ids, summary, notice = approve_withdraw(user_id, user)
+        except ValueError as e:
+            await query.edit_message_text(f"❌ {e}")
+            return
+        save_data(*ids)
+        await query.edit_message_text(f"✅ {summary}")
+        outbox.send(int(user_id), **notice)
         return
 
     if action == "reject_withdraw":
@@ -669,20 +3379,17 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
             await query.edit_message_text("❌ No pending withdraw for this user.")
             return
         pending = user.pop("pending_withdraw")
-        save_data()
+        save_data(user_id)
         await query.edit_message_text(
             f"❌ Withdrawal for user {user_id} rejected (Amount: {pending['amount']:.2f} USDT)."
         )
-        try:
-            await context.bot.send_message(
-                chat_id=int(user_id),
-                text=(
-                    f"❌ Your withdrawal request of {pending['amount']:.2f} USDT was rejected by admin.\n"
-                    "If you believe this is an error, please contact support."
-                ),
-            )
-        except Exception:
-            logger.exception("Failed to notify user after withdrawal rejection.")
+        outbox.send(
+            chat_id=int(user_id),
+            text=(
+                f"❌ Your withdrawal request of {pending['amount']:.2f} USDT was rejected by admin.\n"
+                "If you believe this is an error, please contact support."
+            ),
+        )
         return
 
 # -----------------------
@@ -700,6 +3407,8 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user = users.get(user_id, {})
     if data == "balance":
+        async with user_locks.hold(user_id):
+            realize_profit(user_id, user)
         bal = user.get("balance", 0.0)
         inv = user.get("investment")
         inv_text = ""
@@ -716,72 +3425,43 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(
             f"💰 *Your Balance:* {bal:.2f} USDT{inv_text}",
             parse_mode="Markdown",
-            reply_markup=build_main_menu(),
+            reply_markup=MAIN_MENU,
         )
     elif data == "invest":
-        invest_text = (
-            "💼 *Investment Instructions*\n\n"
-            "💰 *Minimum Investment:* 50 USDT (BEP20)\n"
-            "📈 Earn daily returns and referral rewards.\n\n"
-            "💳 *Payment Address (BEP20):*\n"
-            "`0xC6219FFBA27247937A63963E4779e33F7930d497`\n\n"
-            "📤 *How to Invest:*\n"
-            "1️⃣ Send your USDT to the address above.\n"
-            "2️⃣ Submit your TXID using:\n"
-            "`/invest <amount> <TXID>`\n"
-            "3️⃣ Your *initial investment* will be *locked for 30 days*.\n"
-            " 💹 It will generate *1% daily profit*, which will be added automatically to your balance.\n\n"
-            "⏱️ Once confirmed, your balance updates automatically."
-    )
-
         await query.edit_message_text(
-             text=invest_text,
+             text=INVEST_TEXT,
              parse_mode="Markdown",
-             reply_markup=build_main_menu(),
+             reply_markup=MAIN_MENU,
     )
 
     elif data == "referral":
-        link = f"https://t.me/{context.bot.username}?start={user_id}"
-        refs = users.get(user_id, {}).get("referrals", [])
+        link = referral_link(context.bot.username, user_id)
+        user = users.get(user_id) or UserRecord()
         await query.edit_message_text(
-            f"👥 *Your Referral Link:*\n{link}\n\n👤 Total Referrals: {len(refs)}",
+            f"👥 *Your Referral Link:*\n{link}\n\n"
+            f"👤 Total Referrals: {len(user['referrals'])}\n"
+            f"🌳 Team Size: {user['team_size']} ({user['team_paid']} paid)\n"
+            f"💵 Team Investment: {user['team_volume']:.2f} USDT\n"
+            f"📶 Team Depth: {user['team_depth']} levels",
             parse_mode="Markdown",
-            reply_markup=build_main_menu(),
+            reply_markup=MAIN_MENU,
         )
 
     elif data == "faq":
-        text = (
-            "💡 *FAQ - Auto-Trading & Investments*\n\n"
-            f"• Minimum investment: *{INVEST_MIN} USDT*\n"
-            f"• Deposit to BEP20 address: `{BNB_ADDRESS}`\n"
-            f"• Direct bonus: *{DIRECT_BONUS} USDT*\n"
-            f"• Pairing bonus: *{PAIRING_BONUS} USDT*\n"
-            f"• Investment lock: *{INVEST_LOCK_DAYS} days*\n"
-            f"• Daily profit: *1%* added to balance\n"
-            f"• Minimum withdraw: *{MIN_WITHDRAW} USDT*\n"
-        )
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=build_main_menu())
+        await query.edit_message_text(FAQ_TEXT, parse_mode="Markdown", reply_markup=MAIN_MENU)
 
     elif data == "withdraw":
-        await query.edit_message_text(
-            f"🏦 To request withdrawal, type:\n`/withdraw <your_wallet_address>`\n\n"
-            f"💵 Minimum withdrawal: *{MIN_WITHDRAW} USDT*",
-            parse_mode="Markdown",
-            reply_markup=build_main_menu(),
-        )
+        await query.edit_message_text(WITHDRAW_TEXT, parse_mode="Markdown", reply_markup=MAIN_MENU)
 
     elif data == "help":
-        await query.edit_message_text(
-            "❓ *Help Menu*\n\n"
-            "Use the buttons to navigate:\n"
-            "💰 Balance — View your balance & investment\n"
-            "💸 Invest — Submit new investment\n"
-            "👥 Referral — Your referral link\n"
-            "💎 FAQ — Info about bonuses and rules\n"
-            "🏦 Withdraw — How to withdraw funds",
-            parse_mode="Markdown",
-            reply_markup=build_main_menu(),
+        await query.edit_message_text(MENU_HELP_TEXT, parse_mode="Markdown", reply_markup=MAIN_MENU)
+
+    elif data == "top":
+        text = "\n\n".join(
+            [leaderboard_text(await leaderboard_view(name, 10, user_id), 10, user_id)
+             for name in ("referrers", "investors")]
         )
+        await query.edit_message_text("🏆 *Leaderboard*\n\n" + text, parse_mode="Markdown", reply_markup=MAIN_MENU)
 
 # -----------------------
 # Withdraw command (user)
@@ -791,20 +3471,22 @@ async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = users.get(user_id, {})
     if len(context.args) < 1:
         await update.message.reply_text(
-            f"Usage: /withdraw <wallet_address>\nMinimum: {MIN_WITHDRAW} USDT",
-            reply_markup=build_main_menu(),
+            WITHDRAW_USAGE_TEXT,
+            reply_markup=MAIN_MENU,
         )
         return
     wallet = context.args[0]
-    amount = user.get("balance", 0.0)
-    if amount < MIN_WITHDRAW:
-        await update.message.reply_text(
-            f"❌ Minimum withdrawal is {MIN_WITHDRAW} USDT. Your balance: {amount:.2f} USDT",
-            reply_markup=build_main_menu(),
-        )
-        return
-    user["pending_withdraw"] = {"wallet": wallet, "amount": amount, "submitted_at": datetime.utcnow().isoformat()}
-    save_data()
+    async with user_locks.hold(user_id):
+        realize_profit(user_id, user)
+        amount = user.get("balance", 0.0)
+        if amount < MIN_WITHDRAW:
+            await update.message.reply_text(
+                f"❌ Minimum withdrawal is {MIN_WITHDRAW} USDT. Your balance: {amount:.2f} USDT",
+                reply_markup=MAIN_MENU,
+            )
+            return
+        user["pending_withdraw"] = {"wallet": wallet, "amount": amount, "submitted_at": datetime.utcnow().isoformat()}
+        save_data(user_id)
 
     keyboard = InlineKeyboardMarkup(
         [
@@ -814,25 +3496,433 @@ async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
         ]
     )
-    try:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=(
-                f"🏦 *New Withdrawal Request*\n\n"
-                f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
-                f"💵 Amount: {amount:.2f} USDT\n"
-                f"💳 Wallet: `{wallet}`\n"
-            ),
-            parse_mode="Markdown",
-            reply_markup=keyboard,
+    outbox.send(
+        chat_id=ADMIN_ID,
+        text=(
+            f"🏦 *New Withdrawal Request*\n\n"
+            f"👤 User: {update.effective_user.full_name} (ID: {user_id})\n"
+            f"💵 Amount: {amount:.2f} USDT\n"
+            f"💳 Wallet: `{wallet}`\n"
+        ),
+        parse_mode="Markdown",
+        reply_markup=keyboard,
+    )
+
+    await update.message.reply_text(
+        "✅ Withdrawal request submitted. Admin will process it soon.",
+        reply_markup=MAIN_MENU,
+    )
+
+# -----------------------
+# Rate limiting
+# -----------------------
+class TokenBucket:
+    """
+    Token bucket: `rate` tokens per second, bursts of up to `capacity`.
+    pause() empties the bucket and blocks it (Telegram RetryAfter).
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self) -> float:
+        """Seconds until the next token is available."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class BucketMap:
+    """
+    Per-key token buckets kept in an LRU-bounded OrderedDict, so memory stays
+    flat no matter how many distinct chats/users show up.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, max_keys: int = 100_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+
+    def get(self, key) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+
+# Telegram allows ~30 messages/second overall and ~1/second to the same chat
+SEND_BUCKET = TokenBucket(GLOBAL_SEND_RATE)
+CHAT_BUCKETS = BucketMap(PER_CHAT_SEND_RATE, 1)
+
+
+async def deliver(bot, chat_id, attempts: int = BROADCAST_MAX_ATTEMPTS, **kwargs) -> Optional[str]:
+    """
+    Send one message through the global and per-chat buckets, retrying
+    floods and network errors. Returns None once sent, else why it gave up.
+    """
+    chat_bucket = CHAT_BUCKETS.get(str(chat_id))
+    error = "no attempts"
+    for attempt in range(attempts):
+        await chat_bucket.acquire()
+        await SEND_BUCKET.acquire()
+        try:
+            await bot.send_message(chat_id=int(chat_id), **kwargs)
+            return None
+        except RetryAfter as e:
+            logger.warning("Flood limit hit, pausing sends for %ss", e.retry_after)
+            SEND_BUCKET.pause(e.retry_after)
+            error = f"RetryAfter: {e.retry_after}s"
+        except (BadRequest, Forbidden) as e:
+            return f"{type(e).__name__}: {e}"  # blocked the bot / chat gone: retrying won't help
+        except NetworkError as e:
+            error = f"{type(e).__name__}: {e}"
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            logger.exception("Send to %s failed", chat_id)
+            return f"{type(e).__name__}: {e}"
+    return error
+
+
+async def send_paced(bot, uid: str, **kwargs) -> bool:
+    return await deliver(bot, uid, **kwargs) is None
+
+
+# Incoming updates: one bucket per user and budget, LRU-bounded like CHAT_BUCKETS
+WRITE_COMMANDS = frozenset({"start", "pay", "invest", "withdraw"})
+THROTTLE_BUCKETS = {
+    "read": BucketMap(THROTTLE_READ_RATE, THROTTLE_READ_BURST, THROTTLE_MAX_USERS),
+    "write": BucketMap(THROTTLE_WRITE_RATE, THROTTLE_WRITE_BURST, THROTTLE_MAX_USERS),
+}
+THROTTLE_NOTICES = BucketMap(1 / THROTTLE_NOTICE_SECONDS, 1, THROTTLE_MAX_USERS)
+
+
+def throttle_budget(update: Update) -> str:
+    """'write' for commands that save or notify the admin, else 'read'."""
+    message = update.message
+    if message and message.text and message.text.startswith("/"):
+        command = message.text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+        if command in WRITE_COMMANDS:
+            return "write"
+    return "read"
+
+
+async def throttle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs before every other handler (group -1). Drops the update with
+    ApplicationHandlerStop once the user's bucket for its budget is empty;
+    the user gets at most one short "slow down" per THROTTLE_NOTICE_SECONDS
+    and nothing is saved.
+    """
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return
+    user_id = str(user.id)
+    budget = throttle_budget(update)
+    if THROTTLE_BUCKETS[budget].get(user_id).try_acquire():
+        return
+    THROTTLED.inc(budget)
+    if THROTTLE_NOTICES.get(user_id).try_acquire():
+        text = "⏳ Too many requests, please slow down."
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif update.message:
+                await update.message.reply_text(text)
+        except Exception as e:
+            logger.warning("Slow-down notice to %s failed: %s", user_id, e)
+    raise ApplicationHandlerStop
+
+
+# -----------------------
+# Outbound queue
+# -----------------------
+class Outbox:
+    """
+    Notifications to the admin and to users. Handlers call send() and
+    return at once; `workers` tasks deliver the messages through the send
+    buckets with retries (deliver()). Messages that still can't be sent,
+    or are left over at shutdown, are appended to `dead_letter_path` (JSON
+    lines), where /deadletters shows and retries them.
+
+    send() returns a future that resolves to True once the message is sent
+    and False once it is dead-lettered; most callers ignore it.
+    """
+
+    def __init__(self, dead_letter_path: str, workers: int, attempts: int):
+        self.dead_letter_path = dead_letter_path
+        self.workers = workers
+        self.attempts = attempts
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.in_flight: Dict[int, tuple] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.bot = None
+
+    def send(self, chat_id, **kwargs) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((chat_id, kwargs, future))
+        return future
+
+    def start(self, bot):
+        self.bot = bot
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self, timeout: float):
+        """Give queued messages `timeout` seconds to go out, then dead-letter the rest."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox still had %d messages after %ss", self.queue.qsize() + len(self.in_flight), timeout)
+        leftover = list(self.in_flight.values())  # workers drop these from in_flight as they're cancelled
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        while not self.queue.empty():
+            leftover.append(self.queue.get_nowait())
+        for chat_id, kwargs, future in leftover:
+            self.dead_letter(chat_id, kwargs, "undelivered at shutdown")
+            if not future.done():
+                future.set_result(False)
+
+    async def _worker(self, slot: int):
+        while True:
+            item = await self.queue.get()
+            self.in_flight[slot] = item
+            chat_id, kwargs, future = item
+            try:
+                error = await deliver(self.bot, chat_id, self.attempts, **kwargs)
+                if error:
+                    logger.warning("Dead-lettering message to %s: %s", chat_id, error)
+                    self.dead_letter(chat_id, kwargs, error)
+                if not future.done():
+                    future.set_result(error is None)
+            finally:
+                self.in_flight.pop(slot, None)
+                self.queue.task_done()
+
+    def dead_letter(self, chat_id, kwargs: Dict[str, Any], error: str):
+        message = dict(kwargs)
+        if message.get("reply_markup") is not None:
+            message["reply_markup"] = message["reply_markup"].to_dict()
+        record = {"at": datetime.utcnow().isoformat(), "chat_id": chat_id, "error": error, "message": message}
+        try:
+            with open(self.dead_letter_path, "a") as f:
+                f.write(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+        except Exception:
+            logger.exception("Failed to record dead letter for %s: %r", chat_id, record)
+        OUTBOX_DEAD_LETTERS.inc()
+
+    def dead_letters(self) -> List[Dict[str, Any]]:
+        records = []
+        if os.path.exists(self.dead_letter_path):
+            with open(self.dead_letter_path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue  # torn last line
+        return records
+
+    def retry_dead_letters(self) -> int:
+        """Queue every dead letter again (failures are re-recorded) and empty the file."""
+        records = self.dead_letters()
+        open(self.dead_letter_path, "w").close()
+        for record in records:
+            message = record["message"]
+            if message.get("reply_markup") is not None:
+                message["reply_markup"] = InlineKeyboardMarkup.de_json(message["reply_markup"], None)
+            self.send(record["chat_id"], **message)
+        return len(records)
+
+
+outbox = Outbox(DEAD_LETTER_FILE, OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS)
+
+
+# -----------------------
+# Broadcast engine
+# -----------------------
+BROADCAST_SEGMENTS = {
+    "all": lambda u: True,
+    "paid": lambda u: bool(u.get("paid")),
+    "investors": lambda u: bool((u.get("investment") or {}).get("active")),
+    "withdrawals": lambda u: bool(u.get("pending_withdraw")),
+}
+
+
+class BroadcastJob:
+    """
+    One broadcast: the message, the target list (fixed when the job is
+    created) and progress.
+
+    Workers send concurrently through the global and per-chat buckets.
+    `cursor` is the low-water mark of finished targets and is persisted
+    every few seconds to BROADCAST_FILE (targets go to a side file once), so
+    a restarted bot resumes where it stopped, re-sending at most the few
+    messages that were in flight.
+    """
+
+    def __init__(self, state: Dict[str, Any], targets: List[str]):
+        self.state = state
+        self.targets = targets
+        self._saved_at = 0.0
+        self._version = self._written = 0
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, text: str, segment: str, admin_chat: int) -> "BroadcastJob":
+        """Snapshot the targets from `users`; call on the event loop, then persist()."""
+        match = BROADCAST_SEGMENTS[segment]
+        targets = [uid for uid, u in users.items() if match(u)]
+        state = {
+            "id": datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+            "text": text,
+            "segment": segment,
+            "admin_chat": admin_chat,
+            "total": len(targets),
+            "cursor": 0,
+            "sent": 0,
+            "failed": 0,
+            "status": "running",
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        return cls(state, targets)
+
+    def persist(self):
+        """Write the target list and initial state (blocking file I/O)."""
+        write_json_atomic(BROADCAST_FILE + ".targets", self.targets)
+        self._write(dict(self.state), 0)
+
+    @classmethod
+    def load(cls) -> Optional["BroadcastJob"]:
+        state = load_json_file(BROADCAST_FILE, None)
+        if not state:
+            return None
+        return cls(state, load_json_file(BROADCAST_FILE + ".targets", []))
+
+    async def save(self):
+        """Write a copy of the progress state from a worker thread."""
+        self._saved_at = time.monotonic()
+        self._version += 1
+        await asyncio.to_thread(self._write, dict(self.state), self._version)
+
+    def _write(self, state: Dict[str, Any], version: int):
+        # a copy that lost the race to a newer one (e.g. "running" after "cancelled") is dropped
+        with self._write_lock:
+            if version < self._written:
+                return
+            try:
+                write_json_atomic(BROADCAST_FILE, state)
+            except Exception:
+                logger.exception("Failed to save broadcast progress.")
+            self._written = version
+
+    @property
+    def running(self) -> bool:
+        return self.state["status"] == "running"
+
+    def progress_text(self) -> str:
+        s = self.state
+        return (
+            f"📢 Broadcast #{s['id']} ({s['segment']}): {s['status']}\n"
+            f"✅ Sent: {s['sent']}  ❌ Failed: {s['failed']}  📬 Total: {s['total']}"
         )
-    except Exception:
-        logger.exception("Failed to notify admin about withdraw.")
 
-    await update.message.reply_text(
-        "✅ Withdrawal request submitted. Admin will process it soon.",
-        reply_markup=build_main_menu(),
-    )
+    async def run(self, bot):
+        next_index = self.state["cursor"]
+        finished = set()
+
+        async def worker():
+            nonlocal next_index
+            while self.running and next_index < len(self.targets):
+                i = next_index
+                next_index += 1
+                ok = await self._send(bot, self.targets[i])
+                self.state["sent" if ok else "failed"] += 1
+                finished.add(i)
+                while self.state["cursor"] in finished:
+                    finished.discard(self.state["cursor"])
+                    self.state["cursor"] += 1
+                if time.monotonic() - self._saved_at > BROADCAST_SAVE_EVERY:
+                    await self.save()
+
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+        if self.running:
+            self.state["status"] = "done"
+        await self.save()
+        logger.info("Broadcast %s finished: %s", self.state["id"], self.state["status"])
+        if self.state["status"] == "done":
+            try:
+                await bot.send_message(chat_id=self.state["admin_chat"], text=self.progress_text())
+            except Exception:
+                logger.exception("Failed to report broadcast result to admin.")
+
+    async def _send(self, bot, uid: str) -> bool:
+        return await send_paced(bot, uid, text=self.state["text"])
+
+
+broadcast_job: Optional[BroadcastJob] = None
+_broadcast_task: Optional[asyncio.Task] = None
+
+
+def start_broadcast(job: BroadcastJob, bot):
+    global broadcast_job, _broadcast_task
+    broadcast_job = job
+    _broadcast_task = asyncio.create_task(job.run(bot))
+
+
+async def resume_broadcast(app):
+    """post_init hook: pick up a broadcast interrupted by a restart."""
+    job = BroadcastJob.load()
+    if job and job.running:
+        logger.info("Resuming broadcast %s at %d/%d", job.state["id"], job.state["cursor"], job.state["total"])
+        start_broadcast(job, app.bot)
+
+
+async def stop_broadcast():
+    """Shutdown: stop sending but keep the job "running" so it resumes."""
+    if _broadcast_task and not _broadcast_task.done():
+        _broadcast_task.cancel()
+        try:
+            await _broadcast_task
+        except asyncio.CancelledError:
+            pass
+        await broadcast_job.save()
+
 
 # -----------------------
 # Admin Commands
@@ -842,6 +3932,8 @@ async def distribute(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Unauthorized.")
         return
     count = distribute_daily_profit()
+    if ACCRUAL_MODE == "lazy":
+        return await update.message.reply_text(f"💹 Credited accrued profit to {count} investors.")
     await update.message.reply_text(f"💹 Distributed daily profit to {count} active investors.")
 
 
@@ -849,7 +3941,12 @@ async def usercount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return await update.message.reply_text("❌ Unauthorized.")
     count = len(users)
-    await update.message.reply_text(f"📊 Total registered users: {count}")
+    await update.message.reply_text(
+        f"📊 Total registered users: {count}\n"
+        f"✅ Paid members: {storage.paid_count()}\n"
+        f"📥 Pending investments: {len(storage.pending_ids('investment'))}\n"
+        f"🏦 Pending withdrawals: {len(storage.pending_ids('withdraw'))}"
+    )
 
 
 async def userinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -861,7 +3958,206 @@ async def userinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = users.get(uid)
     if not user:
         return await update.message.reply_text("❌ User not found.")
-    await update.message.reply_text(json.dumps(user, indent=2))
+    async with user_locks.hold(uid):
+        if reset_pairing_if_needed(user):
+            save_data(uid)
+        realize_profit(uid, user)
+    await update.message.reply_text(json.dumps(user.to_dict(), indent=2))
+
+
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /leaderboard [referrers|direct|investors] [k]"""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    names = list(LEADERBOARDS)
+    k = 10
+    for arg in context.args:
+        if arg in LEADERBOARDS:
+            names = [arg]
+        elif arg.isdigit():
+            k = min(int(arg), 100)
+        else:
+            return await update.message.reply_text(f"Usage: /leaderboard [{'|'.join(LEADERBOARDS)}] [k]")
+    views = [await leaderboard_view(name, k) for name in names]
+    await update.message.reply_text(
+        "\n\n".join(leaderboard_text(view, k, mask=False) + f"\n({len(view)} ranked)" for view in views),
+        parse_mode="Markdown",
+    )
+
+
+async def admin_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /query <terms> [page:N] — see QUERY_USAGE_TEXT."""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if not context.args:
+        return await update.message.reply_text(QUERY_USAGE_TEXT)
+    try:
+        terms, page = parse_query(context.args)
+    except ValueError as e:
+        return await update.message.reply_text(f"❌ {e}\n\n{QUERY_USAGE_TEXT}")
+    t0 = time.perf_counter()
+    uids, plan = run_query(terms)
+    elapsed = (time.perf_counter() - t0) * 1000
+    pages = max(1, -(-len(uids) // QUERY_PAGE_SIZE))
+    page = min(page, pages)
+    rows = [_query_row(uid, users[uid]) for uid in uids[(page - 1) * QUERY_PAGE_SIZE:page * QUERY_PAGE_SIZE]]
+    text = f"🔎 {len(uids)} users · page {page}/{pages} · {elapsed:.1f} ms ({plan})\n\n" + "\n".join(rows)
+    if page < pages:
+        words = [w for w in context.args if not w.startswith("page:")]
+        text += f"\n\nNext: /query {' '.join(words)} page:{page + 1}"
+    await update.message.reply_text(text)
+
+
+def _pending_selection(kind: str, args: List[str]):
+    """
+    (/pending|/approve) args -> (terms, page, explicit user IDs or None).
+    Bare numbers are user IDs; a worker process keeps only its own.
+    """
+    ids = [a for a in args if a.isdigit()]
+    words = [a for a in args if not a.isdigit() and a != "all"]
+    terms, page = parse_query(APPROVALS[kind][1] + words)
+    return terms, page, [uid for uid in ids if owns(uid)] if ids else None
+
+
+async def pending_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /pending [pay|invest|withdraw] [terms] [page:N]"""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if not context.args or context.args[0] not in APPROVALS:
+        counts = [f"• {kind}: {len(run_query(parse_query(words)[0])[0])}" for kind, (_, words) in APPROVALS.items()]
+        return await update.message.reply_text(
+            "⏳ Pending queue\n" + "\n".join(counts) + f"\n\nUsage: /pending <{'|'.join(APPROVALS)}> [terms] [page:N]"
+        )
+    kind, args = context.args[0], context.args[1:]
+    try:
+        terms, page, ids = _pending_selection(kind, args)
+    except ValueError as e:
+        return await update.message.reply_text(f"❌ {e}\n\n{QUERY_USAGE_TEXT}")
+    uids, _ = run_query(terms)
+    if ids is not None:
+        uids = [uid for uid in uids if uid in set(ids)]
+    pages = max(1, -(-len(uids) // QUERY_PAGE_SIZE))
+    page = min(page, pages)
+    rows = [_query_row(uid, users[uid]) for uid in uids[(page - 1) * QUERY_PAGE_SIZE:page * QUERY_PAGE_SIZE]]
+    words = [w for w in args if not w.startswith("page:")]
+    text = f"⏳ {len(uids)} pending {kind} · page {page}/{pages}\n\n" + "\n".join(rows)
+    if page < pages:
+        text += f"\n\nNext: /pending {kind} {' '.join(words)} page:{page + 1}"
+    if uids:
+        text += f"\n\nApprove these {len(uids)}: /approve {kind} {' '.join(words) or 'all'}"
+    await update.message.reply_text(text)
+
+
+async def approve_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /approve <pay|invest|withdraw> <all|terms|user_ids...>"""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    usage = f"Usage: /approve <{'|'.join(APPROVALS)}> <all | query terms | user IDs>"
+    if len(context.args) < 2 or context.args[0] not in APPROVALS:
+        return await update.message.reply_text(usage)
+    kind, args = context.args[0], context.args[1:]
+    try:
+        terms, _, ids = _pending_selection(kind, [a for a in args if not a.startswith("page:")])
+    except ValueError as e:
+        return await update.message.reply_text(f"❌ {e}\n\n{usage}")
+    uids, _ = run_query(terms)
+    if ids is not None:
+        matching = set(uids)
+        uids = list(dict.fromkeys(ids))
+        skipped = [(uid, "not pending") for uid in uids if uid not in matching]
+        uids = [uid for uid in uids if uid in matching]
+    else:
+        skipped = []
+    if not uids:
+        return await update.message.reply_text(f"Nothing pending matches ({len(skipped)} skipped).")
+
+    done, failed, unnotified = await approve_batch(kind, uids, terms)
+    failed = skipped + failed
+    lines = [f"✅ Approved {len(done)} {kind} request(s), ❌ {len(failed)} failed."]
+    lines += [f"• {summary}" for _, summary in done[:QUERY_PAGE_SIZE]]
+    if len(done) > QUERY_PAGE_SIZE:
+        lines.append(f"… and {len(done) - QUERY_PAGE_SIZE} more")
+    if failed:
+        lines.append("\nFailed:")
+        lines += [f"• {uid}: {reason}" for uid, reason in failed[:QUERY_PAGE_SIZE]]
+        if len(failed) > QUERY_PAGE_SIZE:
+            lines.append(f"… and {len(failed) - QUERY_PAGE_SIZE} more")
+    lines.append(f"\n📨 Notified {len(done) - len(unnotified)}/{len(done)} users.")
+    if unnotified:
+        lines.append("Not notified: " + ", ".join(unnotified[:50]))
+    await update.message.reply_text("\n".join(lines))
+
+
+async def slowlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /slowlog [n] — the latest profiler captures."""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if profiler is None:
+        return await update.message.reply_text("Profiling is off. Set PROFILE_SLOW_MS and/or PROFILE_EVERY.")
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 5
+    captures = list(profiler.recent)[-n:]
+    if not captures:
+        return await update.message.reply_text(
+            f"No captures yet ({profiler.count} updates seen, slow ≥ {profiler.slow * 1000:.0f} ms, "
+            f"1 in {profiler.every or '∞'} profiled)."
+        )
+    lines = [f"🐢 Latest {len(captures)} of {profiler.count} updates profiled:"]
+    for c in reversed(captures):
+        lines.append(
+            f"\n{c['at']:%m-%d %H:%M:%S} {c['handler']} (user {c['user']}) {c['ms']:.0f} ms [{c['kind']}]\n"
+            + "\n".join(f"  • {t}" for t in c["top"])
+            + f"\n  {c['file']}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+
+async def deadletters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /deadletters [retry] — notifications the outbox gave up on."""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if context.args and context.args[0] == "retry":
+        count = outbox.retry_dead_letters()
+        return await update.message.reply_text(f"🔁 Re-queued {count} message(s).")
+    records = outbox.dead_letters()
+    if not records:
+        return await update.message.reply_text(f"📭 No dead letters ({outbox.queue.qsize()} queued).")
+    lines = [f"📪 {len(records)} undelivered message(s), latest first:"]
+    for r in reversed(records[-10:]):
+        text = (r["message"].get("text") or "").replace("\n", " ")
+        lines.append(f"• {r['at'][:19]} → {r['chat_id']}: {r['error']}\n  {text[:60]}")
+    lines.append("\nRetry all: /deadletters retry")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Admin-only: check every user's balance and rollups against the ledger.
+    The rollups and the ledger sequence number are captured together; once
+    the lines up to it are on disk the ledger is summed in a worker thread.
+    """
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if ledger.unsaved:
+        save_data(*ledger.unsaved)
+    seq = ledger.seq
+    fields = ["balance"] + [field for field, _ in LEDGER_ROLLUPS.values()]
+    expected = {uid: [u[f] for f in fields] for uid, u in users.items()}
+    if persistence is not None:
+        await asyncio.to_thread(persistence.flush)
+    totals = await asyncio.to_thread(ledger.totals, seq)
+
+    mismatches = []
+    for uid in expected.keys() | totals.keys():
+        sums = totals.get(uid, {})
+        actual = [sums.get("*", 0.0)] + [sign * sums.get(kind, 0.0) for kind, (_, sign) in LEDGER_ROLLUPS.items()]
+        for field, want, got in zip(fields, expected.get(uid, [0.0] * len(fields)), actual):
+            if abs(want - got) > 1e-6:
+                mismatches.append(f"{uid} {field}: record {want:.6f} ledger {got:.6f}")
+    if not mismatches:
+        return await update.message.reply_text(f"✅ Ledger reconciled: {len(expected)} users, {seq} entries.")
+    await update.message.reply_text(
+        f"⚠️ {len(mismatches)} mismatches:\n" + "\n".join(sorted(mismatches)[:20])
+    )
 
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -869,27 +4165,893 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("❌ Unauthorized.")
     if not context.args:
         return await update.message.reply_text("Usage: /broadcast <message>")
-    msg = " ".join(context.args)
-    sent = 0
-    for uid in list(users.keys()):
+    await _start_broadcast_command(update, context, "all", " ".join(context.args))
+
+
+async def broadcast_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: /broadcast_to <segment> <message>"""
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if len(context.args) < 2 or context.args[0] not in BROADCAST_SEGMENTS:
+        return await update.message.reply_text(
+            f"Usage: /broadcast_to <{'|'.join(BROADCAST_SEGMENTS)}> <message>"
+        )
+    await _start_broadcast_command(update, context, context.args[0], " ".join(context.args[1:]))
+
+
+async def _start_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE, segment: str, text: str):
+    if broadcast_job and broadcast_job.running:
+        return await update.message.reply_text(
+            "⏳ A broadcast is already running.\n" + broadcast_job.progress_text()
+        )
+    # the snapshot is taken on the loop, where users can't change under it; only the writes go to a thread
+    job = BroadcastJob.create(text, segment, update.effective_chat.id)
+    await asyncio.to_thread(job.persist)
+    start_broadcast(job, context.bot)
+    await update.message.reply_text(
+        f"📢 Broadcast #{job.state['id']} started to {job.state['total']} users ({segment}).\n"
+        "Use /broadcast_status to follow it or /broadcast_cancel to stop it."
+    )
+
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    job = broadcast_job or BroadcastJob.load()
+    if not job:
+        return await update.message.reply_text("ℹ️ No broadcast has been run yet.")
+    await update.message.reply_text(job.progress_text())
+
+
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return await update.message.reply_text("❌ Unauthorized.")
+    if not broadcast_job or not broadcast_job.running:
+        return await update.message.reply_text("ℹ️ No broadcast is running.")
+    broadcast_job.state["status"] = "cancelled"
+    await broadcast_job.save()
+    await update.message.reply_text("🛑 Broadcast cancelled.\n" + broadcast_job.progress_text())
+
+# -----------------------
+# Webhook server
+# -----------------------
+class WebhookServer:
+    """
+    Small HTTP/1.1 server (asyncio streams) for webhook mode. Telegram's
+    POSTs to `path` are checked against the secret token, parsed and put on
+    app.update_queue, and acknowledged at once; handlers then run exactly
+    as they do under polling. GET HEALTH_PATH answers 200 while serving and
+    503 once draining.
+
+    drain() stops accepting connections, refuses new updates with 503 (so
+    Telegram redelivers them after the restart) and waits for requests in
+    progress before idle keep-alive connections are closed.
+    """
+
+    MAX_BODY = 1 << 20
+
+    def __init__(self, app, listen: str, port: int, path: str, secret: Optional[str]):
+        self.app = app
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.server = None
+        self.draining = False
+        self.active = 0
+        self.received = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.listen, self.port)
+        logger.info("Webhook server listening on %s:%d%s", self.listen, self.port, self.path)
+
+    async def drain(self, timeout: float):
+        self.draining = True
+        self.server.close()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Webhook drain timed out with %d requests in progress", self.active)
+        for writer in list(self._writers):
+            writer.close()
+        logger.info("Webhook server drained after %d updates", self.received)
+
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while not self.draining:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > self.MAX_BODY:
+                    writer.write(self._response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False))
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                self.active += 1
+                self._idle.clear()
+                try:
+                    status, payload = await self._route(method, target.split("?", 1)[0], headers, body)
+                finally:
+                    self.active -= 1
+                    if not self.active:
+                        self._idle.set()
+                keep_alive = headers.get("connection", "").lower() != "close" and not self.draining
+                writer.write(self._response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _route(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        if path == HEALTH_PATH and method in ("GET", "HEAD"):
+            status = HTTPStatus.SERVICE_UNAVAILABLE if self.draining else HTTPStatus.OK
+            return status, json.dumps({
+                "status": "draining" if self.draining else "ok",
+                "received": self.received,
+                "queued": self.app.update_queue.qsize(),
+            }).encode()
+        if path != self.path:
+            return HTTPStatus.NOT_FOUND, b""
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, b""
+        if self.secret and not hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", ""), self.secret
+        ):
+            return HTTPStatus.FORBIDDEN, b""
+        if self.draining:
+            return HTTPStatus.SERVICE_UNAVAILABLE, b""
         try:
-            await context.bot.send_message(chat_id=int(uid), text=msg)
-            sent += 1
+            update = Update.de_json(json.loads(body), self.app.bot)
         except Exception:
-            continue
-    await update.message.reply_text(f"📢 Broadcast sent to {sent} users.")
+            logger.exception("Rejected malformed webhook update")
+            return HTTPStatus.BAD_REQUEST, b""
+        await self.app.update_queue.put(update)
+        self.received += 1
+        return HTTPStatus.OK, b""
+
+    @staticmethod
+    def _response(status: HTTPStatus, body: bytes = b"", keep_alive: bool = True) -> bytes:
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        return head.encode("latin-1") + body
+
+
+async def run_webhook(app):
+    """
+    Webhook counterpart of app.run_polling(): register the webhook, serve
+    until SIGINT/SIGTERM, then drain the server and let the application
+    finish every update it has accepted before shutting down.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = WebhookServer(app, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await server.start()
+    await app.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Stopping: draining webhook server")
+        await server.drain(WEBHOOK_DRAIN_TIMEOUT)
+        await app.stop()  # handles everything still queued or running
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+
+# -----------------------
+# Metrics endpoint
+# -----------------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        body = render_metrics().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the bot's log
+
+
+def start_metrics_server(addr: str, port: int) -> ThreadingHTTPServer:
+    """Serve GET /metrics from daemon threads, off the event loop."""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("📈 Metrics on http://%s:%d/metrics", addr, server.server_address[1])
+    return server
+
+
+# -----------------------
+# Profiling
+# -----------------------
+class UpdateProfiler:
+    """
+    Captures where slow updates spend their time.
+
+    Slow mode: while any update is in flight a sampler thread records the
+    event loop thread's stack every `interval` seconds; an update that
+    takes longer than `slow` seconds gets the samples from its lifetime
+    written out as collapsed stacks weighted in ms (flamegraph input).
+    Time spent waiting on Telegram shows up as the loop idling in
+    selectors.select. C code holding the GIL (json.dumps, say) blocks the
+    sampler, so each sample is weighted by the time since the previous one
+    and a long C call is charged to the line that runs right after it.
+
+    1-in-N mode: every `every`-th update runs under cProfile (one at a
+    time, since only one profiler can hook the thread).
+
+    Both see the whole loop thread, so with concurrent updates the work of
+    overlapping updates lands in the same capture.
+    """
+
+    def __init__(self, directory: str, slow: float, every: int, interval: float, keep: int):
+        self.directory = directory
+        self.slow = slow
+        self.every = every
+        self.interval = interval
+        self.keep = keep
+        self.count = 0
+        self.in_flight = 0
+        self.samples = deque(maxlen=int(60 / interval))  # (perf_counter, ms since last sample, collapsed stack)
+        self.recent = deque(maxlen=20)  # summaries for /slowlog, newest last
+        self._profiling = False
+        self._loop_thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _sample(self):
+        last = time.perf_counter()
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            weight, last = (now - last) * 1000, now
+            if not self.in_flight:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = []
+            while frame is not None and len(stack) < 64:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples.append((now, weight, ";".join(reversed(stack))))
+
+    async def run(self, process, update):
+        if self.slow and self._loop_thread is None:
+            self._loop_thread = threading.get_ident()
+            threading.Thread(target=self._sample, name="profiler", daemon=True).start()
+        self.count += 1
+        profile = None
+        if self.every and self.count % self.every == 0 and not self._profiling:
+            self._profiling = True
+            profile = cProfile.Profile()
+            profile.enable()
+        self.in_flight += 1
+        t0 = time.perf_counter()
+        try:
+            await process(update)
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.in_flight -= 1
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            slow = bool(self.slow) and elapsed >= self.slow
+            if profile is not None or slow:
+                samples = [(w, stack) for t, w, stack in self.samples if t0 <= t <= t0 + elapsed] if slow else None
+                asyncio.get_running_loop().run_in_executor(
+                    None, self.capture, update, elapsed, profile, samples, datetime.utcnow()
+                )
+
+    def capture(self, update, elapsed: float, profile, samples, when: datetime):
+        """Write one capture file (runs in a worker thread) and remember its summary."""
+        try:
+            user = getattr(getattr(update, "effective_user", None), "id", None)
+            handler = update_handler_name(update)
+            stem = f"{when:%Y%m%dT%H%M%S%f}-{handler}-{user}"
+            head = f"# {when.isoformat()} handler={handler} user={user} elapsed={elapsed * 1000:.1f}ms"
+            if profile is not None:
+                profile.dump_stats(os.path.join(self.directory, stem + ".prof"))
+                out = io.StringIO()
+                pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(25)
+                body = out.getvalue()
+                top = pstats.Stats(profile).sort_stats("tottime")
+                leaders = [f"{func[2]} {stat[2]:.3f}s" for func, stat in
+                           sorted(top.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:3]]
+                kind = "cprofile"
+            else:
+                stacks, leaves = Tally(), Tally()
+                for weight, stack in samples:
+                    stacks[stack] += weight
+                    leaves[stack.rsplit(";", 1)[-1]] += weight
+                body = "\n".join(f"{stack} {round(ms)}" for stack, ms in stacks.most_common())
+                total = sum(leaves.values()) or 1
+                leaders = [f"{leaf} {ms * 100 / total:.0f}%" for leaf, ms in leaves.most_common(3)]
+                kind = f"{len(samples)} samples"
+            path = os.path.join(self.directory, stem + ".txt")
+            with open(path, "w") as f:
+                f.write(f"{head} mode={kind}\n{body}\n")
+            self.recent.append({
+                "at": when, "handler": handler, "user": user, "ms": elapsed * 1000,
+                "kind": kind, "top": leaders, "file": path,
+            })
+            self.rotate()
+        except Exception:
+            logger.exception("Failed to write profile capture.")
+
+    def rotate(self):
+        files = sorted(os.listdir(self.directory))
+        stems = sorted({name.rsplit(".", 1)[0] for name in files})
+        for stem in stems[:-self.keep] if self.keep else ():
+            for name in files:
+                if name.rsplit(".", 1)[0] == stem:
+                    os.remove(os.path.join(self.directory, name))
+
+
+def update_handler_name(update) -> str:
+    """Callback names of the handlers that take `update` (one per group), for labelling captures."""
+    names = []
+    app = _application
+    for handlers in (app.handlers.values() if app else ()):
+        for handler in handlers:
+            try:
+                if handler.check_update(update):
+                    names.append(handler.callback.__name__)
+                    break
+            except Exception:
+                continue
+    return "+".join(names) or "unhandled"
+
+
+class ProfilingApplication(Application):
+    """Application whose update dispatch runs through the profiler."""
+
+    async def process_update(self, update: object) -> None:
+        await profiler.run(super().process_update, update)
+
+
+profiler: Optional[UpdateProfiler] = None
+_application: Optional[Application] = None
+
+
+# -----------------------
+# Worker processes
+# -----------------------
+# In multi-process mode (WORKERS > 0) the front process only receives
+# updates and routes them: user updates and admin actions on one user go
+# to the worker owning that user, admin commands over all users
+# (FANOUT_COMMANDS) to every worker, each answering for its own users.
+# Changes to users owned elsewhere (referrer bonuses, downline aggregates,
+# new referrals) travel as SHARD_OPS messages relayed by the front, as do
+# TXID checks, which go to the worker indexing the TXID (txid_worker).
+FANOUT_COMMANDS = {
+    "distribute", "usercount", "reconcile", "query", "pending", "approve", "slowlog", "deadletters",
+    "broadcast", "broadcast_to", "broadcast_status", "broadcast_cancel",
+}
+TARGETED_COMMANDS = {"confirm", "userinfo"}  # first argument is the user acted on
+
+
+def _op_bonus(user_id: str, bonus_type: str, source: Optional[str]):
+    add_referral_bonus(user_id, bonus_type, source)
+    return None, [user_id]
+
+
+def _op_downline(user_id: str, distance: int, members: int, paid: int, volume: float):
+    return None, climb_downline(user_id, distance, members, paid, volume)
+
+
+# new users still waiting for their referrer's worker to answer. They can't adopt
+# anyone until linked, so new users naming each other can't form a cycle.
+joining: set = set()
+
+
+def _op_adopt(user_id: str, child: str):
+    """Record `child` as a direct referral; False if the referrer doesn't exist or is still joining."""
+    user = users.get(user_id)
+    if user is None or user_id in joining:
+        return False, []
+    user.setdefault("referrals", []).append(child)
+    return True, [user_id]
+
+
+def _op_txid_claim(_, txid: str, user_id: str, slot: str):
+    return txid_index.claim(txid, user_id, slot), []
+
+
+def _op_txid(_, batch):
+    for txid, uid, removed, added in batch:
+        txid_index.apply(txid, uid, removed, added)
+    return None, []
+
+
+def _op_board(_, name: str, k: int, score: Optional[float]):
+    board = LEADERBOARDS[name]
+    above = board.entries.bisect_left((-score, "")) if score is not None else 0
+    return (board.top(k), len(board), above), []
+
+
+# op -> fn(user_id, *args) -> (result, IDs to save); user_id is None for call_all() ops
+SHARD_OPS = {
+    "bonus": _op_bonus, "downline": _op_downline, "adopt": _op_adopt, "board": _op_board,
+    "txid_claim": _op_txid_claim, "txid": _op_txid,
+}
+TXID_OPS = {"txid_claim", "txid"}  # keyed by normalized TXID instead of user ID; no user lock or save
+
+
+def route_op(op: str, key: str) -> int:
+    """The worker an op for `key` runs on."""
+    return txid_worker(key) if op in TXID_OPS else worker_of(key)
+
+
+async def on_owner(op: str, user_id: str, *args):
+    """
+    Run SHARD_OPS[op] for `user_id`: here, where the caller holds the user's
+    lock and saves the returned IDs, or on the worker owning the user, which
+    locks and saves them itself. Returns (result, IDs to save).
+    """
+    if owns(user_id):
+        return SHARD_OPS[op](user_id, *args)
+    return await shard_link.call(op, user_id, *args), []
+
+
+async def claim_txid(txid: str, user_id: str, slot: str) -> Optional[List[tuple]]:
+    """
+    Duplicate check for a TXID `user_id` submits into `slot`, on the worker
+    indexing that TXID, which holds it for them at once if it's free so two
+    workers can't both accept it. None if that worker didn't answer.
+    """
+    key = normalize_txid(txid)
+    if owns_txid(key):
+        return txid_index.claim(txid, user_id, slot)
+    try:
+        return await shard_link.call("txid_claim", key, txid, user_id, slot)
+    except asyncio.TimeoutError:
+        logger.error("TXID check for user %s timed out on worker %d", user_id, txid_worker(key))
+        return None
+
+
+class PipeSender:
+    """
+    Writes messages to a worker pipe from a daemon thread. A pipe holds only
+    a few dozen KB, so a send on the event loop blocks while the other side
+    is busy - and when both ends are sending at once, neither loop ever gets
+    back to reading and the two deadlock. send() pickles the message on the
+    caller's thread (so it can't change after the call) and returns at once;
+    the thread writes messages in order. Receiving stays on the loop: the
+    peer's thread always finishes a message once it has started it.
+    """
+
+    def __init__(self, conn, name: str):
+        self.conn = conn
+        self.closed = False
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        """Queue `message`; OSError if the pipe is known to be broken."""
+        if self.closed:
+            raise OSError("pipe is closed")
+        data = ForkingPickler.dumps(message)
+        with self._cond:
+            self._queue.append(data)
+            self._cond.notify()
+
+    def close(self, timeout: Optional[float] = None):
+        """Write what is queued (waiting up to `timeout` seconds), then stop the thread."""
+        with self._cond:
+            self._queue.append(None)
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                data = self._queue.popleft()
+            if data is None:
+                return
+            try:
+                self.conn.send_bytes(data)
+            except OSError:
+                if not self.closed:
+                    logger.error("Pipe to %s broke - dropping its queued messages", self._thread.name)
+                self.closed = True
+                with self._cond:
+                    self._queue = deque(d for d in self._queue if d is None)
+
+
+class ShardLink:
+    """
+    A worker's end of its pipe to the front process. Routed updates arrive
+    here and go on the application's update queue; cast() / call() run an
+    op on the worker owning a user and call_all() on every worker, with
+    the front relaying both ways. Messages are pickled tuples, sent through
+    a PipeSender so the loop never blocks on a full pipe.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.sender: Optional[PipeSender] = None
+        self.app = None
+        self.tag_bot = None
+        self.calls: Dict[int, asyncio.Future] = {}
+        self.next_id = 0
+        self.stopped: Optional[asyncio.Event] = None
+
+    def attach(self, conn, app, tag_bot):
+        self.conn, self.app, self.tag_bot = conn, app, tag_bot
+        self.stopped = asyncio.Event()
+        self.sender = PipeSender(conn, "front")
+        asyncio.get_running_loop().add_reader(conn.fileno(), self._receive)
+
+    def detach(self):
+        """Write the replies still queued for the front."""
+        if self.sender is not None:
+            self.sender.close(OUTBOX_DRAIN_TIMEOUT)
+
+    def cast(self, op: str, user_id: str, *args):
+        """Fire and forget: the owner applies and saves the change."""
+        self.sender.send(("op", 0, op, user_id, args))
+
+    async def call(self, op: str, user_id: str, *args):
+        return await self._request("op", op, user_id, args)
+
+    async def call_all(self, op: str, *args) -> list:
+        """Run `op` on every worker (this one included) and return their results."""
+        return await self._request("all", op, None, args)
+
+    async def _request(self, kind: str, op: str, user_id: Optional[str], args):
+        """Send a request and wait for its result; asyncio.TimeoutError after SHARD_CALL_TIMEOUT."""
+        self.next_id += 1
+        req_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.calls[req_id] = future
+        self.sender.send((kind, req_id, op, user_id, args))
+        try:
+            return await asyncio.wait_for(future, SHARD_CALL_TIMEOUT)
+        finally:
+            self.calls.pop(req_id, None)
+
+    def _receive(self):
+        try:
+            message = self.conn.recv()
+        except (EOFError, OSError):
+            logger.warning("Front process went away - stopping worker %d", WORKER_INDEX)
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.sender.closed = True
+            self.stopped.set()
+            return
+        kind = message[0]
+        if kind == "update":
+            _, data, fanout = message
+            self.app.update_queue.put_nowait(Update.de_json(data, self.tag_bot if fanout else self.app.bot))
+        elif kind == "op":
+            _, src, req_id, op, user_id, args = message
+            self.app.create_task(self._apply(src, req_id, op, user_id, args))
+        elif kind == "result":
+            _, req_id, result = message
+            future = self.calls.pop(req_id, None)
+            if future is not None and not future.done():
+                future.set_result(result)
+        elif kind == "stop":
+            self.stopped.set()
+
+    async def _apply(self, src: int, req_id: int, op: str, user_id: Optional[str], args):
+        result = None
+        try:
+            if user_id is None or op in TXID_OPS:
+                result, touched = SHARD_OPS[op](user_id, *args)
+            else:
+                async with user_locks.hold(user_id):
+                    result, touched = SHARD_OPS[op](user_id, *args)
+                    if touched:
+                        save_data(*touched)
+        except Exception:
+            logger.exception("Shard op %s for %s failed", op, user_id)
+        if req_id:
+            self.sender.send(("result", src, req_id, result))
+
+
+shard_link = ShardLink()
+
+
+class ShardTagBot(ExtBot):
+    """Bot for fanned-out admin commands: every reply starts with the worker's tag."""
+
+    __slots__ = ("tag",)
+
+    def __init__(self, *args, tag: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():  # telegram objects are read-only after __init__
+            self.tag = tag
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return await super().send_message(chat_id, self.tag + text, *args, **kwargs)
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        return await super().edit_message_text(self.tag + text, *args, **kwargs)
+
+
+def route_targets(update: Update) -> List[int]:
+    """Indexes of the workers an update goes to (see FANOUT_COMMANDS)."""
+    user = update.effective_user
+    if user is None:
+        return [0]
+    if user.id == ADMIN_ID:
+        query = update.callback_query
+        if query and query.data and query.data.startswith(("confirm_", "reject_")):
+            return [worker_of(query.data.partition(":")[2])]
+        text = update.message.text if update.message else None
+        if text and text.startswith("/"):
+            words = text.split()
+            command = words[0][1:].split("@", 1)[0].lower()
+            if command in TARGETED_COMMANDS and len(words) > 1:
+                return [worker_of(words[1])]
+            if command in ("pending", "approve") and any(w.isdigit() for w in words[2:]):
+                return sorted({worker_of(w) for w in words[2:] if w.isdigit()})
+            if command in FANOUT_COMMANDS:
+                return list(range(WORKERS))
+    return [worker_of(str(user.id))]
+
+
+class FrontRouter:
+    """
+    The front process's side of the worker pipes: sends each update to its
+    workers and relays SHARD_OPS requests, results and call_all() gathers.
+    Each pipe is written by its own PipeSender.
+    """
+
+    def __init__(self, conns, procs):
+        self.conns = conns
+        self.senders: List[PipeSender] = []
+        self.procs = procs
+        self.gathers: Dict[int, list] = {}  # gather id -> [src, req_id, results, still missing]
+        self.next_gather = 0
+        self.stopping = False
+
+    async def start(self, app):
+        loop = asyncio.get_running_loop()
+        for index, conn in enumerate(self.conns):
+            self.senders.append(PipeSender(conn, f"worker-{index}"))
+            loop.add_reader(conn.fileno(), self._relay, index)
+
+    async def stop(self, app):
+        self.stopping = True
+        for sender in self.senders:
+            try:
+                sender.send(("stop",))
+            except OSError:
+                pass
+        loop = asyncio.get_running_loop()
+        for index, proc in enumerate(self.procs):
+            await loop.run_in_executor(None, proc.join, OUTBOX_DRAIN_TIMEOUT + 30)
+            if proc.is_alive():
+                logger.error("Worker %d did not stop - terminating it", index)
+                proc.terminate()
+        for sender in self.senders:
+            sender.closed = True  # nothing reads the pipes any more
+            await loop.run_in_executor(None, sender.close, 1.0)
+
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        targets = route_targets(update)
+        data = update.to_dict()
+        for index in targets:
+            self._send(index, ("update", data, len(targets) > 1))
+
+    def _send(self, index: int, message):
+        try:
+            self.senders[index].send(message)
+        except OSError:
+            logger.error("Worker %d is gone - dropped a %s message", index, message[0])
+
+    def _relay(self, src: int):
+        try:
+            message = self.conns[src].recv()
+        except (EOFError, OSError):
+            if not self.stopping:
+                logger.error("Worker %d exited unexpectedly", src)
+            self.senders[src].closed = True
+            asyncio.get_running_loop().remove_reader(self.conns[src].fileno())
+            return
+        kind = message[0]
+        if kind == "op":
+            _, req_id, op, user_id, args = message
+            self._send(route_op(op, user_id), ("op", src, req_id, op, user_id, args))
+        elif kind == "all":
+            _, req_id, op, _, args = message
+            self.next_gather -= 1  # negative ids mark replies to the front itself
+            self.gathers[self.next_gather] = [src, req_id, [None] * len(self.conns), len(self.conns)]
+            for index in range(len(self.conns)):
+                self._send(index, ("op", -1, self.next_gather, op, None, args))
+        elif kind == "result":
+            _, dest, req_id, result = message
+            if dest >= 0:
+                self._send(dest, ("result", req_id, result))
+                return
+            gather = self.gathers[req_id]
+            gather[2][src] = result
+            gather[3] -= 1
+            if not gather[3]:
+                del self.gathers[req_id]
+                self._send(gather[0], ("result", gather[1], gather[2]))
+
+
+def prepare_shards():
+    """
+    Front process, before the workers start: migrate or reshard the user
+    files, build the downline aggregates over all users if needed and
+    return each worker's part of the TXID index, as (owners, spent).
+    """
+    full = ShardedStorage(SHARD_DIR, SHARD_COUNT, DATA_FILE,
+                          SNAPSHOT_FILE if BINARY_SNAPSHOT else None, SHARD_WORKERS, journal_path=JOURNAL_FILE)
+    data = full.load()
+    if not meta.get("downline_built"):
+        build_downline(data)
+        full.save(data)
+        meta["downline_built"] = True
+        save_meta()
+        logger.info("Built referral downline aggregates for %d users", len(data))
+    full.close()
+    seeds = [TxidIndex() for _ in range(WORKERS)]
+    for uid, user in data.items():
+        for entry in _txid_entries(user):
+            seeds[txid_worker(entry[1])].apply(entry[1], uid, (), (entry,))
+    return [(seed.owners, seed.spent) for seed in seeds]
+
+
+def run_worker(conn, txid_seed):
+    """Worker process entry point; the front started it with WORKER_INDEX set."""
+    txid_index.seed(*txid_seed)
+    # the front stops its workers over the pipe, after the last routed update
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(serve_worker(conn))
+
+
+async def serve_worker(conn):
+    app = build_application()
+    tag_bot = ShardTagBot(BOT_TOKEN, base_url=BOT_API_URL, request=MeteredRequest(connection_pool_size=8),
+                          tag=f"Shard {WORKER_INDEX + 1}/{WORKERS}: ")
+    if METRICS_PORT:
+        start_metrics_server(METRICS_ADDR, METRICS_PORT)
+    await app.initialize()
+    await tag_bot.initialize()
+    await app.post_init(app)
+    shard_link.attach(conn, app, tag_bot)
+    await app.start()
+    logger.info("Worker %d/%d serving %d users", WORKER_INDEX + 1, WORKERS, len(users))
+    try:
+        await shard_link.stopped.wait()
+    finally:
+        await app.stop()  # handles everything already routed here
+        await app.post_shutdown(app)
+        await tag_bot.shutdown()
+        await app.shutdown()
+        await asyncio.to_thread(shard_link.detach)
+
+
+def run_front():
+    if STORAGE_MODE != "sharded":
+        raise SystemExit("WORKERS needs STORAGE_MODE=sharded")
+    txid_seeds = prepare_shards()
+    context = multiprocessing.get_context("spawn")
+    conns, procs = [], []
+    for index in range(WORKERS):
+        conn, child = context.Pipe()
+        os.environ["WORKER_INDEX"] = str(index)  # read by the worker's import of this module
+        proc = context.Process(target=run_worker, args=(child, txid_seeds[index]), name=f"worker-{index}")
+        proc.start()
+        child.close()
+        conns.append(conn)
+        procs.append(proc)
+    del os.environ["WORKER_INDEX"]
+
+    front = FrontRouter(conns, procs)
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .request(MeteredRequest(connection_pool_size=8))
+        .post_init(front.start)
+        .post_shutdown(front.stop)
+        .build()
+    )
+    app.add_handler(TypeHandler(Update, front.route))
+    if METRICS_PORT:
+        start_metrics_server(METRICS_ADDR, METRICS_PORT)
+
+    logger.info("🚀 Front process started with %d workers.", WORKERS)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
+
 
 # -----------------------
 # Main
 # -----------------------
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def on_startup(app):
+    outbox.start(app.bot)
+    await resume_broadcast(app)
+
+
+async def on_shutdown(app):
+    await stop_broadcast()
+    await outbox.stop(OUTBOX_DRAIN_TIMEOUT)
+    # flush the background writer without blocking the loop on disk I/O, then close
+    # the storage here: SQLite's reader connection belongs to this thread
+    await asyncio.get_running_loop().run_in_executor(None, flush_persistence)
+    storage.close()
+
+
+def build_application() -> Application:
+    """The bot's Application with every handler registered (and timed)."""
+    global profiler, _application
+    builder = ApplicationBuilder()
+    if PROFILE_SLOW_MS or PROFILE_EVERY:
+        profiler = UpdateProfiler(
+            PROFILE_DIR, PROFILE_SLOW_MS / 1000, PROFILE_EVERY, PROFILE_INTERVAL_MS / 1000, PROFILE_KEEP
+        )
+        builder = builder.application_class(ProfilingApplication)
+    app = _application = (
+        builder
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .request(MeteredRequest(connection_pool_size=256))
+        .concurrent_updates(CONCURRENT_UPDATES or False)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # Per-user throttling runs ahead of every other handler
+    app.add_handler(TypeHandler(Update, throttle), group=-1)
 
     # Basic user commands
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("faq", faq))
     app.add_handler(CommandHandler("referral", referral))
+    app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CommandHandler("pay", pay))
     app.add_handler(CommandHandler("invest", invest))
     app.add_handler(CommandHandler("withdraw", withdraw))
@@ -899,15 +5061,41 @@ def main():
     app.add_handler(CommandHandler("distribute", distribute))
     app.add_handler(CommandHandler("usercount", usercount))
     app.add_handler(CommandHandler("userinfo", userinfo))
+    app.add_handler(CommandHandler("reconcile", reconcile))
+    app.add_handler(CommandHandler("leaderboard", leaderboard))
+    app.add_handler(CommandHandler("query", admin_query))
+    app.add_handler(CommandHandler("pending", pending_queue))
+    app.add_handler(CommandHandler("approve", approve_all))
+    app.add_handler(CommandHandler("slowlog", slowlog))
+    app.add_handler(CommandHandler("deadletters", deadletters))
     app.add_handler(CommandHandler("broadcast", broadcast))
+    app.add_handler(CommandHandler("broadcast_to", broadcast_to))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status))
+    app.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel))
     app.add_handler(CommandHandler("confirm", confirm_payment_manual))
 
     # Callback query handler (for inline buttons)
     app.add_handler(CallbackQueryHandler(callback_query_handler, pattern="^(confirm_|reject_)"))
     app.add_handler(CallbackQueryHandler(menu_handler, pattern="^menu:"))
 
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+    return app
+
+
+def main():
+    if WORKERS:
+        return run_front()
+    app = build_application()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_ADDR, METRICS_PORT)
+
     logger.info("🚀 Bot started successfully.")
-    app.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
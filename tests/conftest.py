@@ -0,0 +1,44 @@
+"""
+main.py loads users and opens its storage at import, so every file it
+touches is pointed at a temp dir before the first test imports it.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="referral-tests-")
+for _name, _path in (
+    ("DATA_FILE", "users.json"),
+    ("META_FILE", "meta.json"),
+    ("LEDGER_FILE", "ledger.jsonl"),
+    ("JOURNAL_FILE", "users.journal"),
+    ("SQLITE_FILE", "users.db"),
+    ("SNAPSHOT_FILE", "users.snap"),
+    ("SHARD_DIR", "users.shards"),
+    ("DEAD_LETTER_FILE", "dead_letters.jsonl"),
+    ("BROADCAST_FILE", "broadcast.json"),
+    ("PROFILE_DIR", "profiles"),
+):
+    os.environ[_name] = os.path.join(_TMP, _path)
+os.environ["STORAGE_MODE"] = "json"
+os.environ["PERSIST_FLUSH_INTERVAL"] = "0"
+os.environ["PER_CHAT_SEND_RATE"] = "1000"  # admin notices would otherwise go out at 1/s
+os.environ.pop("WORKERS", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def bot():
+    """The main module with an empty user set and indexes."""
+    main.users.clear()
+    main.txid_index.build(main.users)
+    main.invest_columns = None
+    yield main
+    main.users.clear()
+    main.txid_index.build(main.users)
+    main.invest_columns = None
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from main import INVEST_LOCK_DAYS, UserRecord
+
+DAY = timedelta(days=1)
+START = datetime(2026, 1, 1, 12, 0)
+
+
+def investor(amount=100.0):
+    return UserRecord.from_dict({"investment": {
+        "amount": amount,
+        "start_date": START.isoformat(),
+        "active": True,
+        "lock_until": (START + INVEST_LOCK_DAYS * DAY).isoformat(),
+    }})
+
+
+@pytest.fixture(params=["per-user", "columnar"])
+def distribute(request, bot):
+    if request.param == "columnar":
+        pytest.importorskip("numpy")
+        return bot._distribute_columnar
+    return bot._distribute_per_user
+
+
+def test_manual_pays_each_lock_day_once(bot, distribute):
+    bot.users["1"] = user = investor()
+    # runs at the investment's own time of day, including the lock boundary itself
+    paid = sum(distribute(START + day * DAY) for day in range(INVEST_LOCK_DAYS + 2))
+    assert paid == INVEST_LOCK_DAYS
+    assert user["profit_total"] == pytest.approx(100.0 * bot.DAILY_PROFIT_RATE * INVEST_LOCK_DAYS)
+    assert user["investment"]["accrued_through"] == (START + INVEST_LOCK_DAYS * DAY).isoformat()
+
+
+@pytest.mark.parametrize("manual_days, paid_days", [
+    (range(0, 10), INVEST_LOCK_DAYS),
+    (range(0, 30), INVEST_LOCK_DAYS),
+    ([0, 20], 2 + INVEST_LOCK_DAYS - 21),  # days missed by manual runs stay unpaid, as before
+])
+def test_manual_then_lazy_never_pays_past_the_lock(bot, distribute, manual_days, paid_days):
+    bot.users["1"] = user = investor()
+    for day in manual_days:
+        distribute(START + day * DAY + timedelta(hours=1))
+    bot.accrue_profit("1", user, START + (INVEST_LOCK_DAYS + 5) * DAY)
+    assert user["profit_total"] == pytest.approx(100.0 * bot.DAILY_PROFIT_RATE * paid_days)
+
+
+def test_lazy_then_manual_skips_paid_days(bot, distribute):
+    bot.users["1"] = user = investor()
+    assert bot.accrue_profit("1", user, START + 10.5 * DAY) == pytest.approx(10.0)
+    assert distribute(START + 10.5 * DAY) == 1  # day 10 is still open
+    assert distribute(START + 10.75 * DAY) == 0
+    assert distribute(START + INVEST_LOCK_DAYS * DAY) == 0
+    bot.accrue_profit("1", user, START + (INVEST_LOCK_DAYS + 5) * DAY)
+    assert user["profit_total"] == pytest.approx(100.0 * bot.DAILY_PROFIT_RATE * INVEST_LOCK_DAYS)
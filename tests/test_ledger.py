@@ -0,0 +1,49 @@
+from main import Ledger, UserRecord
+
+
+def open_ledger(tmp_path, data):
+    ledger = Ledger(str(tmp_path / "ledger.jsonl"))
+    ledger.open(data)
+    return ledger
+
+
+def saved(data):
+    return {uid: u.copy() for uid, u in data.items()}
+
+
+def test_entries_of_unsaved_records_are_voided(tmp_path):
+    data = {"1": UserRecord.from_dict({"balance": 5.0}), "2": UserRecord()}
+    ledger = open_ledger(tmp_path, data)
+    ledger.post("1", data["1"], "direct", 2.0)
+    lines, seq = ledger.take()
+    ledger.write(lines)
+    on_disk = saved(data)  # the records are saved with the first entry
+    ledger.commit(seq)
+
+    ledger.post("1", data["1"], "pairing", 1.0)
+    ledger.post("2", data["2"], "direct", 2.0)
+    ledger.write(ledger.take()[0])  # crash: lines on disk, records never saved
+    ledger.file.close()
+
+    ledger = open_ledger(tmp_path, on_disk)
+    totals = ledger.totals(ledger.seq)
+    assert totals["1"]["*"] == on_disk["1"]["balance"] == 7.0
+    assert "2" not in totals
+    assert ledger.seq == 3  # voided numbers are not reused
+    ledger.close()
+
+
+def test_torn_line_is_dropped_and_appends_stay_readable(tmp_path):
+    data = {"1": UserRecord()}
+    ledger = open_ledger(tmp_path, data)
+    ledger.post("1", data["1"], "direct", 2.0)
+    line = ledger.take()[0][0]
+    ledger.file.write(line[:len(line) // 2])  # crash mid-write
+    ledger.file.close()
+
+    ledger = open_ledger(tmp_path, {"1": UserRecord()})
+    ledger.post("1", data["1"], "direct", 3.0)
+    ledger.close()
+    ledger = open_ledger(tmp_path, data)
+    assert ledger.totals(ledger.seq)["1"]["*"] == 3.0
+    ledger.close()
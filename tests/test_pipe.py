@@ -0,0 +1,31 @@
+import multiprocessing
+import time
+
+import pytest
+
+
+def test_send_does_not_block_on_a_full_pipe(bot):
+    front, worker = multiprocessing.Pipe()
+    sender = bot.PipeSender(front, "worker-0")
+    payload = ["x" * 1024] * 1024  # ~1 MB per message, far past the pipe buffer
+    started = time.perf_counter()
+    for n in range(8):
+        sender.send(("update", n, payload))
+    assert time.perf_counter() - started < 1.0  # nobody is reading yet
+    payload.append("changed after send")
+    for n in range(8):
+        kind, got, data = worker.recv()
+        assert (kind, got, len(data)) == ("update", n, 1024)
+    sender.close(5)
+    assert not sender._thread.is_alive()
+
+
+def test_send_raises_once_the_peer_is_gone(bot):
+    front, worker = multiprocessing.Pipe()
+    sender = bot.PipeSender(front, "worker-0")
+    worker.close()
+    sender.send(("stop",))
+    sender.close(5)
+    assert sender.closed
+    with pytest.raises(OSError):
+        sender.send(("stop",))
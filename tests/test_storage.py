@@ -0,0 +1,133 @@
+import pickle
+
+import pytest
+
+from main import (JournalStorage, JsonStorage, PersistenceWriter, ShardedStorage, SqliteStorage, UserRecord,
+                  load_snapshot, write_snapshot)
+
+
+def open_shards(tmp_path, journal_path=None):
+    storage = ShardedStorage(str(tmp_path / "shards"), 4, str(tmp_path / "users.json"), workers=1,
+                             journal_path=journal_path)
+    return storage, storage.load()
+
+
+def as_dicts(data):
+    return {uid: u.to_dict() for uid, u in data.items()}
+
+
+def sample_users():
+    return {
+        "1": UserRecord.from_dict({
+            "referrer": None, "balance": 12.5, "paid": True, "txid": "0xabc", "referrals": ["2", "3"],
+            "investment": {"amount": 100.0, "start_date": "2026-01-01T00:00:00", "active": True,
+                           "lock_until": "2026-01-31T00:00:00", "referrer_rewarded_for_invest": False,
+                           "txid": "0xdef", "accrued_through": "2026-01-05T00:00:00"},
+            "pending_withdraw": {"wallet": "TXyz", "amount": 5.0, "submitted_at": "2026-01-06T00:00:00"},
+            "profit_total": 4.0, "spent_txids": ["0x123"],
+        }),
+        "2": UserRecord.from_dict({
+            "referrer": "1", "balance": 0.0, "paid": False, "txid": "0x999",
+            "pending_investment": {"amount": 50.0, "txid": "0x777", "submitted_at": "2026-01-07T00:00:00"},
+        }),
+        "3": UserRecord.from_dict({"referrer": "1", "balance": 1.0, "left": 2, "pairing_day": "2026-01-07"}),
+    }
+
+
+def test_sharded_writer_patches_dirty_shards(tmp_path):
+    storage, data = open_shards(tmp_path)
+    data.update({str(uid): UserRecord.from_dict({"balance": float(uid)}) for uid in range(20)})
+    storage.save(data)
+    writer = PersistenceWriter(storage, data, 3600, 3600)
+    assert writer.image is None
+
+    data["3"]["balance"] = 30.0
+    del data["7"]
+    data["20"] = UserRecord.from_dict({"balance": 20.0})
+    writer.mark(data, ["3", "7", "20"])
+    writer.close()
+    storage.close()
+
+    reader, loaded = open_shards(tmp_path)
+    reader.close()
+    assert {uid: u["balance"] for uid, u in loaded.items()} == {uid: u["balance"] for uid, u in data.items()}
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_snapshot_round_trip(tmp_path, compress):
+    data = {
+        "1": UserRecord.from_dict({"balance": 1.5, "referrals": ["2", "3"], "pairing_day": "2026-01-01",
+                                   "investment": {"amount": 10.0, "start_date": "2026-01-01T00:00:00",
+                                                  "active": True}}),
+        "2": UserRecord.from_dict({"referrer": "1", "referrals": ["not-a-number"], "note": {"x": [1]}}),
+    }
+    path = str(tmp_path / "users.snap")
+    write_snapshot(path, data, compress)
+    assert {uid: u.to_dict() for uid, u in load_snapshot(path).items()} == {uid: u.to_dict() for uid, u in data.items()}
+
+
+class Boom:
+    def __reduce__(self):
+        return (exec, ("raise SystemExit('unpickled')",))
+
+
+def test_old_pickle_snapshot_is_not_unpickled(tmp_path):
+    (tmp_path / "users.json").write_text('{"1": {"balance": 2.0}}')
+    (tmp_path / "users.snap").write_bytes(b"RBSNAP1r" + pickle.dumps({"schema": 1, "users": Boom()}))
+    loaded = JsonStorage(str(tmp_path / "users.json"), str(tmp_path / "users.snap")).load()
+    assert loaded["1"]["balance"] == 2.0
+
+
+def test_to_dict_keeps_the_stored_shape():
+    stored = {"balance": 0.0, "left": 0, "right": 0, "referrals": [], "paid": False, "earned_from_referrals": 0.0,
+              "direct_bonus_total": 0.0, "pairing_bonus_total": 0.0}
+    record = UserRecord.from_dict(stored)
+    assert record["team_size"] == 0 and record["profit_total"] == 0.0
+    assert record.to_dict() == stored
+    record["profit_total"] = 1.5
+    assert record.to_dict() == dict(stored, profit_total=1.5)
+
+
+def test_sqlite_round_trip(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "users.db"))
+    data = storage.load()
+    data.update(sample_users())
+    storage.save(data)
+    data["2"]["pending_investment"] = None
+    data["2"]["balance"] = 3.0
+    data["3"]["referrals"] = ["4"]
+    data["4"] = UserRecord.from_dict({"referrer": "3"})
+    del data["1"]
+    storage.save(data, ["1", "2", "3", "4"])
+    storage.close()
+
+    # SQLite columns come back as None / False where the record never set them: same reads
+    def settled(records):
+        return {uid: {k: v for k, v in u.items() if v is not None and v is not False}
+                for uid, u in as_dicts(records).items()}
+
+    reader = SqliteStorage(str(tmp_path / "users.db"))
+    assert settled(reader.load()) == settled(data)
+    assert reader.referral_ids("3") == ["4"]
+    reader.close()
+
+
+def test_shard_migration_replays_the_journal(tmp_path):
+    journal_path = str(tmp_path / "users.journal")
+    journal = JournalStorage(str(tmp_path / "users.json"), journal_path, 1000)
+    data = journal.load()
+    data.update(sample_users())
+    journal.save(data)  # snapshot
+    data["3"]["balance"] = 9.0
+    data["5"] = UserRecord.from_dict({"referrer": "3"})
+    del data["2"]
+    journal.save(data, ["2", "3", "5"])  # only in the journal
+
+    storage, migrated = open_shards(tmp_path, journal_path)
+    storage.close()
+    assert as_dicts(migrated) == as_dicts(data)
+    assert (tmp_path / "users.journal.migrated").exists() and not (tmp_path / "users.journal").exists()
+
+    reader, loaded = open_shards(tmp_path, journal_path)
+    reader.close()
+    assert as_dicts(loaded) == as_dicts(data)
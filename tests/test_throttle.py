@@ -0,0 +1,52 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def message(uid, text):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=uid), message=FakeMessage(text), callback_query=None)
+
+
+@pytest.fixture
+def throttle(bot, monkeypatch):
+    monkeypatch.setattr(bot, "THROTTLE_BUCKETS", {
+        "read": bot.BucketMap(0.001, 5, 100),
+        "write": bot.BucketMap(0.001, 3, 100),
+    })
+    monkeypatch.setattr(bot, "THROTTLE_NOTICES", bot.BucketMap(0.001, 1, 100))
+
+    def check(update):
+        try:
+            asyncio.run(bot.throttle(update, None))
+        except ApplicationHandlerStop:
+            return False
+        return True
+    return check
+
+
+def test_write_commands_have_their_own_smaller_budget(throttle):
+    updates = [message(7, "/pay 0xabc") for _ in range(5)]
+    assert [throttle(u) for u in updates] == [True, True, True, False, False]
+    # one slow-down notice, not one per dropped update
+    assert sum(len(u.message.replies) for u in updates) == 1
+    assert all(throttle(message(7, "/balance")) for _ in range(5))
+    assert not throttle(message(7, "/balance"))
+
+
+def test_budgets_are_per_user_and_skip_the_admin(bot, throttle):
+    for _ in range(3):
+        throttle(message(7, "/invest 100 T"))
+    assert not throttle(message(7, "/invest@testbot 100 T"))
+    assert throttle(message(8, "/invest 100 T"))
+    assert all(throttle(message(bot.ADMIN_ID, "/pay x")) for _ in range(10))
@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def command(uid, *args):
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=int(uid), full_name=f"U{uid}"),
+                             effective_chat=SimpleNamespace(id=int(uid)), message=FakeMessage())
+    return update, SimpleNamespace(args=list(args), bot=FakeBot())
+
+
+@pytest.fixture
+def run(bot, monkeypatch):
+    """Run a coroutine with a started outbox of its own (queues bind to one event loop)."""
+    def run(make_coro):
+        async def main():
+            monkeypatch.setattr(bot, "outbox", bot.Outbox(bot.DEAD_LETTER_FILE, 2, 1))
+            bot.outbox.start(FakeBot())
+            try:
+                return await make_coro()
+            finally:
+                await bot.outbox.stop(1)
+        return asyncio.run(main())
+    return run
+
+
+def submit(run, bot, handler, uid, *args):
+    update, context = command(uid, *args)
+    run(lambda: handler(update, context))
+    return update.message.replies[-1]
+
+
+def test_txid_stays_taken_after_batch_approval_and_reinvestment(bot, run):
+    for uid in ("11", "12", "13"):
+        bot.users[uid] = bot.UserRecord.from_dict({"paid": True})
+    assert "pending" in submit(run, bot, bot.invest, "11", "100", "0xAAA")
+    done, failed, _ = run(lambda: bot.approve_batch("invest", ["11"], []))
+    assert [uid for uid, _ in done] == ["11"] and not failed
+
+    # the confirmed investment's TXID, in any spelling, is refused for everyone else
+    assert "already" in submit(run, bot, bot.invest, "12", "100", "aaa")
+    assert "already" in submit(run, bot, bot.pay, "13", "0XAAA")
+
+    # reinvesting retires the old TXID: it stays spent
+    assert "pending" in submit(run, bot, bot.invest, "11", "200", "0xBBB")
+    run(lambda: bot.approve_batch("invest", ["11"], []))
+    assert bot.users["11"]["investment"]["txid"] == "0xBBB"
+    assert "already" in submit(run, bot, bot.invest, "12", "100", "0xaaa")
+    assert "already" in submit(run, bot, bot.invest, "11", "100", "0xAAA")
+
+
+def test_approving_a_legacy_duplicate_warns_the_admin(bot):
+    bot.users["21"] = bot.UserRecord.from_dict({"pending_investment": {"amount": 100.0, "txid": "T1"}})
+    bot.users["22"] = bot.UserRecord.from_dict({"pending_investment": {"amount": 50.0, "txid": "t1"}})
+    bot.txid_index.build(bot.users)  # recorded before the index rejected duplicates
+
+    _, summary, _ = bot.approve_invest("21", bot.users["21"])
+    bot.save_data("21")
+    assert "TXID also used by user 22" in summary
+    with pytest.raises(ValueError):
+        bot.approve_invest("23", bot.UserRecord())